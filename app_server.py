@@ -6,6 +6,7 @@ import json
 import os
 import sys
 import subprocess
+import types
 from lxml import etree
 from functools import wraps
 from flask import url_for, make_response
@@ -29,16 +30,19 @@ from sqlalchemy.orm.exc import (
 )
 from model import (
     get_one,
+    CachedFeed,
     Complaint,
     Identifier,
     Patron,
 )
+from model.cachedfeed import FeedContent
 from cdn import cdnify
 from classifier import Classifier
 from config import Configuration
 from lane import (
     Facets,
     Pagination,
+    SortKeyPagination,
 )
 from problem_details import *
 
@@ -74,9 +78,10 @@ def entry_response(entry, cache_for=AcquisitionFeed.FEED_CACHE_TIME):
     return _make_response(entry, content_type, cache_for)
 
 def _make_response(content, content_type, cache_for):
+    streaming = isinstance(content, types.GeneratorType)
     if isinstance(content, etree._Element):
         content = etree.tostring(content)
-    elif not isinstance(content, basestring):
+    elif not (streaming or isinstance(content, (basestring, FeedContent))):
         content = unicode(content)
 
     if isinstance(cache_for, int):
@@ -89,8 +94,63 @@ def _make_response(content, content_type, cache_for):
     else:
         cache_control = "private, no-cache"
 
-    return make_response(content, 200, {"Content-Type": content_type,
-                                        "Cache-Control": cache_control})
+    headers = {"Content-Type": content_type,
+               "Cache-Control": cache_control}
+
+    if streaming:
+        # This is a feed being serialized a piece at a time. Send each
+        # piece as soon as it's ready. There's no way to know the
+        # feed's ETag until the whole thing has been sent, so it
+        # doesn't get one.
+        if flask.has_request_context():
+            # Keep the request (and its database session) around
+            # until the last piece has been produced.
+            content = flask.stream_with_context(content)
+        return make_response(content, 200, headers)
+
+    # A feed that came out of the cache knows its own hash, so it
+    # doesn't need to be hashed -- or even decompressed -- to find
+    # its ETag.
+    content_hash = getattr(content, 'content_hash', None)
+    if content_hash is None:
+        content_hash = CachedFeed.calculate_content_hash(
+            getattr(content, 'text', content)
+        )
+
+    # A feed that came out of the cache may already be compressed.
+    # If the client can handle the compressed version, it will be
+    # sent as-is.
+    compressed = getattr(content, 'compressed', None)
+    encoding = None
+    if compressed is not None:
+        headers["Vary"] = "Accept-Encoding"
+        if (flask.has_request_context()
+            and flask.request.accept_encodings[content.content_encoding] > 0):
+            encoding = content.content_encoding
+
+    # The compressed representation is a different sequence of
+    # bytes, so it needs its own strong ETag.
+    etag = content_hash
+    if encoding:
+        etag = "%s-%s" % (content_hash, encoding)
+    headers["ETag"] = '"%s"' % etag
+
+    # If the client already has this feed, tell it so without
+    # looking at the body. Either ETag is accepted, since they
+    # describe the same feed.
+    if flask.has_request_context():
+        if_none_match = flask.request.if_none_match
+        if (if_none_match.contains_weak(content_hash)
+            or if_none_match.contains_weak(etag)):
+            return make_response("", 304, headers)
+
+    if encoding:
+        headers["Content-Encoding"] = encoding
+        content = compressed
+    elif isinstance(content, FeedContent):
+        # The client needs the uncompressed feed.
+        content = content.text
+    return make_response(content, 200, headers)
 
 def load_facets_from_request(
         facet_config=None, worklist=None, base_class=Facets,
@@ -120,26 +180,31 @@ def load_facets_from_request(
         default_entrypoint, **kwargs
     )
 
-def load_pagination_from_request(default_size=Pagination.DEFAULT_SIZE):
-    """Figure out which Pagination object this request is asking for."""
-    arg = flask.request.args.get
-    size = arg('size', default_size)
-    offset = arg('after', 0)
-    return load_pagination(size, offset)
+def load_pagination_from_request(default_size=Pagination.DEFAULT_SIZE,
+                                 base_class=Pagination):
+    """Figure out which Pagination object this request is asking for.
+
+    :param base_class: The Pagination class to instantiate. Search
+        results should use SortKeyPagination.
+    """
+    return base_class.from_request(flask.request.args.get, default_size)
+
+def load_search_pagination_from_request(
+        default_size=Pagination.DEFAULT_SEARCH_SIZE):
+    """Figure out which page of search results this request is asking
+    for.
+
+    Search results are paged through by sort key if Elasticsearch
+    supports it, and by offset otherwise. Either way, links that
+    use an offset still work.
+    """
+    return load_pagination_from_request(
+        default_size, SortKeyPagination.for_search()
+    )
 
 def load_pagination(size, offset):
     """Turn user input into a Pagination object."""
-    try:
-        size = int(size)
-    except ValueError:
-        return INVALID_INPUT.detailed(_("Invalid page size: %(size)s", size=size))
-    size = min(size, 100)
-    if offset:
-        try:
-            offset = int(offset)
-        except ValueError:
-            return INVALID_INPUT.detailed(_("Invalid offset: %(offset)s", offset=offset))
-    return Pagination(offset, size)
+    return Pagination.from_request(dict(size=size, after=offset).get)
 
 def returns_problem_detail(f):
     @wraps(f)
@@ -260,8 +325,9 @@ class URNLookupController(object):
         opds_feed = LookupAcquisitionFeed(
             self._db, "Lookup results", this_url, self.works, annotator,
             precomposed_entries=self.precomposed_entries,
+            defer_entries=True
         )
-        return feed_response(opds_feed)
+        return feed_response(opds_feed.stream())
 
     def permalink(self, urn, annotator, route_name='work'):
         """Look up a single identifier and generate an OPDS feed."""
@@ -275,10 +341,11 @@ class URNLookupController(object):
         works = [work for (identifier, work) in self.works]
         opds_feed = AcquisitionFeed(
             self._db, urn, this_url, works, annotator,
-            precomposed_entries=self.precomposed_entries
+            precomposed_entries=self.precomposed_entries,
+            defer_entries=True
         )
 
-        return feed_response(opds_feed)
+        return feed_response(opds_feed.stream())
 
     def process_urns(self, urns, **process_urn_kwargs):
         """Processes a list of URNs for a lookup request.
@@ -124,6 +124,10 @@ class Configuration(object):
     NONGROUPED_MAX_AGE_POLICY = "default_nongrouped_feed_max_age"
     GROUPED_MAX_AGE_POLICY = "default_grouped_feed_max_age"
 
+    # Once a cached OPDS feed expires, it may be served for this many
+    # more seconds while a fresh copy is generated in the background.
+    STALE_FEED_MAX_AGE_POLICY = "stale_feed_max_age"
+
     # The name of the per-library configuration policy that controls whether
     # books may be put on hold.
     ALLOW_HOLDS = "allow_holds"
@@ -136,6 +140,10 @@ class Configuration(object):
     # 'featured' lanes.
     FEATURED_LANE_SIZE = "featured_lane_size"
 
+    # Each library may choose to build paginated lane feeds from the
+    # search index rather than the materialized view.
+    WORKS_FROM_SEARCH_INDEX = "works_from_search_index"
+
     # Each facet group has two associated per-library keys: one
     # configuring which facets are enabled for that facet group, and
     # one configuring which facet is the default.
@@ -184,6 +192,12 @@ class Configuration(object):
             "required": True,
             "type": "number",
         },
+        {
+            "key": STALE_FEED_MAX_AGE_POLICY,
+            "label": _("Time to keep serving an expired OPDS feed"),
+            "description": _("While an expired feed is being regenerated in the background, patrons will be shown the expired feed for up to this many seconds. If this is not set, expired feeds are regenerated before they are shown."),
+            "type": "number",
+        },
         {
             "key": BASE_URL_KEY,
             "label": _("Base url of the application"),
@@ -258,6 +272,17 @@ class Configuration(object):
             "max": 1,
             "default": 0.65,
         },
+        {
+            "key": WORKS_FROM_SEARCH_INDEX,
+            "label": _("Find the books in a lane using"),
+            "description": _("Using the search index takes load off the database, but the search index must have been rebuilt with version v4 or later of the search mapping."),
+            "type": "select",
+            "options": [
+                { "key": "false", "label": _("The database") },
+                { "key": "true", "label": _("The search index") },
+            ],
+            "default": "false",
+        },
     ] + [
         { "key": ENABLED_FACETS_KEY_PREFIX + group,
           "label": description,
@@ -25,6 +25,7 @@ from model import (
 from metadata_layer import (
     ReplacementPolicy
 )
+from util import count_estimate
 from util.worker_pools import DatabaseJob
 
 import log # This sets the appropriate log format.
@@ -203,7 +204,7 @@ class BaseCoverageProvider(object):
         count_as_covered_message = ' (counting %s as covered)' % (', '.join(count_as_covered))
 
         qu = self.items_that_need_coverage(count_as_covered=count_as_covered)
-        self.log.info("%d items need coverage%s", qu.count(),
+        self.log.info("%d items need coverage%s", count_estimate(qu),
                       count_as_covered_message)
         batch = qu.limit(self.batch_size).offset(offset)
 
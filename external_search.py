@@ -4,6 +4,7 @@ from elasticsearch.helpers import bulk as elasticsearch_bulk
 from elasticsearch.exceptions import ElasticsearchException
 from elasticsearch_dsl import (
     Index,
+    MultiSearch,
     Search,
     Q,
 )
@@ -17,6 +18,14 @@ from elasticsearch_dsl.query import (
     Bool,
     Query as BaseQuery
 )
+import inspect
+# Newer versions of elasticsearch-dsl can be told not to raise an
+# exception when one query in a multi-search fails. Older versions
+# don't raise an exception at all; the failed query's raw response
+# describes the error instead.
+MULTI_SEARCH_RAISE_ON_ERROR = (
+    'raise_on_error' in inspect.getargspec(MultiSearch.execute).args
+)
 
 from flask_babel import lazy_gettext as _
 from config import (
@@ -28,22 +37,40 @@ from classifier import (
     GradeLevelClassifier,
     AgeClassifier,
 )
+from facets import FacetConstants
 from model import (
     numericrange_to_tuple,
     ExternalIntegration,
     Library,
+    SearchIndexChange,
     Work,
     WorkCoverageRecord,
 )
-from monitor import WorkSweepMonitor
+from monitor import (
+    Monitor,
+    WorkSweepMonitor,
+)
 from coverage import (
     CoverageFailure,
     WorkPresentationProvider,
 )
+from util.cache import LRUCache
+from util.worker_pools import (
+    Job,
+    Pool,
+)
+import datetime
+import hashlib
+import json
 import os
 import logging
 import re
+import sys
 import time
+from threading import (
+    BoundedSemaphore,
+    Event,
+)
 
 class ExternalSearchIndex(object):
 
@@ -53,6 +80,33 @@ class ExternalSearchIndex(object):
 
     DEFAULT_WORKS_INDEX_PREFIX = u'circulation-works'
 
+    BULK_REQUESTS_IN_FLIGHT_KEY = u'bulk_requests_in_flight'
+
+    # By default, one bulk request can be uploading while the search
+    # documents for the next one are being generated.
+    DEFAULT_BULK_REQUESTS_IN_FLIGHT = 2
+
+    # Search documents are generated and uploaded in chunks of this
+    # many works, so that generating one chunk can overlap with
+    # uploading the previous one.
+    BULK_CHUNK_SIZE = 100
+
+    # The bulk API reports errors keyed by these operation types.
+    BULK_OPERATION_TYPES = ['index', 'create', 'update', 'delete']
+
+    RESULT_CACHE_TTL_KEY = u'result_cache_ttl'
+
+    # By default, search results are reused for five minutes.
+    DEFAULT_RESULT_CACHE_TTL = 300
+
+    # The search result cache will not take up more than this many
+    # bytes of memory.
+    RESULT_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+    # While an index is being built from scratch, nobody is searching
+    # it, so there's no need to refresh it or keep replicas in sync.
+    BULK_LOAD_SETTINGS = {"refresh_interval": "-1", "number_of_replicas": 0}
+
     work_document_type = 'work-type'
     __client = None
 
@@ -66,6 +120,18 @@ class ExternalSearchIndex(object):
           "required": True,
           "description": _("Any Elasticsearch indexes needed for this application will be created with this unique prefix. In most cases, the default will work fine. You may need to change this if you have multiple application servers using a single Elasticsearch server.")
         },
+        { "key": BULK_REQUESTS_IN_FLIGHT_KEY,
+          "label": _("Concurrent bulk uploads"),
+          "type": "number",
+          "default": DEFAULT_BULK_REQUESTS_IN_FLIGHT,
+          "description": _("The number of bulk indexing requests that may be sent to Elasticsearch at once while the next batch of search documents is being prepared. Set this to 0 to upload each batch before preparing the next one.")
+        },
+        { "key": RESULT_CACHE_TTL_KEY,
+          "label": _("Search result cache time (seconds)"),
+          "type": "number",
+          "default": DEFAULT_RESULT_CACHE_TTL,
+          "description": _("Search results will be reused for this many seconds when the same search is run again. Set this to 0 to disable the cache.")
+        },
     ]
 
     SITEWIDE = True
@@ -118,11 +184,13 @@ class ExternalSearchIndex(object):
         """Look up the name of the search index alias."""
         return cls.works_prefixed(_db, cls.CURRENT_ALIAS_SUFFIX)
 
-    def __init__(self, _db, url=None, works_index=None):
+    def __init__(self, _db, url=None, works_index=None,
+                 bulk_requests_in_flight=None, result_cache_ttl=None):
 
         self.log = logging.getLogger("External search index")
         self.works_index = None
         self.works_alias = None
+        self._bulk_upload_pool = None
         integration = None
 
         if not _db:
@@ -143,6 +211,28 @@ class ExternalSearchIndex(object):
                 "No URL configured to Elasticsearch server."
             )
 
+        if bulk_requests_in_flight is None and integration:
+            bulk_requests_in_flight = integration.setting(
+                self.BULK_REQUESTS_IN_FLIGHT_KEY
+            ).int_value
+        if bulk_requests_in_flight is None:
+            bulk_requests_in_flight = self.DEFAULT_BULK_REQUESTS_IN_FLIGHT
+        self.bulk_requests_in_flight = bulk_requests_in_flight
+
+        if result_cache_ttl is None and integration:
+            result_cache_ttl = integration.setting(
+                self.RESULT_CACHE_TTL_KEY
+            ).int_value
+        if result_cache_ttl is None:
+            result_cache_ttl = self.DEFAULT_RESULT_CACHE_TTL
+        self.result_cache = None
+        if result_cache_ttl > 0:
+            self.result_cache = LRUCache(
+                max_bytes=self.RESULT_CACHE_MAX_BYTES, ttl=result_cache_ttl,
+                sizeof=self._result_size
+            )
+        self._result_cache_configuration_time = None
+
         if not ExternalSearchIndex.__client:
             use_ssl = url.startswith('https://')
             self.log.info(
@@ -155,6 +245,7 @@ class ExternalSearchIndex(object):
 
         self.indices = self.__client.indices
         self.index = self.__client.index
+        self.count = self.__client.count
         self.delete = self.__client.delete
         self.exists = self.__client.exists
 
@@ -171,6 +262,9 @@ class ExternalSearchIndex(object):
                 )
 
         self.search = Search(using=self.__client, index=self.works_alias)
+        self.multi_search = MultiSearch(
+            using=self.__client, index=self.works_alias
+        )
 
         def bulk(docs, **kwargs):
             return elasticsearch_bulk(self.__client, docs, **kwargs)
@@ -204,6 +298,7 @@ class ExternalSearchIndex(object):
 
         def _use_as_works_alias(name):
             self.works_alias = self.__client.works_alias = name
+            self.clear_result_cache()
 
         if alias_is_set:
             # The alias exists on the Elasticsearch server, so it must
@@ -289,16 +384,60 @@ class ExternalSearchIndex(object):
             other_indices.remove(self.works_index)
 
         if other_indices:
-            # The alias exists on one or more other indices.  Remove
-            # the alias altogether, then put it back on the works
-            # index.
-            self.indices.delete_alias(index='_all', name=alias_name)
-            self.indices.put_alias(
-                index=self.works_index, name=alias_name
+            # The alias exists on one or more other indices. Move it
+            # to the works index in a single request, so that there's
+            # never a moment when the alias points nowhere (or to two
+            # different indices).
+            actions = [
+                dict(remove=dict(index=index, alias=alias_name))
+                for index in other_indices
+            ]
+            actions.append(
+                dict(add=dict(index=self.works_index, alias=alias_name))
             )
+            self.indices.update_aliases(body=dict(actions=actions))
 
         self.works_alias = self.__client.works_alias = alias_name
 
+        # Any cached search results came from a different index.
+        self.clear_result_cache()
+
+    def alias_points_to(self, _db, index):
+        """Is the -current alias, which is used for searches, pointing
+        at the given index?
+        """
+        alias_name = self.works_alias_name(_db)
+        return bool(self.indices.exists_alias(index=index, name=alias_name))
+
+    def start_bulk_load(self, index):
+        """Change an index's settings to make it cheaper to upload a
+        large number of documents.
+
+        :return: A dictionary of the original settings, to be passed
+            into finish_bulk_load() once the upload is done.
+        """
+        response = self.indices.get_settings(index=index)
+        current = response.get(index, {}).get('settings', {}).get('index', {})
+        original = dict(
+            refresh_interval=current.get('refresh_interval', '1s'),
+            number_of_replicas=current.get('number_of_replicas', 1),
+        )
+        self.indices.put_settings(
+            index=index, body=dict(index=self.BULK_LOAD_SETTINGS)
+        )
+        return original
+
+    def finish_bulk_load(self, index, original_settings):
+        """Restore an index's settings after a bulk load, and make
+        all of the uploaded documents visible to searches.
+        """
+        self.indices.put_settings(index=index, body=dict(index=original_settings))
+        self.indices.refresh(index=index)
+
+    def count_documents(self, index):
+        """How many search documents are in the given index?"""
+        return self.count(index=index, doc_type=self.work_document_type)['count']
+
     def base_index_name(self, index_or_alias):
         """Removes version or current suffix from base index name"""
 
@@ -312,9 +451,12 @@ class ExternalSearchIndex(object):
                     debug=False, return_raw_results=False):
         """Run a search query.
 
-        :param query_string: The string to search for.
+        :param query_string: The string to search for. If this is
+            None, every work that makes it through the filter is a
+            match.
         :param filter: A Filter object, used to filter out works that
-            would otherwise match the query string.
+            would otherwise match the query string. The filter may also
+            specify an order other than relevance.
         :param pagination: A Pagination object, used to get a subset
             of the search results.
         :param debug: If this is True, some debugging information will
@@ -329,9 +471,147 @@ class ExternalSearchIndex(object):
         if not self.works_alias:
             return []
 
+        if not pagination:
+            from lane import Pagination
+            pagination = Pagination.default()
+
+        cache_key = None
+        if not (debug or return_raw_results):
+            cache_key, cached = self._cached_results(
+                query_string, filter, pagination
+            )
+            if cached is not None:
+                return cached
+
+        search = self._works_search(
+            self.search, query_string, filter, pagination, debug,
+            return_raw_results
+        )
+
+        a = time.time()
+        # NOTE: This is the code that actually executes the ElasticSearch
+        # request.
+        results = search.execute()
+        if debug:
+            b = time.time()
+            self.log.info("Elasticsearch query completed in %.2fsec", b-a)
+            for i, result in enumerate(results):
+                self.log.debug(
+                    '%02d "%s" (%s) work=%s score=%.3f shard=%s',
+                    i, result.title, result.author, result.meta['id'],
+                    result.meta['score'], result.meta['shard']
+                )
+        work_ids = self._page_loaded(results, pagination, cache_key)
+        if return_raw_results:
+            return results
+        return work_ids
+
+    def query_works_multi(self, queries):
+        """Run several search queries in a single Elasticsearch request.
+
+        :param queries: A list of (query string, Filter, Pagination)
+            3-tuples. The Filter and Pagination may be None.
+        :return: A list containing a list of Work IDs for each item
+            in `queries`, in the same order.
+        """
+        if not self.works_alias:
+            return [[] for x in queries]
+
+        from lane import Pagination
+        results = [None] * len(queries)
+        uncached = []
+        multi = self.multi_search
+        for i, (query_string, filter, pagination) in enumerate(queries):
+            pagination = pagination or Pagination.default()
+            cache_key, cached = self._cached_results(
+                query_string, filter, pagination
+            )
+            if cached is not None:
+                results[i] = cached
+                continue
+            uncached.append((i, pagination, cache_key))
+            multi = multi.add(
+                self._works_search(
+                    self.search, query_string, filter, pagination
+                )
+            )
+
+        if not uncached:
+            # Every query was answered from the cache.
+            return results
+
+        a = time.time()
+        # NOTE: This is the code that actually executes the ElasticSearch
+        # request.
+        #
+        # A query that fails doesn't raise an exception, so the other
+        # queries' results aren't lost.
+        if MULTI_SEARCH_RAISE_ON_ERROR:
+            responses = multi.execute(raise_on_error=False)
+        else:
+            responses = multi.execute()
+        self.log.debug(
+            "Elasticsearch multi-search with %d queries completed in %.2fsec",
+            len(uncached), time.time()-a
+        )
+        for (i, pagination, cache_key), response in zip(uncached, responses):
+            error = self._multi_search_error(response)
+            if error is not None:
+                # One query failing doesn't affect the others.
+                self.log.error(
+                    "Query %r failed in Elasticsearch multi-search: %r",
+                    queries[i][0], error
+                )
+                results[i] = []
+                continue
+            results[i] = self._page_loaded(response, pagination, cache_key)
+        return results
+
+    @classmethod
+    def _multi_search_error(cls, response):
+        """Find the error, if any, in the response to one query in a
+        multi-search.
+
+        A response with no hits is not an error, even though it
+        evaluates as false.
+
+        :return: A description of the error, or None if the query
+            succeeded.
+        """
+        if response is None:
+            # This is how newer versions of elasticsearch-dsl report
+            # a failed query.
+            return "No response"
+        raw = getattr(response, '_d_', None)
+        if isinstance(raw, dict):
+            return raw.get('error')
+        return None
+
+    def _cached_results(self, query_string, filter, pagination):
+        """Look for the results of a search query in the result cache.
+
+        :return: A 2-tuple (cache key, list of Work IDs). The cache key
+            is None if results are not being cached; the list of Work
+            IDs is None if they're not in the cache.
+        """
+        if self.result_cache is None:
+            return None, None
+        self._check_result_cache_freshness()
+        cache_key = self._result_cache_key(query_string, filter, pagination)
+        cached = self.result_cache.get(cache_key)
+        if cached is None:
+            return cache_key, None
+        work_ids, last_item = cached
+        pagination.page_loaded(work_ids, last_item)
+        return cache_key, list(work_ids)
+
+    def _works_search(self, search, query_string, filter, pagination,
+                      debug=False, return_raw_results=False):
+        """Modify a Search object so that it runs a search query and
+        retrieves one page of results.
+        """
         query = Query(query_string, filter)
-        query_without_filter = Query(query_string)
-        search = self.search.query(query.build())
+        search = search.query(query.build())
         if debug:
             search = search.extra(explain=True)
 
@@ -354,127 +634,450 @@ class ExternalSearchIndex(object):
             else:
                 search = search.source(fields)
 
-        if not pagination:
-            from lane import Pagination
-            pagination = Pagination.default()
-        start = pagination.offset
-        stop = start + pagination.size
+        # If the filter specifies an order other than relevance,
+        # apply it.
+        if filter and filter.sort_order:
+            search = search.sort(*filter.sort_order)
 
-        a = time.time()
-        # NOTE: This is the code that actually executes the ElasticSearch
-        # request.
-        results = search[start:stop]
-        if debug:
-            b = time.time()
-            self.log.info("Elasticsearch query completed in %.2fsec", b-a)
-            for i, result in enumerate(results):
-                self.log.debug(
-                    '%02d "%s" (%s) work=%s score=%.3f shard=%s',
-                    i, result.title, result.author, result.meta['id'],
-                    result.meta['score'], result.meta['shard']
+        # Change the Search object so it only retrieves the requested
+        # page of results.
+        return pagination.modify_search_query(search)
+
+    def _page_loaded(self, results, pagination, cache_key=None):
+        """Process a page of search results.
+
+        :param results: A list of search results from Elasticsearch.
+        :param cache_key: If this is present, the Work IDs will be put
+            into the result cache under this key.
+        :return: A list of Work IDs.
+        """
+        work_ids = [int(result.meta['id']) for result in results]
+
+        # If the results were sorted explicitly, the sort key of the
+        # last result can be used to find the next page.
+        last_item = None
+        if results:
+            last_item = getattr(results[-1].meta, 'sort', None)
+            if last_item is not None:
+                last_item = tuple(last_item)
+        pagination.page_loaded(work_ids, last_item)
+
+        if cache_key is not None:
+            self.result_cache.set(cache_key, (tuple(work_ids), last_item))
+        return work_ids
+
+    @classmethod
+    def normalize_query_string(cls, query_string):
+        """Reduce a query string to a canonical form, so that trivially
+        different searches can share cached results.
+        """
+        if not query_string:
+            return query_string
+        return u" ".join(query_string.lower().split())
+
+    def _result_cache_key(self, query_string, filter, pagination):
+        """Build a key into the search result cache."""
+        built_filter = None
+        sort_order = None
+        if filter:
+            built_filter = filter.build()
+            # The sort order isn't part of the built filter, but the
+            # same works in a different order are different results.
+            sort_order = filter.sort_order
+        if built_filter:
+            built_filter = json.dumps(built_filter.to_dict(), sort_keys=True)
+        if sort_order:
+            sort_order = json.dumps(sort_order, sort_keys=True)
+        return (
+            self.works_alias, self.normalize_query_string(query_string),
+            built_filter, sort_order, tuple(pagination.items())
+        )
+
+    @classmethod
+    def _result_size(cls, value):
+        """Estimate the memory taken up by a cached page of search results.
+
+        :param value: A 2-tuple (work IDs, sort key of the last item).
+        """
+        size = sys.getsizeof(value)
+        for item in value:
+            if item is not None:
+                size += sys.getsizeof(item) + sum(
+                    sys.getsizeof(x) for x in item
                 )
-        if return_raw_results:
-            return results
-        return [int(result.meta['id']) for result in results]
+        return size
 
-    def bulk_update(self, works, retry_on_batch_failure=True):
-        """Upload a batch of works to the search index at once."""
+    def _check_result_cache_freshness(self):
+        """Clear the search result cache if the site configuration has
+        changed since the cache was filled.
+        """
+        last_update = Configuration._site_configuration_last_update()
+        if last_update != self._result_cache_configuration_time:
+            self.clear_result_cache()
+            self._result_cache_configuration_time = last_update
+
+    def clear_result_cache(self):
+        """Forget all cached search results."""
+        if self.result_cache is not None:
+            self.result_cache.clear()
+
+    def bulk_update(self, works, retry_on_batch_failure=True, force=False):
+        """Upload a batch of works to the search index at once.
+
+        Works are processed in chunks of BULK_CHUNK_SIZE. Search
+        documents for each chunk are generated on this thread (which
+        owns the database session) and then handed off to a worker
+        thread for upload, so the database and Elasticsearch can be
+        kept busy at the same time. Works that are not presentation
+        ready are removed from the index as part of the same bulk
+        requests.
+
+        A search document that's identical to the one most recently
+        uploaded to this index for the same work is not uploaded
+        again.
+
+        :param force: Upload every search document, even ones that
+            haven't changed. Use this if the search index may have
+            lost track of documents that were uploaded to it.
+
+        :return: A 2-tuple (successes, failures). `successes` is a
+            list of Works; `failures` is a list of (Work, error message)
+            2-tuples.
+        """
+        time1 = time.time()
+        works_by_id = dict((work.id, work) for work in works)
+        slots = None
+        if self.bulk_requests_in_flight > 0:
+            slots = BoundedSemaphore(self.bulk_requests_in_flight)
+
+        uploads = []
+        document_count = 0
+        unchanged_count = 0
+        generation_time = 0
+        chunk_size = self.BULK_CHUNK_SIZE
+        for start in range(0, len(works), chunk_size):
+            chunk = works[start:start+chunk_size]
+            a = time.time()
+            actions, missing_ids = self._bulk_actions(chunk)
+            document_count += len(
+                [x for x in actions if x.get('_op_type') != 'delete']
+            )
+            actions, unchanged_ids, hashes = self._skip_unchanged(
+                actions, works_by_id, force
+            )
+            unchanged_count += len(unchanged_ids)
+            generation_time += time.time() - a
+            upload = BulkUploadJob(
+                self, actions, missing_ids, retry_on_batch_failure,
+                unchanged_ids=unchanged_ids, hashes=hashes
+            )
+            uploads.append(upload)
+            self._start_bulk_upload(upload, slots)
 
+        for upload in uploads:
+            upload.done.wait()
+        time2 = time.time()
+
+        self.log.info(
+            "Created %i search documents in %.2f seconds; %i were unchanged",
+            document_count, generation_time, unchanged_count
+        )
+        self.log.info(
+            "Uploaded %i search documents in %.2f seconds; skipped %i",
+            document_count - unchanged_count, time2 - time1, unchanged_count
+        )
+
+        successes = []
+        failures = []
+        success_count = 0
+        for upload in uploads:
+            upload_successes, upload_failures = upload.results(works_by_id)
+            success_count += len(upload_successes)
+            successes.extend(upload_successes)
+            failures.extend(upload_failures)
+
+        self.log.info(
+            "Successfully indexed %i documents, failed to index %i.",
+            success_count, len(failures)
+        )
+        return successes, failures
+
+    def bulk_update_availability(self, works):
+        """Bring the availability information in these works' search
+        documents up to date, without regenerating the documents.
+
+        The Elasticsearch update API is used to change only the fields
+        that depend on circulation data. This is much cheaper than
+        bulk_update(), but it only works for documents that are
+        already in the index; any other work will show up as a
+        failure.
+
+        :return: A 2-tuple (successes, failures), as returned by
+            bulk_update().
+        """
         time1 = time.time()
+        works_by_id = dict((work.id, work) for work in works)
+        documents = Work.to_search_availability_documents(works)
+        actions = [
+            dict(_op_type='update', _index=self.works_index,
+                 _type=self.work_document_type, _id=work_id, doc=document)
+            for work_id, document in sorted(documents.items())
+        ]
+        upload = BulkUploadJob(self, actions, [])
+        upload.run()
+        successes, failures = upload.results(works_by_id)
+        for work in successes + [work for work, message in failures]:
+            # Either the document in the index has changed, or it's
+            # not there at all. In both cases, the next call to
+            # bulk_update() needs to upload the full document.
+            work.search_document_hash = None
+        self.log.info(
+            "Updated availability for %i search documents in %.2f seconds; %i failed",
+            len(successes), time.time() - time1, len(failures)
+        )
+        return successes, failures
+
+    def _bulk_actions(self, works):
+        """Generate the bulk API actions necessary to bring these
+        works' search documents up to date.
+
+        :return: A 2-tuple (actions, missing_ids). `missing_ids` are
+            the IDs of presentation-ready works for which no search
+            document could be generated.
+        """
         needs_add = []
-        successes = []
+        actions = []
         for work in works:
             if work.presentation_ready:
                 needs_add.append(work)
             else:
-                # Works are removed one at a time, which shouldn't
-                # pose a performance problem because works almost never
-                # stop being presentation ready.
-                self.remove_work(work)
-                successes.append(work)
-
-        # Add any works that need adding.
-        docs = Work.to_search_documents(needs_add)
+                actions.append(
+                    dict(_op_type='delete', _index=self.works_index,
+                         _type=self.work_document_type, _id=work.id)
+                )
 
+        docs = Work.to_search_documents(needs_add) or []
         for doc in docs:
             doc["_index"] = self.works_index
             doc["_type"] = self.work_document_type
-        time2 = time.time()
 
-        success_count, errors = self.bulk(
-            docs,
-            raise_on_error=False,
-            raise_on_exception=False,
-        )
+        # We weren't able to create search documents for these works,
+        # maybe because they don't have presentation editions yet.
+        doc_ids = set(doc['_id'] for doc in docs)
+        missing_ids = [
+            work.id for work in needs_add if work.id not in doc_ids
+        ]
+        return docs + actions, missing_ids
 
-        # If the entire update failed, try it one more time before
-        # giving up on the batch.
-        #
-        # Removed works were already removed, so no need to try them again.
-        if len(errors) == len(docs):
-            if retry_on_batch_failure:
-                self.log.info("Elasticsearch bulk update timed out, trying again.")
-                return self.bulk_update(needs_add, retry_on_batch_failure=False)
+    @classmethod
+    def search_document_hash(cls, index, document):
+        """Calculate a hash of a search document, which can be used to
+        tell whether the document has changed since it was last
+        uploaded to the given index.
+        """
+        data = json.dumps([index, document], sort_keys=True)
+        return unicode(hashlib.sha1(data).hexdigest())
+
+    def _skip_unchanged(self, actions, works_by_id, force=False):
+        """Remove bulk API actions that would upload a search document
+        identical to the one already in the index.
+
+        :param force: Keep every action, but calculate the hashes anyway.
+        :return: A 3-tuple (actions, unchanged_ids, hashes).
+            `unchanged_ids` are the IDs of works whose search documents
+            don't need to be uploaded. `hashes` maps the ID of every
+            other work to the hash of its new search document (or None
+            if the work is being removed from the index).
+        """
+        remaining = []
+        unchanged_ids = []
+        hashes = dict()
+        for action in actions:
+            work_id = action['_id']
+            if action.get('_op_type') == 'delete':
+                hashes[work_id] = None
+                remaining.append(action)
+                continue
+            document = dict(
+                (k, v) for k, v in action.items()
+                if k not in ('_index', '_type')
+            )
+            document_hash = self.search_document_hash(
+                action['_index'], document
+            )
+            work = works_by_id.get(work_id)
+            if (not force and work is not None
+                and work.search_document_hash == document_hash):
+                unchanged_ids.append(work_id)
             else:
-                docs = []
+                hashes[work_id] = document_hash
+                remaining.append(action)
+        return remaining, unchanged_ids, hashes
 
-        time3 = time.time()
-        self.log.info("Created %i search documents in %.2f seconds" % (len(docs), time2 - time1))
-        self.log.info("Uploaded %i search documents in  %.2f seconds" % (len(docs), time3 - time2))
+    def _start_bulk_upload(self, upload, slots):
+        """Send a set of bulk actions to Elasticsearch.
 
-        doc_ids = [d['_id'] for d in docs]
+        :param slots: A semaphore limiting the number of uploads that
+            can be running at once. If this is None, the upload happens
+            on this thread.
+        """
+        if not slots:
+            upload.run()
+            return
+        if not self._bulk_upload_pool:
+            self._bulk_upload_pool = Pool(self.bulk_requests_in_flight)
+        # Block until one of the in-flight uploads is finished.
+        slots.acquire()
+        upload.slots = slots
+        self._bulk_upload_pool.put(upload)
 
-        # We weren't able to create search documents for these works, maybe
-        # because they don't have presentation editions yet.
-        def get_error_id(error):
-            return error.get('data', {}).get('_id', None) or error.get('index', {}).get('_id', None)
-        error_ids = [get_error_id(error) for error in errors]
+    @classmethod
+    def _bulk_error_details(cls, error):
+        """Make sense of an error reported by the bulk helper.
 
-        missing_works = [
-            work for work in works
-            if work.id not in doc_ids and work.id not in error_ids
-            and work not in successes
-        ]
+        :return: A 4-tuple (operation type, work ID, HTTP status,
+            error message). Any of these may be None.
+        """
+        op_type = None
+        details = error
+        for key in cls.BULK_OPERATION_TYPES:
+            if key in error:
+                op_type = key
+                details = error[key]
+                break
+        data = details.get('data') or error.get('data') or {}
+        work_id = details.get('_id', data.get('_id'))
+        try:
+            # Elasticsearch reports document IDs as strings.
+            work_id = int(work_id)
+        except (TypeError, ValueError):
+            pass
+        message = details.get('error') or error.get('error')
+        return op_type, work_id, details.get('status'), message
 
-        successes.extend(
-            [work for work in works
-             if work.id in doc_ids and work.id not in error_ids]
-        )
+    def remove_work(self, work):
+        """Remove the search document for `work` from the search index.
+        """
+        args = dict(index=self.works_index, doc_type=self.work_document_type,
+                    id=work.id)
+        if self.exists(**args):
+            self.delete(**args)
 
-        failures = []
-        for missing in missing_works:
-            failures.append((work, "Work not indexed"))
+class BulkUploadJob(Job):
+    """Send one set of bulk actions to Elasticsearch, possibly in a
+    worker thread.
+
+    This never touches the database; the bulk actions are generated
+    ahead of time and the results are matched back up with Works on
+    the thread that owns the database session.
+    """
 
-        for error in errors:
+    def __init__(self, search_index, actions, missing_ids,
+                 retry_on_batch_failure=True, unchanged_ids=None,
+                 hashes=None):
+        """Constructor.
 
-            error_id = get_error_id(error)
-            work = None
-            works_with_error = [work for work in works if work.id == error_id]
-            if works_with_error:
-                work = works_with_error[0]
+        :param unchanged_ids: IDs of works whose search documents
+            didn't need to be uploaded, because they haven't changed.
+        :param hashes: A dictionary mapping work IDs to the hashes of
+            their new search documents.
+        """
+        self.search_index = search_index
+        self.actions = actions
+        self.missing_ids = missing_ids
+        self.unchanged_ids = unchanged_ids or []
+        self.hashes = hashes or dict()
+        self.retry_on_batch_failure = retry_on_batch_failure
+        self.slots = None
+        self.errors = []
+        self.done = Event()
+
+    def do_run(self):
+        if not self.actions:
+            return
+        bulk = self.search_index.bulk
+        success_count, self.errors = bulk(
+            self.actions, raise_on_error=False, raise_on_exception=False,
+        )
 
-            exception = error.get('exception', None)
-            error_message = error.get('error', None)
-            if not error_message:
-                error_message = error.get('index', {}).get('error', None)
+        # If the entire update failed, try it one more time before
+        # giving up on the batch.
+        if (self.retry_on_batch_failure
+            and len(self.errors) == len(self.actions)):
+            self.search_index.log.info(
+                "Elasticsearch bulk update timed out, trying again."
+            )
+            success_count, self.errors = bulk(
+                self.actions, raise_on_error=False,
+                raise_on_exception=False,
+            )
 
-            failures.append((work, error_message))
+    def rollback(self):
+        # Something went wrong outside of the bulk helper. Treat every
+        # action in this request as having failed.
+        self.errors = [
+            dict(data=action, error="Bulk upload failed")
+            for action in self.actions
+        ]
 
-        self.log.info("Successfully indexed %i documents, failed to index %i." % (success_count, len(failures)))
+    def run(self):
+        try:
+            super(BulkUploadJob, self).run()
+        except Exception, e:
+            self.search_index.log.error(
+                "Bulk upload raised error: %r", e, exc_info=e
+            )
+        finally:
+            if self.slots:
+                self.slots.release()
+            self.done.set()
+
+    def results(self, works_by_id):
+        """Match up the outcome of this upload with the Works that were
+        uploaded.
+
+        :param works_by_id: A dictionary mapping work IDs to Works.
+        :return: A 2-tuple (successes, failures), as returned by
+            ExternalSearchIndex.bulk_update.
+        """
+        error_messages = dict()
+        for error in self.errors:
+            op_type, work_id, status, message = (
+                self.search_index._bulk_error_details(error)
+            )
+            if op_type == 'delete' and status == 404:
+                # We tried to remove a document that wasn't in the
+                # index to begin with. The index is still accurate.
+                continue
+            error_messages[work_id] = message
 
+        successes = []
+        failures = []
+        for missing_id in self.missing_ids:
+            failures.append((works_by_id.get(missing_id), "Work not indexed"))
+        for unchanged_id in self.unchanged_ids:
+            successes.append(works_by_id.get(unchanged_id))
+        for action in self.actions:
+            work = works_by_id.get(action['_id'])
+            if action['_id'] in error_messages:
+                failures.append((work, error_messages.pop(action['_id'])))
+            else:
+                successes.append(work)
+                if work is not None and action['_id'] in self.hashes:
+                    # Remember what was uploaded, so it's not uploaded
+                    # again unless it changes.
+                    work.search_document_hash = self.hashes[action['_id']]
+
+        # Any leftover errors couldn't be traced back to a document
+        # we sent.
+        for work_id, message in error_messages.items():
+            failures.append((works_by_id.get(work_id), message))
         return successes, failures
 
-    def remove_work(self, work):
-        """Remove the search document for `work` from the search index.
-        """
-        args = dict(index=self.works_index, doc_type=self.work_document_type,
-                    id=work.id)
-        if self.exists(**args):
-            self.delete(**args)
 
 class ExternalSearchIndexVersions(object):
 
-    VERSIONS = ['v2', 'v3']
+    VERSIONS = ['v2', 'v3', 'v4']
 
     @classmethod
     def latest(cls):
@@ -495,6 +1098,23 @@ class ExternalSearchIndexVersions(object):
             mapping["properties"][field] = field_description
         return mapping
 
+    @classmethod
+    def v4_body(cls):
+        """The v4 body is the same as the v3 body except that the
+        fields used to sort lists of works are stored as-is, rather
+        than being analyzed, so that works can be sorted by title and
+        author.
+        """
+        body = cls.v3_body()
+        if MAJOR_VERSION == 1:
+            sortable = {"type": "string", "index": "not_analyzed"}
+        else:
+            sortable = {"type": "keyword"}
+        mapping = body['mappings'][ExternalSearchIndex.work_document_type]
+        for field in Filter.SORTABLE_STRING_FIELDS:
+            mapping['properties'][field] = sortable
+        return body
+
     @classmethod
     def v3_body(cls):
         """The v3 body is the same as the v2 except for the inclusion of the
@@ -722,6 +1342,11 @@ class Query(SearchBase):
         r'\b(%s)\b' % "|".join(FUZZY_CONFOUNDERS), re.I
     )
 
+    # The part of a query that depends only on the query string is
+    # expensive to build, and the same query strings come up over and
+    # over again, so we keep the most popular ones around.
+    TEMPLATE_CACHE = LRUCache(max_entries=5000)
+
     def __init__(self, query_string, filter=None):
         """Store a query string and filter.
 
@@ -735,7 +1360,7 @@ class Query(SearchBase):
 
     def build(self):
         """Make an Elasticsearch-DSL query object out of this query."""
-        query = self.query()
+        query = self.template()
 
         # Add the filter, if there is one.
         if self.filter:
@@ -749,10 +1374,28 @@ class Query(SearchBase):
         # There you go!
         return query
 
+    def template(self):
+        """Find or build the Elasticsearch Query object for this query
+        string, without any filter applied.
+
+        The result is shared between every search for the same query
+        string, so it must not be modified.
+        """
+        key = (self.__class__, self.query_string)
+        template = self.TEMPLATE_CACHE.get(key)
+        if template is None:
+            template = self.query()
+            self.TEMPLATE_CACHE.set(key, template)
+        return template
+
     def query(self):
         """Build an Elasticsearch Query object for this query string.
         """
         query_string = self.query_string
+        if query_string is None:
+            # We're not searching for anything in particular; every
+            # work that makes it through the filter is a match.
+            return Q("match_all")
 
         # The search query will create a dis_max query, which tests a
         # number of hypotheses about what the query string might
@@ -1140,6 +1783,14 @@ class Filter(SearchBase):
     wrong language, not available in the patron's library, etc.
     """
 
+    # These fields are stored in the search index without being
+    # analyzed, so that works can be sorted by them.
+    SORTABLE_STRING_FIELDS = ["sort_title", "sort_author"]
+
+    # When works are sorted by some field, ties are broken using these
+    # fields, in this order.
+    DEFAULT_SORT_ORDER = ["sort_author", "sort_title", "work_id"]
+
     @classmethod
     def from_worklist(cls, _db, worklist, facets):
         """Create a Filter that finds only works that belong in the given
@@ -1213,6 +1864,16 @@ class Filter(SearchBase):
         else:
             self.customlist_restriction_sets = []
 
+        # These restrictions are only ever set by a Facets object.
+        self.availability = None
+        self.subcollection = None
+        self.minimum_featured_quality = None
+
+        # By default, matching works are ordered by relevance. A Facets
+        # object may name a field to sort by instead.
+        self.order = None
+        self.order_ascending = True
+
         # Give the Facets object a chance to modify any or all of this
         # information.
         if facets:
@@ -1266,9 +1927,71 @@ class Filter(SearchBase):
             ids = filter_ids(customlist_ids)
             f = chain(f, F('terms', **{'customlists.list_id' : ids}))
 
+        if self.availability == FacetConstants.AVAILABLE_NOW:
+            f = chain(f, self._collection_filter(
+                'available_collections', collection_ids
+            ))
+        elif self.availability == FacetConstants.AVAILABLE_OPEN_ACCESS:
+            f = chain(f, self._collection_filter(
+                'open_access_collections', collection_ids
+            ))
+
+        if self.subcollection == FacetConstants.COLLECTION_MAIN:
+            # Exclude open-access books with a quality of less than
+            # 0.3.
+            low_quality_open_access = F(
+                'bool', must=[
+                    self._collection_filter(
+                        'open_access_collections', collection_ids
+                    ),
+                    F('range', quality=dict(lt=0.3))
+                ]
+            )
+            f = chain(f, F('bool', must_not=[low_quality_open_access]))
+        elif (self.subcollection == FacetConstants.COLLECTION_FEATURED
+              and self.minimum_featured_quality is not None):
+            f = chain(f, F(
+                'range', quality=dict(gte=self.minimum_featured_quality)
+            ))
 
         return f
 
+    @classmethod
+    def _collection_filter(cls, field, collection_ids):
+        """A filter that matches works that show up in one of the
+        given collections under the given search document field.
+
+        :param collection_ids: If this is empty, a work will match as
+            long as it shows up under `field` for any collection.
+        """
+        field = field + '.collection_id'
+        if not collection_ids:
+            return F('exists', field=field)
+        return F('terms', **{field : collection_ids})
+
+    @property
+    def sort_order(self):
+        """Turn `order` and `order_ascending` into an Elasticsearch sort
+        order.
+
+        :return: A list of sort clauses, or None if matching works
+            should be sorted by relevance.
+        """
+        if not self.order:
+            return None
+        if self.order_ascending:
+            direction = 'asc'
+        else:
+            direction = 'desc'
+
+        # order_ascending applies only to the first field in the sort
+        # order. Everything else is ordered ascending.
+        order = [{self.order : direction}]
+        for field in self.DEFAULT_SORT_ORDER:
+            if field != self.order:
+                order.append({field : 'asc'})
+        return order
+
     @property
     def target_age_filter(self):
         """Helper method to generate the target age subfilter.
@@ -1392,6 +2115,12 @@ class MockExternalSearchIndex(ExternalSearchIndex):
         self.works_alias = "works-current"
         self.log = logging.getLogger("Mock external search index")
         self.queries = []
+        self.bulk_requests_in_flight = self.DEFAULT_BULK_REQUESTS_IN_FLIGHT
+        self._bulk_upload_pool = None
+        self.alias_index = self.works_index
+        self.bulk_loading = {}
+        self.result_cache = None
+        self._result_cache_configuration_time = None
 
     def _key(self, index, doc_type, id):
         return (index, doc_type, id)
@@ -1407,6 +2136,23 @@ class MockExternalSearchIndex(ExternalSearchIndex):
     def exists(self, index, doc_type, id):
         return self._key(index, doc_type, id) in self.docs
 
+    def alias_points_to(self, _db, index):
+        return index == self.alias_index
+
+    def transfer_current_alias(self, _db, new_index):
+        self.works_index = self.alias_index = new_index
+
+    def start_bulk_load(self, index):
+        original = dict(refresh_interval='1s', number_of_replicas=1)
+        self.bulk_loading[index] = original
+        return original
+
+    def finish_bulk_load(self, index, original_settings):
+        del self.bulk_loading[index]
+
+    def count_documents(self, index):
+        return len([key for key in self.docs if key[0] == index])
+
     def query_works(self, query_string, filter, pagination, debug=False):
         self.queries.append((query_string, filter, pagination, debug))
         doc_ids = sorted([dict(_id=key[2]) for key in self.docs.keys()])
@@ -1414,12 +2160,41 @@ class MockExternalSearchIndex(ExternalSearchIndex):
             start = pagination.offset
             stop = start + pagination.size
             doc_ids = doc_ids[start:stop]
-        return [x['_id'] for x in doc_ids]
+        work_ids = [x['_id'] for x in doc_ids]
+        if pagination:
+            pagination.page_loaded(work_ids)
+        return work_ids
+
+    def query_works_multi(self, queries):
+        return [
+            self.query_works(query_string, filter, pagination)
+            for (query_string, filter, pagination) in queries
+        ]
 
     def bulk(self, docs, **kwargs):
+        errors = []
         for doc in docs:
-            self.index(doc['_index'], doc['_type'], doc['_id'], doc)
-        return len(docs), []
+            args = (doc['_index'], doc['_type'], doc['_id'])
+            if doc.get('_op_type') == 'update':
+                if self.exists(*args):
+                    self.docs[self._key(*args)].update(doc['doc'])
+                else:
+                    errors.append(
+                        dict(update=dict(_id=str(doc['_id']), status=404,
+                                         error="document_missing_exception"))
+                    )
+            elif doc.get('_op_type') == 'delete':
+                if self.exists(*args):
+                    self.delete(*args)
+                else:
+                    # This is how Elasticsearch reports the deletion
+                    # of a document that isn't there.
+                    errors.append(
+                        dict(delete=dict(_id=str(doc['_id']), status=404))
+                    )
+            else:
+                self.index(*args, body=doc)
+        return len(docs) - len(errors), errors
 
 
 class SearchIndexMonitor(WorkSweepMonitor):
@@ -1432,8 +2207,19 @@ class SearchIndexMonitor(WorkSweepMonitor):
     DEFAULT_BATCH_SIZE = 500
 
     def __init__(self, _db, collection, index_name=None, index_client=None,
-                 **kwargs):
+                 id_range=None, force=False, **kwargs):
+        """Constructor.
+
+        :param id_range: If this is a 2-tuple (lower, upper), only
+            Works whose IDs fall in that range (inclusive) will be
+            indexed. Each range gets its own Timestamp, so several
+            Monitors can sweep different parts of the works table at
+            once.
+        :param force: Upload every search document, even the ones
+            that haven't changed since they were last uploaded.
+        """
         super(SearchIndexMonitor, self).__init__(_db, collection, **kwargs)
+        self.force = force
 
         if index_client:
             # This would only happen during a test.
@@ -1442,17 +2228,41 @@ class SearchIndexMonitor(WorkSweepMonitor):
             self.search_index_client = ExternalSearchIndex(
                 _db, works_index=index_name
             )
+            if index_name:
+                # Upload documents to the requested index, even if
+                # it's not the one the -current alias points to.
+                self.search_index_client.works_index = index_name
 
         index_name = self.search_index_client.works_index
         # We got a generic service name. Replace it with a more
         # specific one.
-        self.service_name = "Search index update (%s)" % index_name
+        self.id_range = id_range
+        if id_range:
+            self.service_name = "Search index update (%s, works %d-%d)" % (
+                (index_name,) + tuple(id_range)
+            )
+        else:
+            self.service_name = "Search index update (%s)" % index_name
+        self.completed = False
+
+    def item_query(self):
+        qu = super(SearchIndexMonitor, self).item_query()
+        if self.id_range:
+            lower, upper = self.id_range
+            qu = qu.filter(Work.id >= lower).filter(Work.id <= upper)
+        return qu
+
+    def cleanup(self):
+        # We made it all the way through the sweep.
+        self.completed = True
 
     def process_batch(self, offset):
         """Update the search index for a set of Works."""
         batch = self.fetch_batch(offset).all()
         if batch:
-            successes, failures = self.search_index_client.bulk_update(batch)
+            successes, failures = self.search_index_client.bulk_update(
+                batch, force=self.force
+            )
 
             for work, message in failures:
                 self.log.error(
@@ -1468,6 +2278,146 @@ class SearchIndexMonitor(WorkSweepMonitor):
             return 0
 
 
+class SearchIndexChangeMonitor(Monitor):
+    """Keep the search index up to date by reindexing only the Works
+    whose search documents have changed.
+
+    Every time a Work is marked as needing to be reindexed, a
+    SearchIndexChange is recorded. This Monitor reindexes the affected
+    Works in batches and deletes the changes it has handled, so the
+    cost of a run is proportional to the number of changes rather
+    than to the size of the collection.
+
+    The Monitor's Timestamp.counter is a high-water mark: the ID of
+    the most recent SearchIndexChange that has been handled. Changes
+    are deleted once they're handled, rather than being skipped
+    because their IDs are below the high-water mark, because a
+    transaction may commit a change with a low ID after a change with
+    a higher ID has already been handled.
+    """
+    SERVICE_NAME = "Search index change feed"
+    DEFAULT_BATCH_SIZE = 500
+    DEFAULT_COUNTER = 0
+
+    def __init__(self, _db, index_client=None, batch_size=None):
+        super(SearchIndexChangeMonitor, self).__init__(_db)
+        if not batch_size or batch_size < 0:
+            batch_size = self.DEFAULT_BATCH_SIZE
+        self.batch_size = batch_size
+        self.search_index_client = index_client or ExternalSearchIndex(_db)
+
+    def run(self):
+        timestamp = self.timestamp()
+        while True:
+            start_time = time.time()
+            try:
+                high_water_mark = self.process_batch()
+            except Exception, e:
+                self.log.error("Error during run: %s", e, exc_info=e)
+                break
+
+            if high_water_mark is None:
+                # There are no more changes to handle.
+                break
+
+            # We completed one batch of work. Update the Timestamp
+            # to record our progress.
+            timestamp.counter = max(timestamp.counter or 0, high_water_mark)
+            timestamp.timestamp = datetime.datetime.utcnow()
+            self._db.commit()
+            self.log.debug(
+                "%s monitor handled changes up to %s in %.2f sec",
+                self.service_name, high_water_mark, time.time()-start_time
+            )
+
+    def fetch_batch(self):
+        """Find the oldest SearchIndexChanges that haven't been handled.
+
+        :return: A list of (SearchIndexChange.id, Work.id,
+            SearchIndexChange.availability_only) 3-tuples.
+        """
+        return self._db.query(
+            SearchIndexChange.id, SearchIndexChange.work_id,
+            SearchIndexChange.availability_only
+        ).order_by(SearchIndexChange.id).limit(self.batch_size).all()
+
+    def process_batch(self):
+        """Reindex the Works affected by one batch of changes.
+
+        If the only thing that changed about a Work is its
+        availability, and the Work is already in the search index,
+        only the availability information in its search document is
+        updated. Otherwise its search document is rebuilt from scratch.
+
+        A Work that fails to be reindexed keeps its registered
+        WorkCoverageRecord, so SearchIndexCoverageProvider will try
+        again later.
+
+        :return: The ID of the last SearchIndexChange handled, or None
+            if there were no changes to handle.
+        """
+        changes = self.fetch_batch()
+        if not changes:
+            return None
+        change_ids = [change[0] for change in changes]
+        full_ids = set()
+        availability_ids = set()
+        for change_id, work_id, availability_only in changes:
+            if availability_only:
+                availability_ids.add(work_id)
+            else:
+                full_ids.add(work_id)
+        # Any work that needs a full reindex will get its availability
+        # information updated as part of the full reindex.
+        availability_ids -= full_ids
+
+        works = self._db.query(Work).filter(
+            Work.id.in_(full_ids | availability_ids)
+        ).all()
+        needs_full = [w for w in works if w.id in full_ids]
+        needs_availability = []
+        for work in works:
+            if work.id not in availability_ids:
+                continue
+            if work.presentation_ready:
+                needs_availability.append(work)
+            else:
+                # The work should be removed from the index, which
+                # is handled by a full reindex.
+                needs_full.append(work)
+
+        successes = []
+        if needs_availability:
+            partial_successes, failures = (
+                self.search_index_client.bulk_update_availability(
+                    needs_availability
+                )
+            )
+            successes.extend(partial_successes)
+            # A work that couldn't be partially updated -- probably
+            # because it's not in the index yet -- gets a full
+            # reindex instead.
+            needs_full.extend([work for work, message in failures])
+
+        if needs_full:
+            full_successes, failures = self.search_index_client.bulk_update(
+                needs_full
+            )
+            successes.extend(full_successes)
+            for work, message in failures:
+                self.log.error(
+                    "Failed to update search index for %s: %s", work, message
+                )
+        WorkCoverageRecord.bulk_add(
+            successes, WorkCoverageRecord.UPDATE_SEARCH_INDEX_OPERATION
+        )
+
+        self._db.query(SearchIndexChange).filter(
+            SearchIndexChange.id.in_(change_ids)
+        ).delete(synchronize_session=False)
+        return change_ids[-1]
+
+
 class SearchIndexCoverageProvider(WorkPresentationProvider):
     """Make sure all Works have up-to-date representation in the
     search index.
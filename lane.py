@@ -1,6 +1,10 @@
 from collections import defaultdict
 from nose.tools import set_trace
+import base64
 import datetime
+from decimal import Decimal
+import hashlib
+import json
 import logging
 import random
 import time
@@ -25,8 +29,12 @@ from classifier import (
 from sqlalchemy import (
     and_,
     case,
+    distinct,
+    func,
     or_,
     not_,
+    union,
+    union_all,
     Integer,
     Table,
     Unicode,
@@ -46,7 +54,11 @@ from sqlalchemy.orm import (
     lazyload,
     relationship,
 )
-from sqlalchemy.sql.expression import literal
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.expression import (
+    false,
+    literal,
+)
 
 from entrypoint import (
     EntryPoint,
@@ -54,6 +66,7 @@ from entrypoint import (
 )
 from external_search import (
     Filter,
+    MAJOR_VERSION,
     Query,
 )
 from model import (
@@ -81,10 +94,11 @@ from model import (
     WorkGenre,
 )
 from model.constants import EditionConstants
+from monitor import Monitor
 from facets import FacetConstants
 from problem_details import *
 from util import (
-    fast_query_count,
+    count_estimate,
     LanguageCodes,
 )
 from util.problem_detail import ProblemDetail
@@ -95,6 +109,7 @@ from sqlalchemy import (
     event,
     Boolean,
     Column,
+    DateTime,
     ForeignKey,
     Integer,
     UniqueConstraint,
@@ -492,51 +507,99 @@ class Facets(FacetsWithEntryPoint):
         }
         return order_facet_to_database_field[order_facet]
 
+    @classmethod
+    def order_facet_to_search_field(cls, order_facet):
+        """Turn the name of an order facet into a search index field
+        for use in sorting a list of works.
+
+        :return: The name of a field, or None if the search index
+            doesn't know how to sort works in this order.
+        """
+        order_facet_to_search_field = {
+            cls.ORDER_WORK_ID : "work_id",
+            cls.ORDER_TITLE : "sort_title",
+            cls.ORDER_AUTHOR : "sort_author",
+            cls.ORDER_LAST_UPDATE : "last_update_time",
+            cls.ORDER_SERIES_POSITION : "series_position",
+            cls.ORDER_RANDOM : "random",
+        }
+        return order_facet_to_search_field.get(order_facet)
+
+    def modify_search_filter(self, filter):
+        """Modify the given external_search.Filter object
+        so that it reflects this set of facets.
+        """
+        super(Facets, self).modify_search_filter(filter)
+        filter.availability = self.availability
+        filter.subcollection = self.collection
+        if self.collection == self.COLLECTION_FEATURED:
+            filter.minimum_featured_quality = (
+                self.library.minimum_featured_quality
+            )
+        filter.order = self.order_facet_to_search_field(self.order)
+        filter.order_ascending = self.order_ascending
+        return filter
+
     def apply(self, _db, qu):
         """Restrict a query against MaterializedWorkWithGenre so that it only
         matches works that fit the given facets, and the query is
         ordered appropriately.
         """
         qu = super(Facets, self).apply(_db, qu)
-        if self.availability == self.AVAILABLE_NOW:
-            availability_clause = or_(
+        availability_clause = self.availability_clause(self.availability)
+        if availability_clause is not None:
+            qu = qu.filter(availability_clause)
+
+        collection_clause = self.collection_clause(self.collection)
+        if collection_clause is not None:
+            qu = qu.filter(collection_clause)
+
+        # Set the ORDER BY clause.
+        order_by, order_distinct = self.order_by()
+        qu = qu.order_by(*order_by)
+
+        # We always mark the query as distinct because the materialized
+        # view can contain the same title many times.
+        qu = qu.distinct(*order_distinct)
+
+        return qu
+
+    @classmethod
+    def availability_clause(cls, availability):
+        """Create a filter clause that restricts a query against
+        MaterializedWorkWithGenre to works with the given availability.
+        """
+        if availability == cls.AVAILABLE_NOW:
+            return or_(
                 LicensePool.open_access==True,
                 LicensePool.licenses_available > 0)
-        elif self.availability == self.AVAILABLE_ALL:
-            availability_clause = or_(
+        elif availability == cls.AVAILABLE_ALL:
+            return or_(
                 LicensePool.open_access==True,
                 LicensePool.licenses_owned > 0)
-        elif self.availability == self.AVAILABLE_OPEN_ACCESS:
-            availability_clause = LicensePool.open_access==True
-        qu = qu.filter(availability_clause)
+        elif availability == cls.AVAILABLE_OPEN_ACCESS:
+            return LicensePool.open_access==True
 
-        if self.collection == self.COLLECTION_FULL:
+    def collection_clause(self, collection):
+        """Create a filter clause that restricts a query against
+        MaterializedWorkWithGenre to works in the given subcollection.
+
+        :return: A clause, or None if no restriction is necessary.
+        """
+        if collection == self.COLLECTION_FULL:
             # Include everything.
-            pass
-        elif self.collection == self.COLLECTION_MAIN:
+            return None
+        elif collection == self.COLLECTION_MAIN:
             # Exclude open-access books with a quality of less than
             # 0.3.
-            or_clause = or_(
+            return or_(
                 LicensePool.open_access==False,
                 work_model.quality >= 0.3
             )
-            qu = qu.filter(or_clause)
-        elif self.collection == self.COLLECTION_FEATURED:
+        elif collection == self.COLLECTION_FEATURED:
             # Exclude books with a quality of less than the library's
             # minimum featured quality.
-            qu = qu.filter(
-                work_model.quality >= self.library.minimum_featured_quality
-            )
-
-        # Set the ORDER BY clause.
-        order_by, order_distinct = self.order_by()
-        qu = qu.order_by(*order_by)
-
-        # We always mark the query as distinct because the materialized
-        # view can contain the same title many times.
-        qu = qu.distinct(*order_distinct)
-
-        return qu
+            return work_model.quality >= self.library.minimum_featured_quality
 
     def order_by(self):
         """Given these Facets, create a complete ORDER BY clause for queries
@@ -797,6 +860,52 @@ class Pagination(object):
     def default(cls):
         return Pagination(0, cls.DEFAULT_SIZE)
 
+    # No one may request more than this many entries on a single page.
+    MAX_SIZE = 100
+
+    @classmethod
+    def from_request(cls, get_arg, default_size=None):
+        """Instantiate a Pagination object from an HTTP request.
+
+        :param get_arg: A callable that takes two arguments and
+            retrieves (or pretends to retrieve) a query string parameter
+            of that name from an incoming HTTP request, or the default
+            if the parameter is not present.
+        :param default_size: The page size to use if the request
+            does not specify one.
+        :return: A Pagination object, or a ProblemDetail if there's a
+            problem with the input from the request.
+        """
+        size = cls.size_from_request(get_arg, default_size)
+        if isinstance(size, ProblemDetail):
+            return size
+        offset = get_arg('after', 0)
+        if offset:
+            try:
+                offset = int(offset)
+            except ValueError:
+                return INVALID_INPUT.detailed(
+                    _("Invalid offset: %(offset)s", offset=offset)
+                )
+        return cls(offset, size)
+
+    @classmethod
+    def size_from_request(cls, get_arg, default_size=None):
+        """Find the page size requested by an HTTP request.
+
+        :return: An integer no larger than MAX_SIZE, or a ProblemDetail.
+        """
+        if default_size is None:
+            default_size = cls.DEFAULT_SIZE
+        size = get_arg('size', default_size)
+        try:
+            size = int(size)
+        except ValueError:
+            return INVALID_INPUT.detailed(
+                _("Invalid page size: %(size)s", size=size)
+            )
+        return min(size, cls.MAX_SIZE)
+
     def __init__(self, offset=0, size=DEFAULT_SIZE):
         """Constructor.
 
@@ -859,6 +968,322 @@ class Pagination(object):
         """Modify the given query with OFFSET and LIMIT."""
         return qu.offset(self.offset).limit(self.size)
 
+    def modify_search_query(self, search):
+        """Modify an Elasticsearch Search object so that it retrieves
+        only this page of results.
+        """
+        return search[self.offset:self.offset+self.size]
+
+    def page_loaded(self, work_ids, last_item=None):
+        """Take note of the search results that were found for this page.
+
+        :param work_ids: The IDs of the works on this page.
+        :param last_item: The sort key of the last item on this page,
+            if the search engine provided one.
+        """
+        self.this_page_size = len(work_ids)
+
+
+class SortKeyPagination(Pagination):
+    """Pagination for search results that picks up where the previous
+    page left off, rather than skipping over some number of results.
+
+    Elasticsearch has to find and then discard every result on the
+    pages before the one that was requested, so deep pages of search
+    results get slower and slower and eventually go past the limit on
+    the size of the result window. Instead, this class uses the sort
+    key of the last item on the previous page as a cursor, and asks
+    Elasticsearch for the results that come after it (`search_after`).
+
+    The cursor is passed around as an opaque string (the `key`
+    argument) rather than as an offset. Versions of Elasticsearch that
+    don't support `search_after` fall back to the offset, which is
+    also kept in the cursor.
+    """
+
+    # Sort by relevance, breaking ties by work ID so that every result
+    # has a distinct sort key. The work ID is stored in each document
+    # as an ordinary field, which is much cheaper to sort on than _id.
+    SORT_ORDER = ["_score", "work_id"]
+
+    # Elasticsearch added search_after in version 5.
+    SEARCH_AFTER_SUPPORTED = MAJOR_VERSION >= 5
+
+    def __init__(self, last_item_on_previous_page=None,
+                 size=Pagination.DEFAULT_SIZE, offset=0):
+        """Constructor.
+
+        :param last_item_on_previous_page: The sort key of the last
+            item on the previous page of results, as returned by
+            Elasticsearch.
+        :param size: Pull no more than this number of entries.
+        :param offset: The position of this page in the full list of
+            results.
+        """
+        super(SortKeyPagination, self).__init__(offset, size)
+        self.last_item_on_previous_page = last_item_on_previous_page
+        self.last_item_on_this_page = None
+
+    @classmethod
+    def from_request(cls, get_arg, default_size=None):
+        """Instantiate a SortKeyPagination object from an HTTP request.
+
+        :return: A SortKeyPagination object, or a ProblemDetail if
+            there's a problem with the input from the request.
+        """
+        key = get_arg('key', None)
+        if not key:
+            # This is either the first page, or a page linked to by
+            # offset before search results were paged by sort key.
+            pagination = Pagination.from_request(get_arg, default_size)
+            if isinstance(pagination, ProblemDetail):
+                return pagination
+            return cls(size=pagination.size, offset=pagination.offset)
+        size = cls.size_from_request(get_arg, default_size)
+        if isinstance(size, ProblemDetail):
+            return size
+        try:
+            return cls.from_pagination_key(key, size)
+        except ValueError:
+            return INVALID_INPUT.detailed(
+                _("Invalid page key: %(key)s", key=key)
+            )
+
+    @classmethod
+    def for_search(cls):
+        """Find the Pagination class to use for search results.
+
+        :return: SortKeyPagination if Elasticsearch can pick up where
+            the previous page left off; otherwise Pagination.
+        """
+        if cls.SEARCH_AFTER_SUPPORTED:
+            return cls
+        return Pagination
+
+    @classmethod
+    def from_pagination_key(cls, key, size=Pagination.DEFAULT_SIZE):
+        """Turn a value generated by `pagination_key` back into a
+        SortKeyPagination object.
+
+        :raise ValueError: If the key is not one we generated.
+        """
+        try:
+            offset, last_item = json.loads(
+                base64.urlsafe_b64decode(str(key))
+            )
+        except (TypeError, ValueError):
+            raise ValueError("Invalid pagination key: %s" % key)
+        if (not isinstance(offset, int) or offset < 0
+            or not isinstance(last_item, (list, type(None)))):
+            raise ValueError("Invalid pagination key: %s" % key)
+        return cls(last_item, size, offset)
+
+    @property
+    def pagination_key(self):
+        """An opaque string that can be turned back into this
+        SortKeyPagination object with `from_pagination_key`.
+
+        :return: A string, or None if this is the first page.
+        """
+        if not self.offset and self.last_item_on_previous_page is None:
+            return None
+        value = json.dumps([self.offset, self.last_item_on_previous_page])
+        return base64.urlsafe_b64encode(value)
+
+    def items(self):
+        key = self.pagination_key
+        if key:
+            yield("key", key)
+        yield("size", self.size)
+
+    @property
+    def first_page(self):
+        return self.__class__(size=self.size)
+
+    @property
+    def next_page(self):
+        return self.__class__(
+            self.last_item_on_this_page, self.size, self.offset+self.size
+        )
+
+    @property
+    def previous_page(self):
+        # There's no way to search backwards from a sort key, so the
+        # previous page is located by its offset.
+        if self.offset <= 0:
+            return None
+        previous_offset = max(0, self.offset - self.size)
+        return self.__class__(size=self.size, offset=previous_offset)
+
+    def modify_search_query(self, search):
+        """Modify an Elasticsearch Search object so that it retrieves
+        the page after `last_item_on_previous_page`.
+        """
+        if not self.SEARCH_AFTER_SUPPORTED:
+            return super(SortKeyPagination, self).modify_search_query(search)
+
+        # Sorting explicitly makes Elasticsearch return the sort key
+        # of each result, which we need to find the next page. If
+        # the search is already sorted some other way, that's fine.
+        if not search.to_dict().get('sort'):
+            search = search.sort(*self.SORT_ORDER)
+        if self.last_item_on_previous_page is None:
+            return super(SortKeyPagination, self).modify_search_query(search)
+        search = search.extra(search_after=self.last_item_on_previous_page)
+        return search[0:self.size]
+
+    def page_loaded(self, work_ids, last_item=None):
+        super(SortKeyPagination, self).page_loaded(work_ids, last_item)
+        if last_item is not None:
+            last_item = list(last_item)
+        self.last_item_on_this_page = last_item
+
+
+class KeysetPagination(SortKeyPagination):
+    """Pagination for lane feeds that picks up where the previous page
+    left off, rather than skipping over some number of works.
+
+    With OFFSET, the database has to find and discard every work on
+    the pages before the one that was requested, so deep pages of a
+    big lane get slower and slower. Instead, the cursor holds the sort
+    key of the last work on the previous page -- the values of the
+    fields given by Facets.order_by(), ending with the work ID -- and
+    the query only looks at the works that sort after it, which an
+    index on those fields can find directly.
+    """
+
+    @classmethod
+    def sort_key(cls, work, facets):
+        """Find the sort key of a MaterializedWorkWithGenre under the
+        given Facets.
+
+        :return: A list that can be serialized as JSON, or None if
+            `facets` doesn't put works in a definite order.
+        """
+        if not isinstance(facets, Facets):
+            return None
+        order_by, fields = facets.order_by()
+        key = []
+        for field in fields:
+            value = getattr(work, field.key)
+            if isinstance(value, datetime.datetime):
+                value = value.isoformat()
+            elif isinstance(value, Decimal):
+                value = str(value)
+            key.append(value)
+        return key
+
+    @classmethod
+    def _parse_datetime(cls, value):
+        """Turn a datetime serialized by sort_key() back into a datetime."""
+        if not isinstance(value, basestring):
+            raise ValueError("Not a datetime: %r" % value)
+        for format in ("%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S"):
+            try:
+                return datetime.datetime.strptime(value, format)
+            except ValueError:
+                continue
+        raise ValueError("Not a datetime: %r" % value)
+
+    def modify_search_query(self, search):
+        # A sort key from the database means nothing to the search
+        # index, so search results are located by offset.
+        return Pagination.modify_search_query(self, search)
+
+    def apply_keyset(self, qu, facets):
+        """Modify the given query so it only finds the works on this page.
+
+        :param facets: The Facets object that determined the query's
+            ORDER BY clause. If the sort key doesn't fit this ordering,
+            the page is located by its offset instead.
+        """
+        if (self.last_item_on_previous_page is None
+            or not isinstance(facets, Facets)):
+            return self.apply(qu)
+        order_by, fields = facets.order_by()
+        try:
+            clause = self.after_clause(
+                order_by, self.last_item_on_previous_page
+            )
+        except ValueError, e:
+            logging.warn("Ignoring unusable sort key: %s", e)
+            return self.apply(qu)
+        return qu.filter(clause).limit(self.size)
+
+    @classmethod
+    def after_clause(cls, order_by, values):
+        """Create a clause that matches rows that sort after `values`.
+
+        A plain row-value comparison doesn't work here: the first
+        field may be sorted in the opposite direction from the
+        others, and Postgres sorts NULL after every other value (or
+        before, for a descending sort), where a comparison with NULL
+        matches nothing. So the comparison is spelled out field by
+        field, with a simple bound on the first field so the database
+        can use an index.
+
+        :param order_by: A list of ORDER BY expressions, as returned
+            by Facets.order_by().
+        :param values: A sort key, as returned by sort_key().
+        :raise ValueError: If the sort key doesn't fit `order_by`.
+        """
+        if len(order_by) != len(values):
+            raise ValueError(
+                "Expected %d values, got %r" % (len(order_by), values)
+            )
+
+        fields = []
+        for expression, value in zip(order_by, values):
+            if not isinstance(value, (basestring, int, long, float,
+                                      type(None))):
+                raise ValueError("Invalid sort key value: %r" % value)
+            field = expression.element
+            descending = expression.modifier is operators.desc_op
+            nullable = getattr(field, 'nullable', True)
+            if value is not None and isinstance(field.type, DateTime):
+                value = cls._parse_datetime(value)
+            fields.append((field, descending, nullable, value))
+
+        clause = None
+        for field, descending, nullable, value in reversed(fields):
+            if value is None:
+                equal = (field == None)
+                if descending:
+                    after = (field != None)
+                else:
+                    # Nothing sorts after NULL.
+                    after = None
+            else:
+                equal = (field == value)
+                if descending:
+                    after = (field < value)
+                elif nullable:
+                    after = or_(field > value, field == None)
+                else:
+                    after = (field > value)
+
+            if clause is None:
+                clause = after
+            elif after is None:
+                clause = and_(equal, clause)
+            else:
+                clause = or_(after, and_(equal, clause))
+
+        if clause is None:
+            # Nothing sorts after this key.
+            return false()
+
+        field, descending, nullable, value = fields[0]
+        if value is not None:
+            if descending:
+                bound = (field <= value)
+            elif nullable:
+                bound = or_(field >= value, field == None)
+            else:
+                bound = (field >= value)
+            clause = and_(bound, clause)
+        return clause
+
 
 class WorkList(object):
     """An object that can obtain a list of Work/MaterializedWorkWithGenre
@@ -1258,9 +1683,32 @@ class WorkList(object):
             # run.
             return []
 
+        candidates = None
+        samples = FeaturedWork.sample(_db, [self], facets, target_size)
+        if self in samples:
+            # This lane has a precomputed pool of featured works. We
+            # only need to look at the works sampled from that pool,
+            # rather than picking a random window over the whole lane.
+            pool_query = query.filter(
+                work_model.works_id.in_(samples[self])
+            )
+            candidates = pool_query.limit(target_size).all()
+            found = set(
+                (x[0] if isinstance(x, tuple) else x).works_id
+                for x in candidates
+            )
+            if len(found) < len(set(samples[self])):
+                # Some of the sampled works have left the lane since
+                # the pool was built, so the pool is stale.
+                candidates = None
+            else:
+                random.shuffle(candidates)
+        if candidates is None:
+            candidates = self.random_sample(query, target_size)
+
         work_ids = set()
         works = []
-        for work in self.random_sample(query, target_size)[:target_size]:
+        for work in candidates[:target_size]:
             if isinstance(work, tuple):
                 # This is a (work, score) 2-tuple.
                 work = work[0]
@@ -1337,6 +1785,125 @@ class WorkList(object):
             )
         return qu
 
+    def facet_counts(self, _db, facets, use_cache=True):
+        """Count the works that would show up in this WorkList under each
+        of the enabled availability and collection facets.
+
+        Each count assumes the current value of the other facet
+        group, so the counts match the feeds a patron would see by
+        following the corresponding facet links.
+
+        :param facets: A Facets object.
+        :param use_cache: If this is True, the counts will be cached
+            as a CachedFeed, and a cached copy will be used if it's
+            fresh enough.
+        :return: A dictionary mapping facet group name to a
+            dictionary mapping facet value to a number of works.
+        """
+        cached = None
+        if use_cache:
+            cached, usable = CachedFeed.fetch(
+                _db, self, CachedFeed.FACET_COUNTS_TYPE, facets, None, None
+            )
+            if usable:
+                return json.loads(unicode(cached.content))
+
+        counts = self._facet_counts(_db, facets)
+        if cached:
+            cached.update(_db, unicode(json.dumps(counts)))
+        return counts
+
+    def _facet_counts(self, _db, facets):
+        """Count the works for facet_counts() with a single query."""
+        ignore, availability_facets, collection_facets = facets.enabled_facets
+
+        # Find everything in this WorkList that would show up under
+        # the current entry point.
+        qu = self.works(
+            _db, facets=FacetsWithEntryPoint(entrypoint=facets.entrypoint)
+        )
+
+        counts = {
+            facets.AVAILABILITY_FACET_GROUP_NAME : {},
+            facets.COLLECTION_FACET_GROUP_NAME : {},
+        }
+        if qu is None:
+            return counts
+
+        # Each facet value becomes a conditional count of distinct
+        # works, so that every count comes from one pass over the
+        # materialized view.
+        columns = []
+        keys = []
+        def add(group, value, *clauses):
+            clauses = [x for x in clauses if x is not None]
+            if clauses:
+                works_id = case([(and_(*clauses), work_model.works_id)])
+            else:
+                works_id = work_model.works_id
+            columns.append(func.count(distinct(works_id)))
+            keys.append((group, value))
+
+        current_availability = facets.availability_clause(facets.availability)
+        current_collection = facets.collection_clause(facets.collection)
+        for availability in availability_facets:
+            add(facets.AVAILABILITY_FACET_GROUP_NAME, availability,
+                facets.availability_clause(availability), current_collection)
+        for collection in collection_facets:
+            add(facets.COLLECTION_FACET_GROUP_NAME, collection,
+                current_availability, facets.collection_clause(collection))
+        if not columns:
+            return counts
+
+        statement = qu.enable_eagerloads(False).with_labels().statement
+        statement = statement.with_only_columns(columns).order_by(None)
+        row = _db.execute(statement).first()
+        for (group, value), count in zip(keys, row):
+            counts[group][value] = count
+        return counts
+
+    def works_from_search_index(self, _db, facets, pagination,
+                                search_engine, debug=False):
+        """Find one page of the works in this WorkList by asking the
+        search index, rather than querying the materialized view.
+
+        :param facets: A Facets object.
+        :param pagination: A Pagination object.
+        :param search_engine: An ExternalSearchIndex.
+        :return: A list of MaterializedWorkWithGenre objects, or None
+            if this page can't be found through the search index, in
+            which case works() should be used instead.
+        """
+        if not isinstance(facets, Facets):
+            return None
+        if self.list_seen_in_previous_days:
+            # The search index doesn't know when a book was last
+            # seen on a list.
+            return None
+        if isinstance(pagination, KeysetPagination):
+            # The search index can't continue from a sort key that
+            # came from the database.
+            return None
+
+        filter = Filter.from_worklist(_db, self, facets)
+        if not filter.order:
+            # The search index doesn't know how to put the works in
+            # the order requested by the facets.
+            return None
+
+        pagination = pagination or Pagination.default()
+        try:
+            work_ids = search_engine.query_works(
+                None, filter, pagination, debug
+            )
+        except elasticsearch.exceptions.ElasticsearchException, e:
+            logging.error(
+                "Problem communicating with ElasticSearch. Falling back to the database.",
+                exc_info=e
+            )
+            return None
+        return self.works_for_specific_ids(_db, work_ids)
+
     def works_for_specific_ids(self, _db, work_ids):
         """Create the appearance of having called works(),
         but return the specific MaterializedWorks identified by `work_ids`.
@@ -1402,7 +1969,9 @@ class WorkList(object):
             # based on work ID.
             qu = qu.distinct(work_model.works_id)
 
-        if pagination:
+        if isinstance(pagination, KeysetPagination):
+            qu = pagination.apply_keyset(qu, facets)
+        elif pagination:
             qu = pagination.apply(qu)
 
         return qu
@@ -1595,7 +2164,9 @@ class WorkList(object):
             # This is probably a unit test.
             total_size = len(query)
         else:
-            total_size = fast_query_count(query)
+            # We only need a rough idea of the size of the query
+            # to pick a random offset.
+            total_size = count_estimate(query)
 
         # Determine the highest offset we could choose and still
         # choose `target_size` items that fit entirely in the portion
@@ -1614,6 +2185,11 @@ class WorkList(object):
         else:
             offset = 0
         items = query.offset(offset).limit(target_size).all()
+        if offset > 0 and len(items) < target_size:
+            # The estimate overshot the real size of the query, so
+            # the offset went past the end. Start from the beginning
+            # instead.
+            items = query.limit(target_size).all()
         random.shuffle(items)
         return items
 
@@ -1664,8 +2240,8 @@ class WorkList(object):
             return results
 
         if not pagination:
-            pagination = Pagination(
-                offset=0, size=Pagination.DEFAULT_SEARCH_SIZE
+            pagination = SortKeyPagination(
+                size=Pagination.DEFAULT_SEARCH_SIZE
             )
 
         filter = Filter.from_worklist(_db, self, facets)
@@ -1780,14 +2356,116 @@ class WorkList(object):
 
         facets = facets or self.default_featured_facets(_db)
 
-        # Pull a window of works for every lane we were given.
-        for lane in lanes:
-            for mw, quality_tier in lane.works_in_window(
-                    _db, facets, target_size
+        # Lanes with a precomputed pool of featured works can be
+        # restricted to a sample from that pool.
+        samples = FeaturedWork.sample(_db, lanes, facets, target_size)
+        by_lane = defaultdict(list)
+        for work, work_quality_tier, lane_index in self._featured_windows(
+            _db, facets, target_size,
+            [(i, lane, samples.get(lane)) for i, lane in enumerate(lanes)]
+        ):
+            by_lane[lane_index].append((work, work_quality_tier))
+
+        # If some of the works sampled from a lane's pool have left
+        # the lane since the pool was built, the pool is stale. Pick
+        # a random window over the lane instead, as though it had no
+        # pool.
+        stale = []
+        for lane_index, lane in enumerate(lanes):
+            if lane not in samples:
+                continue
+            found = set(work.works_id for work, ignore in by_lane[lane_index])
+            if len(found) < len(set(samples[lane])):
+                stale.append((lane_index, lane, None))
+                del by_lane[lane_index]
+        if stale:
+            for work, work_quality_tier, lane_index in self._featured_windows(
+                _db, facets, target_size, stale
             ):
-                yield mw, quality_tier, lane
+                by_lane[lane_index].append((work, work_quality_tier))
+
+        for lane_index, lane in enumerate(lanes):
+            for work, work_quality_tier in by_lane[lane_index]:
+                yield work, work_quality_tier, lane
 
-    def works_in_window(self, _db, facets, target_size):
+    def _featured_windows(self, _db, facets, target_size, lanes):
+        """Find windows of featurable works for a number of lanes, in a
+        single database query.
+
+        :param lanes: A list of 3-tuples (lane index, Lane, list of
+            featured work IDs). The list of featured work IDs is passed
+            into `works_in_window` and may be None.
+
+        :yield: A sequence of (MaterializedWorkWithGenre, quality_tier,
+            lane index) 3-tuples, grouped by lane index.
+        """
+        quality_tier = facets.quality_tier_field()
+        mw = work_model
+
+        # Build a query that finds a window of works for every lane we
+        # were given. Each of these queries keeps its own quality-tier
+        # ordering and LIMIT. We only need the columns of the
+        # materialized view itself, plus the quality tier and a tag
+        # identifying which lane the row is for.
+        windows = []
+        for lane_index, lane, featured_work_ids in lanes:
+            lane_query = lane.works_in_window(
+                _db, facets, target_size,
+                featured_work_ids=featured_work_ids
+            )
+            if lane_query is None:
+                continue
+            lane_query = lane_query.enable_eagerloads(False).with_entities(
+                *(list(mw.__table__.columns) + [
+                    quality_tier, literal(lane_index).label("lane_index")
+                ])
+            )
+            windows.append(lane_query.with_labels().statement)
+        if not windows:
+            return
+
+        # Combine all of the windows into a single statement, so that
+        # a grouped feed costs one database round trip rather than
+        # one per lane.
+        featured = union_all(*windows).alias("featured_windows")
+        featured_mw = aliased(mw, featured)
+        qu = _db.query(
+            featured_mw, featured.c.quality_tier, featured.c.lane_index
+        ).join(
+            featured_mw.license_pool
+        ).order_by(
+            featured.c.lane_index, featured.c.quality_tier.desc(),
+            featured_mw.random.desc()
+        ).options(
+            # These are the same optimizations works() applies to
+            # a query against the materialized view.
+            contains_eager(featured_mw.license_pool),
+            lazyload(featured_mw.license_pool, LicensePool.data_source),
+            lazyload(featured_mw.license_pool, LicensePool.identifier),
+            lazyload(
+                featured_mw.license_pool, LicensePool.presentation_edition
+            ),
+            joinedload(featured_mw.license_pool,
+                       LicensePool.delivery_mechanisms),
+            joinedload(featured_mw.license_pool,
+                       LicensePool.delivery_mechanisms,
+                       "delivery_mechanism"),
+            joinedload(featured_mw.license_pool,
+                       LicensePool.delivery_mechanisms, "resource"),
+            joinedload(featured_mw.license_pool,
+                       LicensePool.delivery_mechanisms, "resource",
+                       "representation"),
+        )
+        if Configuration.DEFAULT_OPDS_FORMAT == "simple_opds_entry":
+            qu = qu.options(defer(featured_mw.verbose_opds_entry))
+        else:
+            qu = qu.options(defer(featured_mw.simple_opds_entry))
+
+        for work, work_quality_tier, lane_index in qu:
+            yield work, work_quality_tier, lane_index
+
+    def works_in_window(self, _db, facets, target_size,
+                        featured_work_ids=None):
         """Find all MaterializedWorkWithGenre objects within a randomly
         selected window of values for the `random` field.
 
@@ -1796,14 +2474,28 @@ class WorkList(object):
         :param target_size: Try to get approximately this many
         items. There may be more or less; this controls the size of
         the window and the LIMIT on the query.
+
+        :param featured_work_ids: A list of work IDs sampled from this
+        lane's pool of featured works (see `FeaturedWork.sample`). If
+        this is provided, only these works are considered, instead of
+        a random window.
         """
         lane_query = self.works(_db, facets=facets)
+        if lane_query is None:
+            # works() may return None, indicating that this lane
+            # should not be queried at all.
+            return None
 
-        # Make sure this query finds a number of works proportinal
-        # to the expected size of the lane.
-        lane_query = self._restrict_query_to_window(
-            lane_query, target_size, facets
-        )
+        if featured_work_ids is not None:
+            lane_query = lane_query.filter(
+                work_model.works_id.in_(featured_work_ids)
+            )
+        else:
+            # Make sure this query finds a number of works proportinal
+            # to the expected size of the lane.
+            lane_query = self._restrict_query_to_window(
+                lane_query, target_size, facets
+            )
 
         lane_query = lane_query.order_by(
             "quality_tier desc", work_model.random.desc()
@@ -1913,6 +2605,92 @@ Genre.lane_genres = relationship(
 )
 
 
+class FeaturedWork(Base):
+    """A Work that is a good candidate for being featured in a Lane's
+    grouped feed.
+
+    FeaturedWorksMonitor periodically stores a small pool of the most
+    featurable works in each Lane, once for each EntryPoint. A grouped
+    feed can then take a random sample from the pool, instead of
+    counting the works in the lane and picking a random window over
+    them while the patron waits.
+    """
+    __tablename__ = 'featuredworks'
+    id = Column(Integer, primary_key=True)
+    lane_id = Column(Integer, ForeignKey('lanes.id'), index=True,
+                     nullable=False)
+    work_id = Column(Integer, ForeignKey('works.id'), index=True,
+                     nullable=False)
+
+    # The URI of the EntryPoint this work was chosen for.
+    entrypoint = Column(Unicode, nullable=False)
+
+    # The value of FeaturedFacets.quality_tier_field() for this work
+    # when it was chosen.
+    quality_tier = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        UniqueConstraint('lane_id', 'entrypoint', 'work_id'),
+    )
+
+    @classmethod
+    def sample(cls, _db, lanes, facets, target_size):
+        """Take a random sample from the pool of featured works for
+        each of the given lanes, using a single query.
+
+        :param lanes: A list of WorkLists. Only Lanes have pools
+            of featured works; the others are ignored.
+        :param facets: A FeaturedFacets object, used to decide which
+            EntryPoint's pool to use.
+        :param target_size: The number of works the caller wants for
+            each lane.
+
+        :return: A dictionary mapping Lanes to lists of work IDs,
+            higher quality tiers first. A lane that doesn't have a
+            pool of featured works won't show up in the dictionary.
+        """
+        lanes_by_id = dict(
+            (lane.id, lane) for lane in lanes if isinstance(lane, Lane)
+        )
+        if not lanes_by_id:
+            return {}
+
+        entrypoint = EverythingEntryPoint.URI
+        if facets and facets.entrypoint:
+            entrypoint = facets.entrypoint.URI
+
+        qu = _db.query(
+            cls.lane_id, cls.work_id, cls.quality_tier
+        ).filter(
+            cls.lane_id.in_(lanes_by_id.keys())
+        ).filter(
+            cls.entrypoint==entrypoint
+        )
+        pools = defaultdict(lambda: defaultdict(list))
+        for lane_id, work_id, quality_tier in qu:
+            pools[lane_id][quality_tier].append(work_id)
+
+        # Allow the same overage as works_in_window, to reduce the
+        # risk that we'll have to use a given book more than once.
+        sample_size = int(target_size*1.3)
+        samples = dict()
+        for lane_id, by_tier in pools.items():
+            sample = []
+            # Go through each tier in decreasing quality order.
+            for tier in sorted(by_tier.keys(), reverse=True):
+                work_ids = by_tier[tier]
+                random.shuffle(work_ids)
+                sample.extend(work_ids[:sample_size-len(sample)])
+                if len(sample) >= sample_size:
+                    break
+            samples[lanes_by_id[lane_id]] = sample
+        return samples
+
+Work.featured_in_lanes = relationship(
+    "FeaturedWork", backref="work", cascade="all, delete-orphan"
+)
+
+
 class Lane(Base, WorkList):
     """A WorkList that draws its search criteria from a row in a
     database table.
@@ -1926,6 +2704,14 @@ class Lane(Base, WorkList):
     # Lane is cacheable for twenty minutes by default.
     MAX_CACHE_AGE = 20*60
 
+    # A Lane's pool of featured works holds this many times as many
+    # works as will be shown in a grouped feed.
+    FEATURED_POOL_MULTIPLIER = 5
+
+    # When recalculating lane sizes, the counts for this many lanes
+    # are gathered in a single query.
+    SIZE_BATCH_SIZE = 50
+
     __tablename__ = 'lanes'
     id = Column(Integer, primary_key=True)
     library_id = Column(Integer, ForeignKey('libraries.id'), index=True,
@@ -1942,6 +2728,11 @@ class Lane(Base, WorkList):
     # entry point? This is periodically calculated and cached.
     size_by_entrypoint = Column(JSON, nullable=True)
 
+    # A hash of everything that went into the most recent calculation
+    # of `size` and `size_by_entrypoint`. If it hasn't changed, there's
+    # no need to calculate them again.
+    size_fingerprint = Column(Unicode, nullable=True)
+
     # A lane may have one parent lane and many sublanes.
     sublanes = relationship(
         "Lane",
@@ -2047,6 +2838,14 @@ class Lane(Base, WorkList):
         cascade="all, delete-orphan",
     )
 
+    # A Lane may have a pool of FeaturedWorks. (This can't be called
+    # `featured_works`, since that would hide
+    # WorkList.featured_works().)
+    featured_work_pool = relationship(
+        "FeaturedWork", backref="lane",
+        cascade="all, delete-orphan",
+    )
+
 
     __table_args__ = (
         UniqueConstraint('parent_id', 'display_name'),
@@ -2090,6 +2889,42 @@ class Lane(Base, WorkList):
             seen.add(parent)
             yield parent
 
+    def _lane_tree_entry(self):
+        """Find this Lane's precomputed values in a LaneTreeSnapshot.
+
+        :return: A LaneTreeSnapshot.Entry, or None if this Lane isn't
+            in the database yet.
+        """
+        _db = Session.object_session(self)
+        if not _db or not self.library_id or self.id is None:
+            return None
+        if LaneTreeSnapshot.has_pending_changes(_db):
+            # The snapshot may not match what's in the session, so
+            # calculate the values from the Lane objects instead.
+            return None
+        snapshot = LaneTreeSnapshot.for_library(_db, self.library_id)
+        return snapshot.entry(self.id)
+
+    def inherited_value(self, k):
+        """Find this Lane's value for the given key, possibly inherited
+        from its parent, using a LaneTreeSnapshot if possible.
+        """
+        if k in LaneTreeSnapshot.INHERITED_FIELDS:
+            entry = self._lane_tree_entry()
+            if entry:
+                return entry.inherited[k]
+        return super(Lane, self).inherited_value(k)
+
+    def inherited_values(self, k):
+        """Find the values for the given key imposed by this Lane and
+        its parentage, using a LaneTreeSnapshot if possible.
+        """
+        if k in LaneTreeSnapshot.ACCUMULATED_FIELDS:
+            entry = self._lane_tree_entry()
+            if entry and entry.accumulated[k] is not None:
+                return entry.accumulated[k]
+        return super(Lane, self).inherited_values(k)
+
     @property
     def depth(self):
         """How deep is this lane in this site's hierarchy?
@@ -2223,16 +3058,238 @@ class Lane(Base, WorkList):
 
     def update_size(self, _db):
         """Update the stored estimate of the number of Works in this Lane."""
-        query = self.works(_db).limit(None)
-        query = query.distinct(work_model.works_id)
+        self.update_sizes(_db, [self], force=True)
+
+    @classmethod
+    def size_statistics(cls, _db):
+        """Summarize the materialized view, so that update_sizes() can
+        tell which lanes might have changed size since they were last
+        counted.
+
+        :return: A dictionary mapping (collection_id, genre_id) to a
+            tuple of numbers that changes whenever works are added to,
+            removed from, or modified within that part of the
+            materialized view.
+        """
+        mw = work_model
+        available = case(
+            [(and_(LicensePool.suppressed==False,
+                   or_(LicensePool.licenses_owned > 0,
+                       LicensePool.open_access==True)), 1)],
+            else_=0
+        )
+        qu = _db.query(
+            mw.collection_id, mw.genre_id, func.count(mw.works_id),
+            func.sum(mw.works_id), func.sum(available),
+            func.max(mw.last_update_time),
+        ).select_from(mw).join(
+            LicensePool, LicensePool.id==mw.license_pool_id
+        ).group_by(mw.collection_id, mw.genre_id)
+
+        statistics = dict()
+        for collection_id, genre_id, count, total, available, updated in qu:
+            if updated:
+                updated = updated.isoformat()
+            statistics[(collection_id, genre_id)] = (
+                count, int(total or 0), int(available or 0), updated
+            )
+        return statistics
+
+    def _size_fingerprint(self, _db, statements, statistics):
+        """Hash everything that goes into this Lane's size: the queries
+        that count its works, and the parts of the materialized view
+        and the CustomLists those queries look at.
+        """
+        genre_ids = self.genre_ids
+        collection_ids = self.collection_ids
+        relevant = sorted(
+            (key, value) for key, value in statistics.items()
+            if (collection_ids is None or key[0] in collection_ids)
+            and (genre_ids is None or key[1] in genre_ids)
+        )
+        data = []
+        for statement in statements:
+            compiled = statement.compile(dialect=_db.get_bind().dialect)
+            data.append(
+                [unicode(compiled), sorted(
+                    (k, repr(v)) for k, v in compiled.params.items()
+                )]
+            )
+        data.append(relevant)
+        data.append(self._customlist_statistics(_db))
+        return unicode(hashlib.sha1(json.dumps(data)).hexdigest())
+
+    def _customlist_statistics(self, _db):
+        """Summarize the entries in the CustomLists this Lane draws from.
+
+        Adding a work to one of those lists, or removing one, changes
+        the size of the Lane without changing the materialized view.
+
+        :return: A list of numbers that changes whenever one of the
+            lists gains or loses an entry, or None if this Lane isn't
+            restricted to CustomLists.
+        """
+        if self.inherit_parent_restrictions:
+            hierarchy = self.hierarchy
+        else:
+            hierarchy = [self]
+        customlist_ids = set()
+        data_source_ids = set()
+        for lane in hierarchy:
+            if lane.list_datasource_id:
+                # A new list from this DataSource can also change the
+                # size of the Lane.
+                data_source_ids.add(lane.list_datasource_id)
+            elif lane.customlist_ids:
+                customlist_ids.update(lane.customlist_ids)
+        if not customlist_ids and not data_source_ids:
+            return None
 
-        # Do the estimate for every known entry point.
-        by_entrypoint = dict()
+        clauses = []
+        if customlist_ids:
+            clauses.append(CustomListEntry.list_id.in_(customlist_ids))
+        if data_source_ids:
+            clauses.append(CustomList.data_source_id.in_(data_source_ids))
+        qu = _db.query(
+            func.count(CustomListEntry.id), func.sum(CustomListEntry.id),
+            func.sum(CustomListEntry.work_id),
+            func.max(CustomListEntry.most_recent_appearance),
+        ).select_from(CustomListEntry).join(
+            CustomList, CustomList.id==CustomListEntry.list_id
+        ).filter(or_(*clauses))
+        count, total, work_total, updated = qu.one()
+        if updated:
+            updated = updated.isoformat()
+        return [count, int(total or 0), int(work_total or 0), updated]
+
+    def _size_statements(self, _db):
+        """Build one statement per entry point, each of which selects
+        every row in the materialized view that belongs in this Lane.
+
+        :return: A list of 2-tuples (EntryPoint, statement), or None if
+            this Lane can't generate a query at all.
+        """
+        query = self.works(_db)
+        if query is None:
+            return None
+        query = query.limit(None)
+        statements = []
         for entrypoint in EntryPoint.ENTRY_POINTS:
             qu = entrypoint.apply(query)
-            by_entrypoint[entrypoint.URI] = fast_query_count(qu)
-        self.size_by_entrypoint = by_entrypoint
-        self.size = by_entrypoint[EverythingEntryPoint.URI]
+            statement = qu.enable_eagerloads(False).with_labels().statement
+            # We'll be counting distinct works ourselves.
+            statement._distinct = False
+            statements.append((entrypoint, statement.order_by(None)))
+        return statements
+
+    @classmethod
+    def update_sizes(cls, _db, lanes, force=False, statistics=None):
+        """Update the stored estimate of the number of Works in each of
+        the given Lanes.
+
+        Rather than running a separate count for every Lane and
+        entry point, the counts for a batch of Lanes are gathered in
+        a single query. Lanes whose queries and underlying data
+        (including the entries in any CustomLists they draw from)
+        have not changed since their sizes were last calculated are
+        skipped.
+
+        :param lanes: A list of Lanes.
+        :param force: Recalculate every Lane's size, even if nothing
+            seems to have changed.
+        :param statistics: The output of size_statistics(), if it has
+            already been calculated.
+        :return: A list of the Lanes whose sizes were recalculated.
+        """
+        if not force and statistics is None:
+            statistics = cls.size_statistics(_db)
+
+        # Build all the statements up front. Setting sizes flushes
+        # Lanes, which would force the lane tree snapshot used by
+        # works() to be rebuilt.
+        todo = []
+        for lane in lanes:
+            statements = lane._size_statements(_db)
+            fingerprint = None
+            if statements is not None and statistics is not None:
+                fingerprint = lane._size_fingerprint(
+                    _db, [statement for ignore, statement in statements],
+                    statistics
+                )
+                if not force and fingerprint == lane.size_fingerprint:
+                    continue
+            todo.append((lane, statements, fingerprint))
+
+        sizes = defaultdict(dict)
+        for start in range(0, len(todo), cls.SIZE_BATCH_SIZE):
+            batch = todo[start:start+cls.SIZE_BATCH_SIZE]
+            counts = []
+            for lane_index, (lane, statements, ignore) in enumerate(batch):
+                for entrypoint, statement in (statements or []):
+                    counts.append(statement.with_only_columns([
+                        literal(start+lane_index).label("lane_index"),
+                        literal(entrypoint.URI).label("entrypoint"),
+                        func.count(distinct(work_model.works_id)).label("size"),
+                    ]))
+            if not counts:
+                continue
+            for lane_index, entrypoint, size in _db.execute(union_all(*counts)):
+                sizes[lane_index][entrypoint] = size
+
+        for lane_index, (lane, statements, fingerprint) in enumerate(todo):
+            by_entrypoint = dict()
+            for entrypoint in EntryPoint.ENTRY_POINTS:
+                by_entrypoint[entrypoint.URI] = sizes[lane_index].get(
+                    entrypoint.URI, 0
+                )
+            lane.size_by_entrypoint = by_entrypoint
+            lane.size = by_entrypoint[EverythingEntryPoint.URI]
+            lane.size_fingerprint = fingerprint
+        return [lane for lane, ignore, ignore in todo]
+
+    def update_featured_works(self, _db):
+        """Replace this Lane's pool of featured works, for every known
+        entry point.
+        """
+        library = self.library
+        pool_size = library.featured_lane_size * self.FEATURED_POOL_MULTIPLIER
+        _db.query(FeaturedWork).filter(
+            FeaturedWork.lane_id==self.id
+        ).delete(synchronize_session=False)
+
+        rows = []
+        for entrypoint in EntryPoint.ENTRY_POINTS:
+            facets = FeaturedFacets(
+                library.minimum_featured_quality,
+                uses_customlists=self.uses_customlists,
+                entrypoint=entrypoint
+            )
+            query = self.works(_db, facets=facets)
+            if query is None:
+                continue
+
+            # Build the pool from a random window over the lane, so
+            # that each refresh features different works.
+            query = self._restrict_query_to_window(query, pool_size, facets)
+            query = query.enable_eagerloads(False).with_entities(
+                work_model.works_id, facets.quality_tier_field()
+            ).limit(pool_size)
+
+            # A work may show up more than once, e.g. if it's in
+            # multiple collections. Its first appearance is the one
+            # with the highest quality tier.
+            seen = set()
+            for work_id, quality_tier in query:
+                if work_id in seen:
+                    continue
+                seen.add(work_id)
+                rows.append(
+                    dict(lane_id=self.id, work_id=work_id,
+                         entrypoint=entrypoint.URI,
+                         quality_tier=quality_tier)
+                )
+        if rows:
+            _db.execute(FeaturedWork.__table__.insert(), rows)
 
     @property
     def genre_ids(self):
@@ -2243,7 +3300,11 @@ class Lane(Base, WorkList):
         consider genres at all.
         """
         if not hasattr(self, '_genre_ids'):
-            self._genre_ids = self._gather_genre_ids()
+            entry = self._lane_tree_entry()
+            if entry:
+                self._genre_ids = entry.genre_ids
+            else:
+                self._genre_ids = self._gather_genre_ids()
         return self._genre_ids
 
     def _gather_genre_ids(self):
@@ -2289,7 +3350,15 @@ class Lane(Base, WorkList):
         :return: A list of CustomList IDs, possibly empty.
         """
         if not hasattr(self, '_customlist_ids'):
-            self._customlist_ids = self._gather_customlist_ids()
+            entry = None
+            if not self.list_datasource_id:
+                # The lists from a DataSource aren't part of the
+                # snapshot.
+                entry = self._lane_tree_entry()
+            if entry:
+                self._customlist_ids = entry.customlist_ids
+            else:
+                self._customlist_ids = self._gather_customlist_ids()
         return self._customlist_ids
 
     def _gather_customlist_ids(self):
@@ -2335,6 +3404,160 @@ class Lane(Base, WorkList):
             or_(data_source_matches, specific_link)
         )
 
+    @classmethod
+    def affected_by_works(cls, _db, work_ids, lanes=None):
+        """Find all Lanes that contain any of the given Works, according
+        to the materialized view.
+
+        The check for a batch of Lanes is done in a single query.
+
+        :param lanes: Only consider these Lanes. By default, every
+            Lane is considered.
+        :return: A set of Lanes.
+        """
+        work_ids = list(work_ids)
+        if not work_ids:
+            return set()
+        if lanes is None:
+            lanes = _db.query(Lane).all()
+
+        statements = []
+        for lane in lanes:
+            query = lane.works(_db)
+            if query is None:
+                continue
+            statement = query.limit(None).enable_eagerloads(
+                False
+            ).with_labels().statement
+            statement._distinct = False
+            statements.append((lane, statement.order_by(None)))
+
+        affected = set()
+        for start in range(0, len(statements), cls.SIZE_BATCH_SIZE):
+            batch = statements[start:start+cls.SIZE_BATCH_SIZE]
+            matches = []
+            for lane_index, (lane, statement) in enumerate(batch):
+                matches.append(statement.where(
+                    work_model.works_id.in_(work_ids)
+                ).with_only_columns([
+                    literal(start+lane_index).label("lane_index")
+                ]))
+            for lane_index, in _db.execute(union(*matches)):
+                affected.add(statements[lane_index][0])
+        return affected
+
+    @classmethod
+    def invalidate_cached_feeds(cls, _db, lanes, work_ids=None):
+        """Mark stale every cached feed that might show something
+        different now that the contents of the given Lanes have changed.
+
+        This covers:
+
+        * Every feed for one of the Lanes, other than its navigation
+          feed.
+        * Every feed for one of the given Works.
+        * The grouped feed for a Lane or its parent, if the Lane
+          features one of the given Works. If the Lane is at the top
+          level, this means the grouped feed for the library's
+          top-level WorkList.
+        * Every other feed for the top-level WorkList of a library with
+          one of the Lanes.
+
+        A Lane without a pool of featured works (see FeaturedWork)
+        features any of its works.
+
+        :param work_ids: The IDs of the Works that changed. If this is
+            None, every work in the Lanes is presumed to have changed.
+        :return: The number of feeds marked stale.
+        """
+        lanes = set(lanes)
+        lane_ids = set(lane.id for lane in lanes)
+        libraries = dict((lane.library_id, lane.library) for lane in lanes)
+        library_ids = set(libraries)
+        if work_ids is not None:
+            work_ids = list(work_ids)
+
+        featuring = lanes
+        if work_ids is not None and lane_ids:
+            pooled_lane_ids = set(
+                lane_id for lane_id, in _db.query(
+                    distinct(FeaturedWork.lane_id)
+                ).filter(FeaturedWork.lane_id.in_(lane_ids))
+            )
+            featuring_lane_ids = set()
+            if work_ids:
+                featuring_lane_ids = set(
+                    lane_id for lane_id, in _db.query(
+                        distinct(FeaturedWork.lane_id)
+                    ).filter(
+                        FeaturedWork.lane_id.in_(lane_ids)
+                    ).filter(
+                        FeaturedWork.work_id.in_(work_ids)
+                    )
+                )
+            featuring = [
+                lane for lane in lanes
+                if lane.id not in pooled_lane_ids
+                or lane.id in featuring_lane_ids
+            ]
+
+        grouped_lane_ids = set()
+        top_level_library_ids = set()
+        for lane in featuring:
+            grouped_lane_ids.add(lane.id)
+            if lane.parent_id:
+                grouped_lane_ids.add(lane.parent_id)
+            else:
+                top_level_library_ids.add(lane.library_id)
+
+        groups = CachedFeed.GROUPS_TYPE
+        not_grouped = CachedFeed.type.notin_(
+            [groups, CachedFeed.NAVIGATION_TYPE]
+        )
+        top_level = dict(
+            (library_id, cls._top_level_feeds(_db, library))
+            for library_id, library in libraries.items()
+        )
+        clauses = []
+        if lane_ids:
+            clauses.append(and_(CachedFeed.lane_id.in_(lane_ids), not_grouped))
+        if grouped_lane_ids:
+            clauses.append(and_(
+                CachedFeed.lane_id.in_(grouped_lane_ids),
+                CachedFeed.type==groups
+            ))
+        if top_level_library_ids:
+            clauses.append(and_(
+                or_(*[top_level[x] for x in top_level_library_ids]),
+                CachedFeed.type==groups
+            ))
+        if library_ids:
+            clauses.append(and_(or_(*top_level.values()), not_grouped))
+        if work_ids:
+            clauses.append(CachedFeed.work_id.in_(work_ids))
+        if not clauses:
+            return 0
+        return CachedFeed.mark_stale(_db, or_(*clauses))
+
+    @classmethod
+    def _top_level_feeds(cls, _db, library):
+        """A clause matching the cached feeds for the given library's
+        top-level WorkList, but not feeds for other WorkLists such as
+        series or contributor feeds.
+        """
+        top_level = WorkList.top_level_for_library(_db, library)
+        if isinstance(top_level, Lane):
+            return CachedFeed.lane_id==top_level.id
+        fields = CachedFeed.identifying_fields(
+            _db, top_level, None, None, None
+        )
+        return and_(
+            CachedFeed.lane_id==None,
+            CachedFeed.unique_key==fields['unique_key'],
+            CachedFeed.library_id==library.id,
+            CachedFeed.work_id==None
+        )
+
     def add_genre(self, genre, inclusive=True, recursive=True):
         """Create a new LaneGenre for the given genre and
         associate it with this Lane.
@@ -2601,6 +3824,270 @@ lanes_customlists = Table(
     UniqueConstraint('lane_id', 'customlist_id'),
 )
 
+class LaneTreeSnapshot(object):
+    """An immutable picture of one library's lane hierarchy.
+
+    Finding a Lane's genre IDs, custom list IDs and inherited
+    restrictions means walking up the tree through Lane.parent and
+    lazy-loading LaneGenre and CustomList rows. A snapshot does all of
+    that once, with a handful of queries, and keeps the results until
+    the lane configuration changes.
+
+    A snapshot is thrown away when the site configuration changes
+    (which covers changes made by other processes), or when a change
+    to a Lane, LaneGenre or Genre, or the deletion of a CustomList, is
+    flushed in this process.
+
+    CustomLists are created by other processes without changing the
+    site configuration, so the lists of a Lane that takes every list
+    from a DataSource are not part of the snapshot.
+    """
+
+    # Lane fields whose values can be inherited from a parent lane
+    # through WorkList.inherited_value().
+    INHERITED_FIELDS = ['fiction', 'audiences', 'target_age', 'languages',
+                        'media']
+
+    # Lane fields whose values accumulate down the lane hierarchy
+    # through WorkList.inherited_values().
+    ACCUMULATED_FIELDS = ['genre_ids', 'customlist_ids']
+
+    # Maps library IDs to snapshots.
+    _cache = dict()
+
+    # Incremented whenever a change to the lane hierarchy is flushed
+    # in this process.
+    _generation = 0
+
+    class Entry(object):
+        """The precomputed values for a single Lane."""
+        def __init__(self, lane_id, values, inherited, accumulated):
+            self.lane_id = lane_id
+            self.values = values
+            self.inherited = inherited
+            # A value of None means the accumulated values aren't
+            # part of the snapshot.
+            self.accumulated = accumulated
+
+        @property
+        def genre_ids(self):
+            return self.values['genre_ids']
+
+        @property
+        def customlist_ids(self):
+            return self.values['customlist_ids']
+
+    def __init__(self, library_id, entries, configuration_time=None,
+                 generation=None):
+        self.library_id = library_id
+        self.entries = entries
+        self.configuration_time = configuration_time
+        self.generation = generation
+
+    @classmethod
+    def lane_hierarchy_changed(cls):
+        """Note that the lane hierarchy changed, invalidating every
+        snapshot built by this process.
+        """
+        cls._generation += 1
+
+    @classmethod
+    def has_pending_changes(cls, _db):
+        """Does the given session hold changes to the lane hierarchy
+        that haven't been flushed yet, and so can't be in a snapshot?
+        """
+        for objects in (_db.new, _db.dirty, _db.deleted):
+            for obj in objects:
+                if isinstance(obj, (Lane, LaneGenre, Genre, CustomList)):
+                    return True
+        return False
+
+    @classmethod
+    def for_library(cls, _db, library_id):
+        """Find an up-to-date snapshot of the given library's lanes,
+        building one if necessary.
+
+        Changes that haven't been flushed yet aren't reflected in the
+        snapshot. It's up to the caller to flush them first.
+        """
+        configuration_time = Configuration._site_configuration_last_update()
+        generation = cls._generation
+        snapshot = cls._cache.get(library_id)
+        if (snapshot is None
+            or snapshot.configuration_time != configuration_time
+            or snapshot.generation != generation):
+            snapshot = cls.build(
+                _db, library_id, configuration_time, generation
+            )
+            cls._cache[library_id] = snapshot
+        return snapshot
+
+    @classmethod
+    def build(cls, _db, library_id, configuration_time=None,
+              generation=None):
+        """Build a snapshot of the given library's lanes."""
+        lane_rows = _db.query(
+            Lane.id, Lane.parent_id, Lane.inherit_parent_restrictions,
+            Lane.fiction, Lane._audiences.label("audiences"),
+            Lane._target_age.label("target_age"), Lane.languages,
+            Lane.media, Lane._list_datasource_id.label("list_datasource_id")
+        ).filter(Lane.library_id==library_id).all()
+
+        lane_genres = defaultdict(list)
+        for lane_id, genre_id, inclusive, recursive in _db.query(
+            LaneGenre.lane_id, LaneGenre.genre_id, LaneGenre.inclusive,
+            LaneGenre.recursive
+        ).join(Lane).filter(Lane.library_id==library_id):
+            lane_genres[lane_id].append((genre_id, inclusive, recursive))
+
+        specific_lists = defaultdict(list)
+        for lane_id, customlist_id in _db.query(
+            lanes_customlists.c.lane_id, lanes_customlists.c.customlist_id
+        ).join(
+            Lane, Lane.id==lanes_customlists.c.lane_id
+        ).filter(Lane.library_id==library_id):
+            specific_lists[lane_id].append(customlist_id)
+
+        genre_ids_by_name = dict()
+        genre_names_by_id = dict()
+        if lane_genres:
+            for genre_id, name in _db.query(Genre.id, Genre.name):
+                genre_ids_by_name[name] = genre_id
+                genre_names_by_id[genre_id] = name
+
+        # Find each lane's own values, the way the corresponding Lane
+        # properties would.
+        values = dict()
+        for row in lane_rows:
+            if row.list_datasource_id:
+                # Another process may create a list from this
+                # DataSource at any time, so the lane's lists can't be
+                # part of a snapshot.
+                customlist_ids = None
+            else:
+                customlist_ids = specific_lists[row.id] or None
+            values[row.id] = dict(
+                fiction=row.fiction,
+                audiences=row.audiences or [],
+                target_age=row.target_age,
+                languages=row.languages,
+                media=row.media,
+                genre_ids=cls._genre_ids(
+                    lane_genres.get(row.id), genre_ids_by_name,
+                    genre_names_by_id
+                ),
+                customlist_ids=customlist_ids,
+            )
+
+        rows_by_id = dict((row.id, row) for row in lane_rows)
+        entries = dict()
+        for row in lane_rows:
+            # Find this lane's ancestors, nearest first.
+            parentage = []
+            parent_id = row.parent_id
+            while parent_id is not None and parent_id in rows_by_id:
+                if parent_id in parentage or parent_id == row.id:
+                    # Lane.parentage will complain about this loop
+                    # if anyone tries to use it.
+                    break
+                parentage.append(parent_id)
+                parent_id = rows_by_id[parent_id].parent_id
+
+            inherited = dict()
+            for k in cls.INHERITED_FIELDS:
+                inherited[k] = cls._inherited_value(
+                    row.id, k, rows_by_id, values
+                )
+
+            if row.inherit_parent_restrictions:
+                hierarchy = list(reversed(parentage)) + [row.id]
+            else:
+                hierarchy = [row.id]
+            accumulated = dict()
+            for k in cls.ACCUMULATED_FIELDS:
+                accumulated[k] = [
+                    values[x][k] for x in hierarchy
+                    if values[x][k] not in (None, [])
+                ]
+            if any(rows_by_id[x].list_datasource_id for x in hierarchy):
+                # See above.
+                accumulated['customlist_ids'] = None
+            entries[row.id] = cls.Entry(
+                row.id, values[row.id], inherited, accumulated
+            )
+        return cls(library_id, entries, configuration_time, generation)
+
+    @classmethod
+    def _inherited_value(cls, lane_id, k, rows_by_id, values):
+        """Does the work of WorkList.inherited_value() for one lane."""
+        seen = set()
+        while lane_id is not None and lane_id not in seen:
+            seen.add(lane_id)
+            value = values[lane_id][k]
+            if value not in (None, []):
+                return value
+            row = rows_by_id[lane_id]
+            if (not row.inherit_parent_restrictions
+                or row.parent_id not in rows_by_id):
+                return None
+            lane_id = row.parent_id
+        return None
+
+    @classmethod
+    def _genre_ids(cls, lane_genres, genre_ids_by_name, genre_names_by_id):
+        """Does the work of Lane.genre_ids for one lane.
+
+        :param lane_genres: A list of (genre_id, inclusive, recursive)
+            3-tuples.
+        """
+        if not lane_genres:
+            return None
+        included_ids = set()
+        excluded_ids = set()
+        for genre_id, inclusive, recursive in lane_genres:
+            if inclusive:
+                bucket = included_ids
+            else:
+                bucket = excluded_ids
+            bucket.add(genre_id)
+            genredata = classifier.genres.get(genre_names_by_id.get(genre_id))
+            if recursive and genredata:
+                for subgenre in genredata.self_and_subgenres:
+                    subgenre_id = genre_ids_by_name.get(subgenre.name)
+                    if subgenre_id is not None:
+                        bucket.add(subgenre_id)
+        if not included_ids:
+            # No genres have been explicitly included, so this lane
+            # includes all genres that aren't excluded.
+            included_ids = set(genre_names_by_id.keys())
+        return included_ids - excluded_ids
+
+    def entry(self, lane_id):
+        """Find the precomputed values for the Lane with the given ID.
+
+        :return: A LaneTreeSnapshot.Entry, or None if the Lane isn't
+            part of this snapshot.
+        """
+        return self.entries.get(lane_id)
+
+
+class FeaturedWorksMonitor(Monitor):
+    """Refresh the pool of featured works for every Lane.
+
+    This takes the work of finding featurable books out of the
+    request path: a grouped feed only has to sample from the pool.
+    """
+    SERVICE_NAME = "Featured works refresh"
+
+    def run_once(self, start, cutoff):
+        for lane in self._db.query(Lane):
+            lane.update_featured_works(self._db)
+            self.log.info(
+                "Refreshed featured works for lane %s", lane.full_identifier
+            )
+            self._db.commit()
+
+
 @event.listens_for(Lane, 'after_insert')
 @event.listens_for(Lane, 'after_delete')
 @event.listens_for(LaneGenre, 'after_insert')
@@ -2614,3 +4101,29 @@ def configuration_relevant_lifecycle_event(mapper, connection, target):
 def configuration_relevant_update(mapper, connection, target):
     if directly_modified(target):
         site_configuration_has_changed(target)
+
+
+@event.listens_for(Lane.customlists, 'append')
+@event.listens_for(Lane.customlists, 'remove')
+def configuration_relevant_collection_change(target, value, initiator):
+    if Session.object_session(target):
+        site_configuration_has_changed(target)
+    LaneTreeSnapshot.lane_hierarchy_changed()
+
+
+@event.listens_for(CustomList, 'after_delete')
+def customlist_lifecycle_event(mapper, connection, target):
+    # A deleted CustomList is no longer part of any Lane.
+    LaneTreeSnapshot.lane_hierarchy_changed()
+
+
+@event.listens_for(Lane, 'after_insert')
+@event.listens_for(Lane, 'after_delete')
+@event.listens_for(Lane, 'after_update')
+@event.listens_for(LaneGenre, 'after_insert')
+@event.listens_for(LaneGenre, 'after_delete')
+@event.listens_for(LaneGenre, 'after_update')
+@event.listens_for(Genre, 'after_insert')
+@event.listens_for(Genre, 'after_delete')
+def lane_hierarchy_changed(mapper, connection, target):
+    LaneTreeSnapshot.lane_hierarchy_changed()
@@ -0,0 +1,20 @@
+DO $$
+    BEGIN
+        BEGIN
+            CREATE TABLE searchindexchanges (
+                id SERIAL PRIMARY KEY,
+                work_id INTEGER NOT NULL REFERENCES works(id),
+                timestamp TIMESTAMP WITHOUT TIME ZONE
+            );
+        EXCEPTION
+            WHEN duplicate_table THEN RAISE NOTICE 'Warning: searchindexchanges already exists.';
+        END;
+
+        BEGIN
+            CREATE INDEX ix_searchindexchanges_work_id
+                ON searchindexchanges (work_id);
+        EXCEPTION
+            WHEN duplicate_table THEN RAISE NOTICE 'Warning: ix_searchindexchanges_work_id already exists.';
+        END;
+    END;
+$$;
@@ -0,0 +1,9 @@
+DO $$
+  BEGIN
+    BEGIN
+      ALTER TABLE works ADD COLUMN search_document_hash varchar;
+    EXCEPTION
+      WHEN duplicate_column THEN RAISE NOTICE 'column works.search_document_hash already exists, not creating it.';
+    END;
+  END;
+$$;
@@ -0,0 +1,9 @@
+DO $$
+  BEGIN
+    BEGIN
+      ALTER TABLE searchindexchanges ADD COLUMN availability_only boolean NOT NULL DEFAULT false;
+    EXCEPTION
+      WHEN duplicate_column THEN RAISE NOTICE 'column searchindexchanges.availability_only already exists, not creating it.';
+    END;
+  END;
+$$;
@@ -0,0 +1,30 @@
+DO $$
+    BEGIN
+        BEGIN
+            CREATE TABLE featuredworks (
+                id SERIAL PRIMARY KEY,
+                lane_id INTEGER NOT NULL REFERENCES lanes(id),
+                work_id INTEGER NOT NULL REFERENCES works(id),
+                entrypoint VARCHAR NOT NULL,
+                quality_tier INTEGER NOT NULL DEFAULT 0,
+                UNIQUE (lane_id, entrypoint, work_id)
+            );
+        EXCEPTION
+            WHEN duplicate_table THEN RAISE NOTICE 'Warning: featuredworks already exists.';
+        END;
+
+        BEGIN
+            CREATE INDEX ix_featuredworks_lane_id
+                ON featuredworks (lane_id);
+        EXCEPTION
+            WHEN duplicate_table THEN RAISE NOTICE 'Warning: ix_featuredworks_lane_id already exists.';
+        END;
+
+        BEGIN
+            CREATE INDEX ix_featuredworks_work_id
+                ON featuredworks (work_id);
+        EXCEPTION
+            WHEN duplicate_table THEN RAISE NOTICE 'Warning: ix_featuredworks_work_id already exists.';
+        END;
+    END;
+$$;
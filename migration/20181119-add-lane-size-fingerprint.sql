@@ -0,0 +1,9 @@
+DO $$
+  BEGIN
+    BEGIN
+      ALTER TABLE lanes ADD COLUMN size_fingerprint varchar;
+    EXCEPTION
+      WHEN duplicate_column THEN RAISE NOTICE 'column lanes.size_fingerprint already exists, not creating it.';
+    END;
+  END;
+$$;
@@ -0,0 +1,47 @@
+-- Give every cached feed a fixed-width key that identifies it, so
+-- feeds can be found with a single unique index. See
+-- CachedFeed.calculate_lookup_key.
+DO $$
+  BEGIN
+    BEGIN
+      ALTER TABLE cachedfeeds ADD COLUMN lookup_key varchar;
+    EXCEPTION
+      WHEN duplicate_column THEN RAISE NOTICE 'column cachedfeeds.lookup_key already exists, not creating it.';
+    END;
+  END;
+$$;
+
+update cachedfeeds set lookup_key = md5(concat_ws(chr(31),
+    coalesce(lane_id::text, ''),
+    coalesce(unique_key, ''),
+    coalesce(library_id::text, ''),
+    coalesce(work_id::text, ''),
+    coalesce(type, ''),
+    coalesce(facets, ''),
+    coalesce(pagination, '')
+));
+
+-- Collapse duplicate feeds, keeping the most recent one that has
+-- content.
+delete from cachedfeeds where id in (
+    select id from (
+        select id, row_number() over (
+            partition by lookup_key
+            order by (content is not null) desc, timestamp desc nulls last, id desc
+        ) as rank
+        from cachedfeeds
+    ) as ranked
+    where rank > 1
+);
+
+DO $$
+  BEGIN
+    BEGIN
+      CREATE UNIQUE INDEX ix_cachedfeeds_lookup_key ON cachedfeeds (lookup_key);
+    EXCEPTION
+      WHEN duplicate_table THEN RAISE NOTICE 'Warning: ix_cachedfeeds_lookup_key already exists.';
+    END;
+  END;
+$$;
+
+drop index if exists ix_cachedfeeds_library_id_lane_id_type_facets_pagination;
@@ -0,0 +1,21 @@
+-- Cached feeds are now stored compressed. Feeds cached before this
+-- change keep their uncompressed content until they're regenerated.
+DO $$
+  BEGIN
+    BEGIN
+      ALTER TABLE cachedfeeds ADD COLUMN compressed_content bytea;
+    EXCEPTION
+      WHEN duplicate_column THEN RAISE NOTICE 'column cachedfeeds.compressed_content already exists, not creating it.';
+    END;
+  END;
+$$;
+
+DO $$
+  BEGIN
+    BEGIN
+      ALTER TABLE cachedfeeds ADD COLUMN content_encoding varchar;
+    EXCEPTION
+      WHEN duplicate_column THEN RAISE NOTICE 'column cachedfeeds.content_encoding already exists, not creating it.';
+    END;
+  END;
+$$;
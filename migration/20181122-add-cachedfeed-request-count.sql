@@ -0,0 +1,22 @@
+-- Keep track of how often each cached feed is requested and how long
+-- it takes to generate, so the busiest feeds can be regenerated
+-- before they expire.
+DO $$
+  BEGIN
+    BEGIN
+      ALTER TABLE cachedfeeds ADD COLUMN request_count integer;
+    EXCEPTION
+      WHEN duplicate_column THEN RAISE NOTICE 'column cachedfeeds.request_count already exists, not creating it.';
+    END;
+  END;
+$$;
+
+DO $$
+  BEGIN
+    BEGIN
+      ALTER TABLE cachedfeeds ADD COLUMN generation_time float;
+    EXCEPTION
+      WHEN duplicate_column THEN RAISE NOTICE 'column cachedfeeds.generation_time already exists, not creating it.';
+    END;
+  END;
+$$;
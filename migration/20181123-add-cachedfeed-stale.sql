@@ -0,0 +1,11 @@
+-- A cached feed can be marked stale when works it might contain have
+-- changed, so it's regenerated before it expires.
+DO $$
+  BEGIN
+    BEGIN
+      ALTER TABLE cachedfeeds ADD COLUMN stale boolean;
+    EXCEPTION
+      WHEN duplicate_column THEN RAISE NOTICE 'column cachedfeeds.stale already exists, not creating it.';
+    END;
+  END;
+$$;
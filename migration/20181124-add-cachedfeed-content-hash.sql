@@ -0,0 +1,11 @@
+-- Cached feeds remember a hash of their content, for use as an ETag.
+-- Feeds cached before this change are hashed when they're served.
+DO $$
+  BEGIN
+    BEGIN
+      ALTER TABLE cachedfeeds ADD COLUMN content_hash varchar;
+    EXCEPTION
+      WHEN duplicate_column THEN RAISE NOTICE 'column cachedfeeds.content_hash already exists, not creating it.';
+    END;
+  END;
+$$;
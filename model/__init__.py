@@ -367,8 +367,7 @@ class SessionManager(object):
         # Immediately update the number of works associated with each
         # lane.
         from ..lane import Lane
-        for lane in _db.query(Lane):
-            lane.update_size(_db)
+        Lane.update_sizes(_db, _db.query(Lane).all())
 
     @classmethod
     def session(cls, url, initialize_data=True):
@@ -522,6 +521,7 @@ from resource import (
 from work import (
     BaseMaterializedWork,
     MaterializedWorkWithGenre,
+    SearchIndexChange,
     Work,
     WorkGenre,
 )
@@ -5,22 +5,136 @@ from nose.tools import set_trace
 from . import (
     Base,
     flush,
-    get_one_or_create,
+    get_one,
+)
+from ..util.cache import LRUCache
+from ..util.worker_pools import (
+    DatabaseJob,
+    DatabasePool,
 )
 
 import datetime
+import hashlib
 import logging
+import sys
+import time
+import zlib
+from collections import Counter
+from threading import Lock
 from sqlalchemy import (
+    bindparam,
+    event,
+    inspect,
+    Boolean,
     Column,
     DateTime,
+    Float,
     ForeignKey,
     Index,
     Integer,
+    LargeBinary,
     Unicode,
 )
-from sqlalchemy.sql.expression import (
-    and_,
-)
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import defer
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.sql import select
+from sqlalchemy.sql.expression import or_
+from sqlalchemy.sql.functions import func
+
+class FeedCodec(object):
+    """Compresses and decompresses the content of cached feeds.
+
+    NAME is used both to record which codec compressed a feed, and as
+    the value of the Content-Encoding header when the compressed feed
+    is sent to a client as-is.
+    """
+    NAME = None
+
+    @classmethod
+    def compress(cls, data):
+        raise NotImplementedError()
+
+    @classmethod
+    def decompress(cls, data):
+        raise NotImplementedError()
+
+
+class GzipFeedCodec(FeedCodec):
+    """Store feeds in gzip format, which any HTTP client can accept."""
+    NAME = u"gzip"
+
+    # Adding 16 to the window size makes zlib read and write gzip
+    # headers.
+    WBITS = 16 + zlib.MAX_WBITS
+
+    LEVEL = 6
+
+    @classmethod
+    def compress(cls, data):
+        compressor = zlib.compressobj(cls.LEVEL, zlib.DEFLATED, cls.WBITS)
+        return compressor.compress(data) + compressor.flush()
+
+    @classmethod
+    def decompress(cls, data):
+        return zlib.decompress(data, cls.WBITS)
+
+
+class FeedContent(object):
+    """The content of a cached feed, which isn't decompressed until
+    something needs it.
+
+    Code that sends the feed over HTTP can send `compressed` as-is if
+    the client accepts `content_encoding`, and can use `content_hash`
+    as an ETag, without the feed ever being decompressed. Code that
+    needs the feed itself can call unicode() on this object.
+    """
+    def __init__(self, text=None, compressed=None, content_encoding=None,
+                 content_hash=None):
+        self._text = text
+        self.compressed = compressed
+        self.content_encoding = content_encoding
+        self.content_hash = content_hash
+
+    @property
+    def decompressed(self):
+        """Has the feed been decompressed yet?"""
+        return self._text is not None
+
+    @property
+    def text(self):
+        """The feed, as a Unicode string."""
+        if self._text is None and self.compressed is not None:
+            codec = CachedFeed.CODECS[self.content_encoding]
+            self._text = codec.decompress(self.compressed).decode("utf8")
+        return self._text
+
+    def __unicode__(self):
+        return self.text
+
+    def __str__(self):
+        return self.text.encode("utf8")
+
+    def __len__(self):
+        return len(self.text)
+
+    def __contains__(self, value):
+        return value in self.text
+
+    def __eq__(self, other):
+        if isinstance(other, FeedContent):
+            other = other.text
+        return self.text == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.text)
+
+    def __repr__(self):
+        return "<FeedContent %s %s>" % (self.content_encoding, self.content_hash)
+
 
 class CachedFeed(Base):
 
@@ -51,8 +165,24 @@ class CachedFeed(Base):
     # A 'page' feed is associated with a set of values for pagination.
     pagination = Column(Unicode, nullable=False)
 
-    # The content of the feed.
-    content = Column(Unicode, nullable=True)
+    # The uncompressed content of the feed. Only feeds cached before
+    # feeds were compressed will have this; use .content instead.
+    _content = Column('content', Unicode, nullable=True)
+
+    # The content of the feed, compressed by the codec named in
+    # content_encoding.
+    compressed_content = Column(LargeBinary, nullable=True)
+    content_encoding = Column(Unicode, nullable=True)
+
+    # A hash of the uncompressed content, used as an ETag when the
+    # feed is served. Only feeds cached before this was added will
+    # lack one.
+    content_hash = Column(Unicode, nullable=True)
+
+    # A hash of lane_id, unique_key, library_id, work_id, type,
+    # facets and pagination, which uniquely identifies a feed. This is
+    # kept up to date automatically.
+    lookup_key = Column(Unicode, nullable=True)
 
     # Every feed is associated with a Library.
     library_id = Column(
@@ -63,6 +193,19 @@ class CachedFeed(Base):
     work_id = Column(Integer, ForeignKey('works.id'),
         nullable=True, index=True)
 
+    # How many times this feed has been requested. This is updated
+    # periodically rather than on every request; see record_request.
+    request_count = Column(Integer, nullable=True, default=0)
+
+    # How many seconds it took to generate this feed, the last time it
+    # was generated.
+    generation_time = Column(Float, nullable=True)
+
+    # A feed is marked stale when some of the works it might contain
+    # have changed. A stale feed is regenerated even if it hasn't
+    # expired.
+    stale = Column(Boolean, nullable=True, default=False)
+
     GROUPS_TYPE = u'groups'
     PAGE_TYPE = u'page'
     NAVIGATION_TYPE = u'navigation'
@@ -70,75 +213,114 @@ class CachedFeed(Base):
     SERIES_TYPE = u'series'
     CONTRIBUTOR_TYPE = u'contributor'
 
+    # Not a feed at all, but a JSON document containing the number
+    # of works available under each facet of a 'page' feed.
+    FACET_COUNTS_TYPE = u'facet_counts'
+
     log = logging.getLogger("CachedFeed")
 
+    # New feed content is compressed with this codec. Feeds compressed
+    # with any of CODECS can be read.
+    codec = GzipFeedCodec
+    CODECS = {
+        GzipFeedCodec.NAME: GzipFeedCodec,
+    }
+
+    # Separates the values that go into a feed's lookup key.
+    LOOKUP_KEY_SEPARATOR = u"\x1f"
+
+    # The first half of the key used for the Postgres advisory lock
+    # held while a feed is being regenerated. The second half is the
+    # feed's ID.
+    ADVISORY_LOCK_NAMESPACE = 1127
+
+    # This many background threads will regenerate expired feeds.
+    REVALIDATION_POOL_SIZE = 2
+
+    # The pool of threads that regenerates expired feeds. It's created
+    # the first time it's needed.
+    revalidation_pool = None
+
+    # Requests for feeds are counted in memory, and the counts are
+    # written to the database at most this often (in seconds).
+    REQUEST_COUNT_FLUSH_INTERVAL = 60
+
+    # Maps a feed ID to the number of requests for that feed that
+    # haven't been written to the database yet.
+    _request_counts = Counter()
+    _request_counts_flushed = time.time()
+    _request_counts_lock = Lock()
+
+    # The IDs of the feeds this process is currently regenerating.
+    _revalidating = set()
+    _revalidating_lock = Lock()
+
+    # Recently used feed content is kept in memory, up to this many
+    # bytes per process, so it doesn't have to be sent over from the
+    # database every time.
+    MEMORY_CACHE_BYTES = 64 * 1024 * 1024
+
+    # Maps the values that identify a feed to a 3-tuple (feed ID,
+    # timestamp, content).
+    memory_cache = LRUCache(max_bytes=MEMORY_CACHE_BYTES)
+
     @classmethod
     def fetch(cls, _db, lane, type, facets, pagination, annotator,
-              force_refresh=False, max_age=None):
+              force_refresh=False, max_age=None, regenerate=None):
+        """Find or create the CachedFeed for a lane, type, set of facets,
+        and pagination.
+
+        :param regenerate: A callable that takes a database session and
+            regenerates this feed. If this is provided and the feed has
+            expired only recently, the expired feed will be treated
+            as usable and regeneration will be handed to a background
+            thread. See AcquisitionFeed.stale_feed_max_age.
+
+        :return: A 2-tuple (CachedFeed, usable). If `usable` is False,
+            the caller is expected to generate the feed and call update().
+        """
         from ..opds import AcquisitionFeed
         from ..lane import Lane, WorkList
         if max_age is None:
-            if type == cls.GROUPS_TYPE:
-                max_age = AcquisitionFeed.grouped_max_age(_db)
-            elif type == cls.PAGE_TYPE:
-                max_age = AcquisitionFeed.nongrouped_max_age(_db)
-            elif hasattr(lane, 'MAX_CACHE_AGE'):
-                max_age = lane.MAX_CACHE_AGE
-            else:
-                max_age = 0
+            max_age = cls.max_cache_age(_db, lane, type)
         if isinstance(max_age, int):
             max_age = datetime.timedelta(seconds=max_age)
 
-        unique_key = None
-        if lane and isinstance(lane, Lane):
-            lane_id = lane.id
-        else:
-            lane_id = None
-            unique_key = "%s-%s-%s" % (lane.display_name, lane.language_key, lane.audience_key)
-        work = None
-        if lane:
-            work = getattr(lane, 'work', None)
-        library = None
-        if lane and isinstance(lane, Lane):
-            library = lane.library
-        elif lane and isinstance(lane, WorkList):
-            library = lane.get_library(_db)
+        fields = cls.identifying_fields(_db, lane, type, facets, pagination)
+        lookup_key = cls.calculate_lookup_key(**fields)
 
-        if facets:
-            facets_key = unicode(facets.query_string)
-        else:
-            facets_key = u""
+        # If this feed was used recently, we may be able to avoid
+        # loading its content from the database.
+        feed = None
+        if not force_refresh:
+            feed = cls._from_memory(_db, lookup_key)
 
-        if pagination:
-            pagination_key = unicode(pagination.query_string)
+        if feed:
+            is_new = False
         else:
-            pagination_key = u""
-
-        # Get a CachedFeed object. We will either return its .content,
-        # or update its .content.
-        constraint_clause = and_(cls.content!=None, cls.timestamp!=None)
-        feed, is_new = get_one_or_create(
-            _db, cls,
-            on_multiple='interchangeable',
-            constraint=constraint_clause,
-            lane_id=lane_id,
-            unique_key=unique_key,
-            library=library,
-            work=work,
-            type=type,
-            facets=facets_key,
-            pagination=pagination_key)
+            # Get a CachedFeed object. We will either return its .content,
+            # or update its .content.
+            feed, is_new = cls._find_or_create(_db, lookup_key, **fields)
 
         if force_refresh is True:
             # No matter what, we've been directed to treat this
             # cached feed as stale.
+            feed._generation_started = time.time()
             return feed, False
 
+        cls.record_request(_db, feed)
+
         if max_age is AcquisitionFeed.CACHE_FOREVER:
             # This feed is so expensive to generate that it must be cached
             # forever (unless force_refresh is True).
-            if not is_new and feed.content:
+            if not is_new and feed.has_content:
                 # Cacheable!
+                if feed.stale and regenerate:
+                    # Some of the works in this feed have changed.
+                    # Serve the feed while it's regenerated in the
+                    # background.
+                    cls.revalidate(_db, feed, None, regenerate)
+                feed._remember()
                 return feed, True
             else:
                 # We're supposed to generate this feed, but as a group
@@ -164,22 +346,435 @@ class CachedFeed(Base):
             # This feed is cheap enough to generate on the fly.
             cutoff = datetime.datetime.utcnow() - max_age
             fresh = False
-            if feed.timestamp and feed.content:
-                if feed.timestamp >= cutoff:
+            if feed.timestamp and feed.has_content:
+                expired = feed.timestamp < cutoff
+                if not expired and not feed.stale:
                     fresh = True
+                    feed._remember()
+                elif regenerate:
+                    stale_max_age = AcquisitionFeed.stale_feed_max_age(_db)
+                    if (not expired or (
+                            stale_max_age and feed.timestamp >= cutoff
+                            - datetime.timedelta(seconds=stale_max_age)
+                    )):
+                        # Serve the expired or stale feed while a new
+                        # one is generated in the background.
+                        cls.revalidate(_db, feed, max_age, regenerate)
+                        fresh = True
+            if not fresh:
+                feed._generation_started = time.time()
             return feed, fresh
 
         # Either there is no cached feed or it's time to update it.
         return feed, False
 
+    @classmethod
+    def max_cache_age(cls, _db, lane, type):
+        """How long should a feed of the given type be cached?
+
+        :return: A number of seconds, or AcquisitionFeed.CACHE_FOREVER.
+        """
+        from ..opds import AcquisitionFeed
+        if type == cls.GROUPS_TYPE:
+            return AcquisitionFeed.grouped_max_age(_db)
+        elif type in (cls.PAGE_TYPE, cls.FACET_COUNTS_TYPE):
+            return AcquisitionFeed.nongrouped_max_age(_db)
+        elif hasattr(lane, 'MAX_CACHE_AGE'):
+            return lane.MAX_CACHE_AGE
+        return 0
+
+    @classmethod
+    def identifying_fields(cls, _db, lane, type, facets, pagination):
+        """Find the values that identify the feed for a lane, type, set
+        of facets, and pagination.
+
+        :return: A dictionary suitable for passing into
+            calculate_lookup_key().
+        """
+        from ..lane import Lane, WorkList
+        unique_key = None
+        if lane and isinstance(lane, Lane):
+            lane_id = lane.id
+        else:
+            lane_id = None
+            unique_key = "%s-%s-%s" % (lane.display_name, lane.language_key, lane.audience_key)
+        work = None
+        if lane:
+            work = getattr(lane, 'work', None)
+        library = None
+        if lane and isinstance(lane, Lane):
+            library = lane.library
+        elif lane and isinstance(lane, WorkList):
+            library = lane.get_library(_db)
+
+        if facets:
+            facets_key = unicode(facets.query_string)
+        else:
+            facets_key = u""
+
+        if pagination:
+            pagination_key = unicode(pagination.query_string)
+        else:
+            pagination_key = u""
+
+        return dict(
+            lane_id=lane_id,
+            unique_key=unique_key,
+            library_id=library and library.id,
+            work_id=work and work.id,
+            type=type,
+            facets=facets_key,
+            pagination=pagination_key,
+        )
+
+    @classmethod
+    def record_request(cls, _db, feed):
+        """Count a request for a feed.
+
+        The counts are kept in memory and written to the database in
+        bulk every REQUEST_COUNT_FLUSH_INTERVAL seconds.
+        """
+        with cls._request_counts_lock:
+            cls._request_counts[feed.id] += 1
+            now = time.time()
+            if (now - cls._request_counts_flushed
+                < cls.REQUEST_COUNT_FLUSH_INTERVAL):
+                return
+            counts = cls._request_counts
+            cls._request_counts = Counter()
+            cls._request_counts_flushed = now
+        cls.flush_request_counts(_db, counts)
+
+    @classmethod
+    def flush_request_counts(cls, _db, counts=None):
+        """Add request counts to the database.
+
+        :param counts: A Counter mapping feed IDs to the number of
+            new requests for each feed. By default, the counts this
+            process has built up since they were last written are used.
+        """
+        if counts is None:
+            with cls._request_counts_lock:
+                counts = cls._request_counts
+                cls._request_counts = Counter()
+                cls._request_counts_flushed = time.time()
+        if not counts:
+            return
+        table = cls.__table__
+        statement = table.update().where(
+            table.c.id==bindparam('feed_id')
+        ).values(
+            request_count=func.coalesce(table.c.request_count, 0)
+            + bindparam('new_requests')
+        )
+        _db.execute(statement, [
+            dict(feed_id=feed_id, new_requests=count)
+            for feed_id, count in counts.items()
+        ])
+
+    @classmethod
+    def mark_stale(cls, _db, clause):
+        """Mark every cached feed that matches a SQL clause as stale.
+
+        :return: The number of feeds marked stale.
+        """
+        return _db.query(cls).filter(clause).filter(
+            or_(cls.stale==None, cls.stale==False)
+        ).update({cls.stale: True}, synchronize_session=False)
+
+    @classmethod
+    def revalidate(cls, _db, feed, max_age, regenerate, pool=None):
+        """Regenerate an expired feed in a background thread.
+
+        Only one thread in this process will be asked to regenerate a
+        given feed at a time, and that thread will give up if another
+        process is already regenerating it.
+
+        :param max_age: A timedelta. If the feed is newer than this by
+            the time the background thread gets to it, and it hasn't
+            been marked stale, it won't be regenerated. None means the
+            feed never expires.
+        :param regenerate: A callable that takes a database session and
+            regenerates the feed.
+        :param pool: A Pool (or other) object for use in testing
+            environments.
+        :return: True if regeneration was scheduled; False if it was
+            already in progress.
+        """
+        with cls._revalidating_lock:
+            if feed.id in cls._revalidating:
+                return False
+            cls._revalidating.add(feed.id)
+
+        job = CachedFeedRevalidationJob(feed.id, max_age, regenerate)
+        try:
+            if not pool:
+                if not cls.revalidation_pool:
+                    from . import SessionManager
+                    cls.revalidation_pool = DatabasePool(
+                        cls.REVALIDATION_POOL_SIZE,
+                        SessionManager.sessionmaker(session=_db)
+                    )
+                pool = cls.revalidation_pool
+            pool.put(job)
+        except Exception:
+            job.done()
+            raise
+        return True
+
+    @classmethod
+    def lock(cls, _db, feed_id):
+        """Try to take the advisory lock that shows a feed is being
+        regenerated.
+
+        The lock belongs to the current transaction. It's released
+        when that transaction is committed or rolled back, on whatever
+        connection the transaction used, so the regenerated feed
+        should be committed in the same transaction.
+
+        :return: True if the lock was acquired, False if some other
+            database session holds it.
+        """
+        return _db.execute(select([
+            func.pg_try_advisory_xact_lock(
+                cls.ADVISORY_LOCK_NAMESPACE, feed_id
+            )
+        ])).scalar()
+
+    @classmethod
+    def calculate_lookup_key(cls, lane_id, unique_key, library_id, work_id,
+                             type, facets, pagination):
+        """Combine the values that identify a feed into a single
+        fixed-width key.
+
+        This must stay in sync with the SQL that calculated the keys of
+        existing feeds in migration 20181120-add-cachedfeed-lookup-key.
+        """
+        values = []
+        for value in (lane_id, unique_key, library_id, work_id, type,
+                      facets, pagination):
+            if value is None:
+                value = u""
+            elif isinstance(value, str):
+                value = value.decode("utf8")
+            else:
+                value = unicode(value)
+            values.append(value)
+        data = cls.LOOKUP_KEY_SEPARATOR.join(values).encode("utf8")
+        return unicode(hashlib.md5(data).hexdigest())
+
+    @classmethod
+    def calculate_content_hash(cls, content):
+        """Calculate a hash of feed content that will change whenever
+        the content changes.
+        """
+        if isinstance(content, unicode):
+            content = content.encode("utf8")
+        return unicode(hashlib.md5(content).hexdigest())
+
+    @classmethod
+    def _find_or_create(cls, _db, lookup_key, **fields):
+        """Find the CachedFeed with the given lookup key, creating it
+        if necessary.
+
+        If another process creates the same feed at the same time,
+        both processes will end up with the same row.
+
+        :return: A 2-tuple (CachedFeed, is_new)
+        """
+        feed = get_one(_db, cls, lookup_key=lookup_key)
+        if feed:
+            return feed, False
+        insert_statement = insert(cls.__table__).values(
+            lookup_key=lookup_key, **fields
+        ).on_conflict_do_nothing(index_elements=[cls.__table__.c.lookup_key])
+        result = _db.execute(insert_statement)
+        feed = get_one(_db, cls, lookup_key=lookup_key)
+        return feed, result.rowcount == 1
+
+    @property
+    def has_content(self):
+        """Does this feed have any content? Unlike checking .content,
+        this doesn't decompress anything.
+        """
+        return self.compressed_content is not None or bool(self._content)
+
+    @property
+    def content(self):
+        """The content of the feed.
+
+        :return: A FeedContent, which won't be decompressed until it's
+            needed, or None if the feed has no content.
+        """
+        compressed = self.compressed_content
+        if compressed is None:
+            if self._content is None:
+                return None
+            # This feed was stored before feeds were compressed.
+            return FeedContent(self._content)
+
+        # Only create one FeedContent, so the content is only
+        # decompressed once.
+        decompressed = self.__dict__.get('_decompressed')
+        if decompressed and decompressed[0] is compressed:
+            return decompressed[1]
+
+        content = FeedContent(
+            compressed=bytes(compressed),
+            content_encoding=self.content_encoding,
+            content_hash=self.content_hash
+        )
+        self.__dict__['_decompressed'] = (compressed, content)
+        return content
+
+    @content.setter
+    def content(self, value):
+        self._content = None
+        if value is None:
+            self.compressed_content = None
+            self.content_encoding = None
+            self.content_hash = None
+        else:
+            self.content_encoding, self.compressed_content = (
+                self.compress(value)
+            )
+            self.content_hash = self.calculate_content_hash(value)
+            self._prime(value)
+
+    def _prime(self, value):
+        """Remember that `value` is the decompressed form of
+        compressed_content, so it doesn't have to be decompressed again.
+        """
+        if isinstance(value, str):
+            value = value.decode("utf8")
+        content = FeedContent(
+            value, compressed=bytes(self.compressed_content),
+            content_encoding=self.content_encoding,
+            content_hash=self.content_hash
+        )
+        self.__dict__['_decompressed'] = (self.compressed_content, content)
+
+    @classmethod
+    def compress(cls, content):
+        """Compress feed content with the current codec.
+
+        :return: A 2-tuple (content encoding, compressed bytes).
+        """
+        if isinstance(content, unicode):
+            content = content.encode("utf8")
+        return cls.codec.NAME, cls.codec.compress(content)
+
+    @classmethod
+    def _from_memory(cls, _db, memory_key):
+        """Find a feed whose content is cached in memory.
+
+        The content is only used if the feed's timestamp in the
+        database still matches the timestamp of the cached content.
+
+        :return: A CachedFeed, or None if the feed isn't cached in
+            memory or the cached content is out of date.
+        """
+        entry = cls.memory_cache.get(memory_key)
+        if not entry:
+            return None
+        feed_id, timestamp, content = entry
+        feed = _db.query(cls).options(
+            defer(cls._content), defer(cls.compressed_content)
+        ).filter(cls.id==feed_id).first()
+        if not feed or feed.timestamp != timestamp:
+            # The feed was regenerated or deleted.
+            cls.memory_cache.remove(memory_key)
+            return None
+        # Fill in the content without marking the feed as changed.
+        for key, value in zip(('_content', 'compressed_content'), content):
+            if key not in feed.__dict__:
+                set_committed_value(feed, key, value)
+        return feed
+
+    def _remember(self):
+        """Cache this feed's content in memory, in whatever form it's
+        stored in the database.
+        """
+        if (not self.id or not self.lookup_key or not self.timestamp
+            or not self.has_content):
+            return
+        content = (self._content, self.compressed_content)
+        size = sum(sys.getsizeof(x) for x in content if x is not None)
+        self.memory_cache.set(
+            self.lookup_key, (self.id, self.timestamp, content), size=size
+        )
+
+    @classmethod
+    def memory_cache_statistics(cls):
+        """Report on how well the in-memory cache is working."""
+        cache = cls.memory_cache
+        return dict(
+            entries=len(cache),
+            resident_bytes=cache.resident_bytes,
+            hits=cache.hits,
+            misses=cache.misses,
+            hit_ratio=cache.hit_ratio,
+        )
+
     def update(self, _db, content):
-        self.content = content
-        self.timestamp = datetime.datetime.utcnow()
+        timestamp = datetime.datetime.utcnow()
+
+        # If fetch() asked for this feed to be generated, record how
+        # long that took.
+        generation_time = self.generation_time
+        started = self.__dict__.pop('_generation_started', None)
+        if started is not None:
+            generation_time = time.time() - started
+
+        # Make sure the lookup key reflects any changes to this feed.
         flush(_db)
+        if not self.lookup_key or not inspect(self).persistent:
+            self.content = content
+            self.timestamp = timestamp
+            self.generation_time = generation_time
+            self.stale = False
+            flush(_db)
+        else:
+            # Write the content with an upsert, so that if the row has
+            # been deleted in the meantime, it's recreated rather than
+            # lost.
+            content_encoding, compressed_content = self.compress(content)
+            content_hash = self.calculate_content_hash(content)
+            new_values = dict(
+                content=None, compressed_content=compressed_content,
+                content_encoding=content_encoding,
+                content_hash=content_hash, timestamp=timestamp,
+                generation_time=generation_time, stale=False,
+            )
+            fields = dict(
+                (prop.columns[0].name, getattr(self, prop.key))
+                for prop in inspect(self.__class__).column_attrs
+                if prop.key != 'id'
+            )
+            fields.update(new_values)
+            table = self.__table__
+            upsert = insert(table).values(**fields).on_conflict_do_update(
+                index_elements=[table.c.lookup_key], set_=new_values
+            )
+            _db.execute(upsert)
+
+            # The database is now up to date, so this object shouldn't
+            # be considered changed.
+            set_committed_value(self, '_content', None)
+            set_committed_value(self, 'compressed_content', compressed_content)
+            set_committed_value(self, 'content_encoding', content_encoding)
+            set_committed_value(self, 'content_hash', content_hash)
+            set_committed_value(self, 'timestamp', timestamp)
+            set_committed_value(self, 'generation_time', generation_time)
+            set_committed_value(self, 'stale', False)
+            self._prime(content)
+        self._remember()
 
     def __repr__(self):
-        if self.content:
-            length = len(self.content)
+        if self.compressed_content is not None:
+            length = "%d bytes compressed" % len(self.compressed_content)
+        elif self._content:
+            length = len(self._content)
         else:
             length = "No content"
         return "<CachedFeed #%s %s %s %s %s %s %s >" % (
@@ -190,12 +785,50 @@ class CachedFeed(Base):
 
 
 Index(
-    "ix_cachedfeeds_library_id_lane_id_type_facets_pagination",
-    CachedFeed.library_id, CachedFeed.lane_id, CachedFeed.type,
-    CachedFeed.facets, CachedFeed.pagination
+    "ix_cachedfeeds_lookup_key", CachedFeed.lookup_key, unique=True
 )
 
 
+@event.listens_for(CachedFeed, 'before_insert')
+@event.listens_for(CachedFeed, 'before_update')
+def set_lookup_key(mapper, connection, target):
+    target.lookup_key = CachedFeed.calculate_lookup_key(
+        target.lane_id, target.unique_key, target.library_id,
+        target.work_id, target.type, target.facets, target.pagination
+    )
+
+
+class CachedFeedRevalidationJob(DatabaseJob):
+    """Regenerate an expired CachedFeed in a background thread."""
+
+    def __init__(self, feed_id, max_age, regenerate):
+        self.feed_id = feed_id
+        self.max_age = max_age
+        self.regenerate = regenerate
+
+    def done(self):
+        with CachedFeed._revalidating_lock:
+            CachedFeed._revalidating.discard(self.feed_id)
+
+    def do_run(self, _db):
+        # The lock is released when run() commits or rolls back.
+        try:
+            if not CachedFeed.lock(_db, self.feed_id):
+                # Another process is regenerating this feed.
+                return
+            feed = get_one(_db, CachedFeed, id=self.feed_id)
+            if feed and feed.timestamp and not feed.stale and (
+                self.max_age is None or feed.timestamp
+                >= datetime.datetime.utcnow() - self.max_age
+            ):
+                # Someone else regenerated the feed while this job
+                # was waiting.
+                return
+            self.regenerate(_db)
+        finally:
+            self.done()
+
+
 class WillNotGenerateExpensiveFeed(Exception):
     """This exception is raised when a feed is not cached, but it's too
     expensive to generate.
@@ -219,6 +219,10 @@ class Library(Base, HasFullTableCache):
     # 'featured' lanes.
     FEATURED_LANE_SIZE = Configuration.FEATURED_LANE_SIZE
 
+    # Each library may choose to build paginated lane feeds from the
+    # search index rather than the materialized view.
+    WORKS_FROM_SEARCH_INDEX = Configuration.WORKS_FROM_SEARCH_INDEX
+
     @property
     def allow_holds(self):
         """Does this library allow patrons to put items on hold?"""
@@ -245,6 +249,16 @@ class Library(Base, HasFullTableCache):
             value = 15
         return value
 
+    @property
+    def works_from_search_index(self):
+        """Should paginated lane feeds for this library be built from
+        the search index instead of the materialized view?
+        """
+        value = self.setting(self.WORKS_FROM_SEARCH_INDEX).bool_value
+        if value is None:
+            value = False
+        return value
+
     @property
     def entrypoints(self):
         """The EntryPoints enabled for this library."""
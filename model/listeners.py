@@ -285,7 +285,31 @@ def licenses_owned_change(target, value, oldvalue, initiator):
         # The availability of this LicensePool has not changed. No need
         # to reindex anything.
         return
-    work.external_index_needs_updating()
+    work.external_index_availability_needs_updating()
+
+@event.listens_for(LicensePool.licenses_available, 'set',
+                   active_history=True)
+def licenses_available_change(target, value, oldvalue, initiator):
+    """A Work may need to have its search document re-indexed if one of
+    its LicensePools changes the number of licenses_available to or
+    from zero.
+
+    Circulation data is usually updated long after the LicensePool
+    was loaded, so the old value is loaded if necessary rather than
+    being ignored.
+    """
+    work = target.work
+    if not work:
+        return
+    if target.open_access:
+        # For open-access works, the licenses_available value doesn't
+        # matter.
+        return
+    if (value == oldvalue) or (value > 0 and oldvalue > 0):
+        # The availability of this LicensePool has not changed. No need
+        # to reindex anything.
+        return
+    work.external_index_availability_needs_updating()
 
 @event.listens_for(LicensePool.open_access, 'set')
 def licensepool_open_access_change(target, value, oldvalue, initiator):
@@ -1,5 +1,5 @@
 # encoding: utf-8
-# WorkGenre, Work
+# WorkGenre, SearchIndexChange, Work
 from nose.tools import set_trace
 
 from . import (
@@ -87,6 +87,33 @@ class WorkGenre(Base):
     def __repr__(self):
         return "%s (%d%%)" % (self.genre.name, self.affinity*100)
 
+class SearchIndexChange(Base):
+    """A record that something about a Work changed in a way that
+    affects its search document.
+
+    Rows are added to this table whenever a Work is marked as needing
+    reindexing, and removed once the change has made it into the
+    search index. This makes it possible to keep the search index up
+    to date by looking only at the works that changed, rather than
+    sweeping the entire works table.
+    """
+
+    __tablename__ = 'searchindexchanges'
+    id = Column(Integer, primary_key=True)
+    work_id = Column(Integer, ForeignKey('works.id'), index=True,
+                     nullable=False)
+    timestamp = Column(DateTime, default=lambda: datetime.datetime.utcnow())
+
+    # If this is True, only the Work's availability has changed, and
+    # only the parts of its search document that depend on
+    # availability need to be updated.
+    availability_only = Column(Boolean, default=False, nullable=False)
+
+    def __repr__(self):
+        return "<SearchIndexChange #%s: work %s at %s>" % (
+            self.id, self.work_id, self.timestamp
+        )
+
 class Work(Base):
     APPEALS_URI = "http://librarysimplified.org/terms/appeals/"
 
@@ -139,6 +166,12 @@ class Work(Base):
     # One Work may have many associated WorkCoverageRecords.
     coverage_records = relationship("WorkCoverageRecord", backref="work")
 
+    # One Work may have pending changes that haven't made it into the
+    # search index yet.
+    search_index_changes = relationship(
+        "SearchIndexChange", backref="work", cascade="all, delete-orphan"
+    )
+
     # One Work may be associated with many CustomListEntries.
     custom_list_entries = relationship('CustomListEntry', backref='work')
 
@@ -191,6 +224,11 @@ class Work(Base):
     # The last time the availability or metadata changed for this Work.
     last_update_time = Column(DateTime, index=True)
 
+    # A hash of the search document most recently uploaded for this
+    # Work. If a newly generated search document has the same hash,
+    # there's no need to upload it again.
+    search_document_hash = Column(Unicode, default=None)
+
     # This is set to True once all metadata and availability
     # information has been obtained for this Work. Until this is True,
     # the work will not show up in feeds.
@@ -1074,7 +1112,25 @@ class Work(Base):
         """Mark this work as needing to have its search document reindexed.
         This is a more efficient alternative to reindexing immediately,
         since these WorkCoverageRecords are handled in large batches.
+
+        A SearchIndexChange is also recorded, so the work can be found
+        by a Monitor that only looks at works that have changed.
         """
+        SearchIndexChange(work=self)
+        return self._reset_coverage(
+            WorkCoverageRecord.UPDATE_SEARCH_INDEX_OPERATION
+        )
+
+    def external_index_availability_needs_updating(self):
+        """Mark this work as needing to have the availability information
+        in its search document updated.
+
+        This is like external_index_needs_updating(), except that the
+        SearchIndexChange indicates that only the parts of the search
+        document that depend on circulation data need to change, which
+        is much cheaper than rebuilding the whole document.
+        """
+        SearchIndexChange(work=self, availability_only=True)
         return self._reset_coverage(
             WorkCoverageRecord.UPDATE_SEARCH_INDEX_OPERATION
         )
@@ -1290,6 +1346,7 @@ class Work(Base):
              Edition.title,
              Edition.subtitle,
              Edition.series,
+             Edition.series_position,
              Edition.language,
              Edition.sort_title,
              Edition.author,
@@ -1304,6 +1361,8 @@ class Work(Base):
              Work.quality,
              Work.rating,
              Work.popularity,
+             Work.random,
+             Work.last_update_time,
             ],
             Work.id.in_((w.id for w in works))
         ).select_from(
@@ -1352,6 +1411,32 @@ class Work(Base):
         ).alias("collections_subquery")
         collections_json = query_to_json_array(collections)
 
+        # These subqueries get the IDs of collections where the book
+        # is available right now, and collections where it's open
+        # access. They're used to apply the availability and
+        # collection facets.
+        available_collections = select(
+            [LicensePool.collection_id]
+        ).where(
+            and_(
+                LicensePool.work_id==work_id_column,
+                or_(LicensePool.open_access, LicensePool.licenses_available>0)
+            )
+        ).alias("available_collections_subquery")
+        available_collections_json = query_to_json_array(available_collections)
+
+        open_access_collections = select(
+            [LicensePool.collection_id]
+        ).where(
+            and_(
+                LicensePool.work_id==work_id_column,
+                LicensePool.open_access==True
+            )
+        ).alias("open_access_collections_subquery")
+        open_access_collections_json = query_to_json_array(
+            open_access_collections
+        )
+
         # This subquery gets CustomList IDs for all lists
         # that contain the work.
         customlists = select(
@@ -1460,9 +1545,11 @@ class Work(Base):
         # search document.
         search_data = select(
             [works_alias.c.work_id.label("_id"),
+             works_alias.c.work_id,
              works_alias.c.title,
              works_alias.c.subtitle,
              works_alias.c.series,
+             works_alias.c.series_position,
              works_alias.c.language,
              works_alias.c.sort_title,
              works_alias.c.author,
@@ -1485,9 +1572,13 @@ class Work(Base):
              works_alias.c.quality,
              works_alias.c.rating,
              works_alias.c.popularity,
+             works_alias.c.random,
+             works_alias.c.last_update_time,
 
              # Here are all the subqueries.
              collections_json.label("collections"),
+             available_collections_json.label("available_collections"),
+             open_access_collections_json.label("open_access_collections"),
              customlists_json.label("customlists"),
              contributors_json.label("contributors"),
              subjects_json.label("classifications"),
@@ -1509,6 +1600,57 @@ class Work(Base):
         """Generate a search document for this Work."""
         return Work.to_search_documents([self])[0]
 
+    @classmethod
+    def to_search_availability_documents(cls, works):
+        """Generate partial search documents for these Works, containing
+        only the fields that change when circulation data changes.
+
+        This looks only at the Works' LicensePools, so it's much
+        cheaper than to_search_documents().
+
+        :return: A dictionary mapping Work IDs to partial search documents.
+        """
+        from licensing import LicensePool
+        if not works:
+            return {}
+        _db = Session.object_session(works[0])
+
+        fields = ['collections', 'available_collections',
+                  'open_access_collections']
+        documents = dict()
+        for work in works:
+            last_update_time = work.last_update_time
+            if last_update_time:
+                last_update_time = last_update_time.isoformat()
+            document = dict(last_update_time=last_update_time)
+            for field in fields:
+                # As in to_search_documents(), a field with no
+                # collections is null rather than an empty list.
+                document[field] = None
+            documents[work.id] = document
+
+        pools = _db.query(
+            LicensePool.work_id, LicensePool.collection_id,
+            LicensePool.open_access, LicensePool.licenses_owned,
+            LicensePool.licenses_available
+        ).filter(
+            LicensePool.work_id.in_(documents.keys())
+        ).order_by(LicensePool.id)
+
+        for work_id, collection_id, open_access, owned, available in pools:
+            document = documents[work_id]
+            value = dict(collection_id=collection_id)
+            for field, applies in (
+                ('collections', open_access or owned > 0),
+                ('available_collections', open_access or available > 0),
+                ('open_access_collections', open_access),
+            ):
+                if applies:
+                    if document[field] is None:
+                        document[field] = []
+                    document[field].append(value)
+        return documents
+
     def mark_licensepools_as_superceded(self):
         """Make sure that all but the single best open-access LicensePool for
         this Work are superceded. A non-open-access LicensePool should
@@ -7,6 +7,8 @@ from urlparse import urlparse, urljoin
 import copy
 import datetime
 import feedparser
+import flask
+import itertools
 import logging
 import md5
 import os
@@ -33,6 +35,7 @@ from classifier import Classifier
 from entrypoint import EntryPoint
 from facets import FacetConstants
 from model import (
+    get_one,
     BaseMaterializedWork,
     CachedFeed,
     ConfigurationSetting,
@@ -44,18 +47,28 @@ from model import (
     Resource,
     Identifier,
     Edition,
+    Library,
     Measurement,
+    SessionManager,
     Subject,
     Work,
 )
+from monitor import Monitor
 from lane import (
     Facets,
     FacetsWithEntryPoint,
+    FeaturedFacets,
+    KeysetPagination,
     Lane,
     Pagination,
     SearchFacets,
+    SortKeyPagination,
     WorkList,
 )
+from util.worker_pools import (
+    DatabaseJob,
+    DatabasePool,
+)
 from util.opds_writer import (
     AtomFeed,
     OPDSFeed,
@@ -174,6 +187,26 @@ class Annotator(object):
         """
         pass
 
+    def background_factory(self):
+        """Find a way to create an annotator like this one in another
+        thread, using another database session -- to regenerate a
+        cached feed in the background, for instance.
+
+        An annotator may hold on to database objects and collect
+        information as a feed is built, so it can't be shared between
+        threads.
+
+        :return: A callable that takes a database session and returns
+            an annotator, or None if this annotator can't be
+            recreated. A feed whose annotator can't be recreated is
+            always regenerated in the foreground.
+        """
+        if type(self).__init__ is object.__init__:
+            # This annotator takes no arguments, so a new one is just
+            # as good.
+            return lambda _db: type(self)()
+        return None
+
     @classmethod
     def group_uri(cls, work, license_pool, identifier):
         """The URI to be associated with this Work when making it part of
@@ -561,13 +594,19 @@ class AcquisitionFeed(OPDSFeed):
 
     @classmethod
     def groups(cls, _db, title, url, lane, annotator,
-               cache_type=None, force_refresh=False, facets=None):
+               cache_type=None, force_refresh=False, facets=None,
+               feed_content=False):
         """The acquisition feed for 'featured' items from a given lane's
         sublanes, organized into per-lane groups.
 
         :param facets: A GroupsFacet object.
 
-        :return: CachedFeed (if use_cache is True) or unicode
+        :param feed_content: If True, a cached feed is returned as a
+            FeedContent, which feed_response() can send to the client
+            without decompressing it.
+
+        :return: unicode, or a FeedContent if `feed_content` is True
+            and the feed was cached.
         """
         works_and_lanes = None
         if lane.children:
@@ -582,6 +621,10 @@ class AcquisitionFeed(OPDSFeed):
             facets = facets or lane.default_featured_facets(_db)
             if use_cache:
                 cache_type = cache_type or CachedFeed.GROUPS_TYPE
+                regenerate = cls._regenerate_function(
+                    cls.groups, lane, facets, title=title, url=url,
+                    annotator=annotator, cache_type=cache_type,
+                )
                 cached, usable = CachedFeed.fetch(
                     _db,
                     lane=lane,
@@ -590,9 +633,12 @@ class AcquisitionFeed(OPDSFeed):
                     pagination=None,
                     annotator=annotator,
                     force_refresh=force_refresh,
+                    regenerate=regenerate,
                 )
                 if usable:
-                    return cached.content
+                    if feed_content:
+                        return cached.content
+                    return unicode(cached.content)
             works_and_lanes = lane.groups(_db, facets=facets)
 
         if not works_and_lanes:
@@ -616,6 +662,7 @@ class AcquisitionFeed(OPDSFeed):
                 cache_type=cache_type,
                 force_refresh=force_refresh,
                 facets=None,
+                feed_content=feed_content,
             )
             return cached
 
@@ -670,16 +717,27 @@ class AcquisitionFeed(OPDSFeed):
         content = unicode(feed)
         if cached and use_cache:
             cached.update(_db, content)
+            if feed_content:
+                content = cached.content
         return content
 
     @classmethod
     def page(cls, _db, title, url, lane, annotator,
              cache_type=None, facets=None, pagination=None,
-             force_refresh=False
+             force_refresh=False, search_engine=None, feed_content=False
     ):
         """Create a feed representing one page of works from a given lane.
 
-        :return: CachedFeed (if use_cache is True) or unicode
+        :param search_engine: An ExternalSearchIndex. If the library
+            is configured to find the works in its lanes using the
+            search index, this will be used instead of the database.
+
+        :param feed_content: If True, a cached feed is returned as a
+            FeedContent, which feed_response() can send to the client
+            without decompressing it.
+
+        :return: unicode, or a FeedContent if `feed_content` is True
+            and the feed was cached.
         """
         if isinstance(lane, Lane):
             library = lane.library
@@ -694,6 +752,11 @@ class AcquisitionFeed(OPDSFeed):
         use_cache = cache_type != cls.NO_CACHE
         if use_cache:
             cache_type = cache_type or CachedFeed.PAGE_TYPE
+            regenerate = cls._regenerate_function(
+                cls.page, lane, facets, title=title, url=url,
+                annotator=annotator, cache_type=cache_type,
+                pagination=pagination, search_engine=search_engine,
+            )
             cached, usable = CachedFeed.fetch(
                 _db,
                 lane=lane,
@@ -702,17 +765,35 @@ class AcquisitionFeed(OPDSFeed):
                 pagination=pagination,
                 annotator=annotator,
                 force_refresh=force_refresh,
+                regenerate=regenerate,
             )
             if usable:
-                return cached.content
+                if feed_content:
+                    return cached.content
+                return unicode(cached.content)
 
-        works_q = lane.works(_db, facets, pagination)
-        if not works_q:
-            # The Lane believes that creating this feed is a bad idea.
-            works = []
-        else:
-            works = works_q.all()
+        works = None
+        if search_engine and library and library.works_from_search_index:
+            works = lane.works_from_search_index(
+                _db, facets, pagination, search_engine
+            )
+        if works is not None:
             pagination.this_page_size = len(works)
+        else:
+            works_q = lane.works(_db, facets, pagination)
+            if not works_q:
+                # The Lane believes that creating this feed is a bad idea.
+                works = []
+            else:
+                works = works_q.all()
+                last_item = None
+                if works and isinstance(pagination, KeysetPagination):
+                    # The next page will pick up after the last work
+                    # on this page.
+                    last_item = pagination.sort_key(works[-1], facets)
+                pagination.page_loaded(
+                    [x.works_id for x in works], last_item
+                )
         feed = cls(_db, title, url, works, annotator)
 
         entrypoints = facets.selectable_entrypoints(lane)
@@ -749,19 +830,112 @@ class AcquisitionFeed(OPDSFeed):
         content = unicode(feed)
         if cached and use_cache:
             cached.update(_db, content)
+            if feed_content:
+                content = cached.content
         return content
 
+    @classmethod
+    def _regenerate_function(cls, method, lane, facets, annotator,
+                             **kwargs):
+        """Create a function that regenerates a cached feed in some other
+        thread and database session, for use by CachedFeed.fetch().
+
+        Nothing from the current request's database session is used
+        by the function: the lane, the library and the annotator are
+        all recreated in the new session.
+
+        :param method: The method that generates the feed, e.g. page().
+        :param annotator: The annotator for the feed, or the class of
+            annotator to use.
+        :param kwargs: Other arguments to pass into `method`.
+        :return: A function that takes a database session, or None if
+            the feed can't be regenerated outside of this request.
+        """
+        if isinstance(annotator, type):
+            # The feed will create its own annotator.
+            annotator_factory = lambda _db: annotator
+        else:
+            annotator_factory = annotator.background_factory()
+            if annotator_factory is None:
+                return None
+
+        lane_id = None
+        top_level_library_id = None
+        if isinstance(lane, Lane):
+            lane_id = lane.id
+        elif type(lane) is WorkList and lane.library_id is not None:
+            # This is a library's top-level WorkList, which can be
+            # recreated in the new session. Other WorkLists can't.
+            top_level_library_id = lane.library_id
+            top_level_key = (
+                lane.display_name, lane.language_key, lane.audience_key
+            )
+        else:
+            return None
+
+        library = getattr(facets, 'library', None)
+        library_id = None
+        if isinstance(library, Library):
+            library_id = library.id
+
+        # Annotators may need the web application in order to build
+        # URLs.
+        app = None
+        if flask.has_app_context():
+            app = flask.current_app._get_current_object()
+
+        def regenerate(_db):
+            # Database objects belong to the session that loaded
+            # them, so find them again in the new session.
+            if lane_id is not None:
+                new_lane = get_one(_db, Lane, id=lane_id)
+            else:
+                new_lane = WorkList.top_level_for_library(
+                    _db, get_one(_db, Library, id=top_level_library_id)
+                )
+                if (type(new_lane) is not WorkList or (
+                        new_lane.display_name, new_lane.language_key,
+                        new_lane.audience_key) != top_level_key):
+                    # The library's lanes have changed so much that
+                    # this isn't the same feed anymore.
+                    logging.warn(
+                        "Not regenerating top-level feed for library %s: its lanes have changed.",
+                        top_level_library_id
+                    )
+                    return None
+            new_facets = facets
+            if library_id is not None:
+                new_facets = copy.copy(facets)
+                new_facets.library = get_one(_db, Library, id=library_id)
+            new_annotator = annotator_factory(_db)
+            if app is None:
+                return method(
+                    _db, lane=new_lane, facets=new_facets,
+                    annotator=new_annotator, force_refresh=True, **kwargs
+                )
+            with app.app_context():
+                return method(
+                    _db, lane=new_lane, facets=new_facets,
+                    annotator=new_annotator, force_refresh=True, **kwargs
+                )
+        return regenerate
+
     @classmethod
     def from_query(cls, query, _db, feed_name, url, pagination, url_fn, annotator):
         """Build  a feed representing one page of a given list. Currently used for
         creating an OPDS feed for a custom list and not cached.
         """
-        page_of_works = pagination.apply(query)
-        pagination.total_size = int(query.count())
+        # Fetch one extra work to find out whether there's a next
+        # page, rather than counting every work in the query.
+        works = query.offset(pagination.offset).limit(
+            pagination.size + 1
+        ).all()
+        page_of_works = works[:pagination.size]
+        has_next_page = len(works) > pagination.size
 
         feed = cls(_db, feed_name, url, page_of_works, annotator)
 
-        if pagination.total_size > 0 and pagination.has_next_page:
+        if has_next_page:
             OPDSFeed.add_link_to_feed(feed=feed.feed, rel="next", href=url_fn(pagination.next_page.offset))
         if pagination.offset > 0:
             OPDSFeed.add_link_to_feed(feed=feed.feed, rel="first", href=url_fn(pagination.first_page.offset))
@@ -897,7 +1071,15 @@ class AcquisitionFeed(OPDSFeed):
                pagination=None, facets=None, annotator=None
     ):
         facets = facets or SearchFacets()
-        pagination = pagination or Pagination.default()
+
+        # Search results are paged through by sort key if the caller
+        # passes in a SortKeyPagination. If the caller passes in some
+        # other Pagination, they're paged through by offset, since
+        # that's what the caller will know how to read from the 'next'
+        # link.
+        if not pagination:
+            pagination_class = SortKeyPagination.for_search()
+            pagination = pagination_class(size=Pagination.DEFAULT_SIZE)
         results = lane.search(
             _db, query, search_engine, pagination=pagination, facets=facets
         )
@@ -1010,6 +1192,22 @@ class AcquisitionFeed(OPDSFeed):
             value = cls.DEFAULT_GROUPED_MAX_AGE
         return value
 
+    STALE_FEED_MAX_AGE_POLICY = Configuration.STALE_FEED_MAX_AGE_POLICY
+
+    @classmethod
+    def stale_feed_max_age(cls, _db):
+        """How long an expired feed may be served while it's regenerated
+        in the background.
+
+        :return: A number of seconds, or None if expired feeds should
+            not be served at all.
+        """
+        value = ConfigurationSetting.sitewide(
+            _db, cls.STALE_FEED_MAX_AGE_POLICY).int_value
+        if not value or value < 0:
+            return None
+        return value
+
     @classmethod
     def nongrouped_max_age(cls, _db):
         "The maximum cache time for a non-grouped acquisition feed."
@@ -1025,9 +1223,14 @@ class AcquisitionFeed(OPDSFeed):
         return value
 
     def __init__(self, _db, title, url, works, annotator=None,
-                 precomposed_entries=[]):
+                 precomposed_entries=[], defer_entries=False):
         """Turn a list of works, messages, and precomposed <opds> entries
         into a feed.
+
+        :param defer_entries: If True, entries won't be created until
+            the feed is serialized with stream(). Each entry can then
+            be sent as soon as it's created, instead of the whole
+            feed being built in memory first.
         """
         if not annotator:
             annotator = Annotator
@@ -1037,6 +1240,11 @@ class AcquisitionFeed(OPDSFeed):
 
         super(AcquisitionFeed, self).__init__(title, url)
 
+        self.deferred_entries = ()
+        if defer_entries:
+            self.deferred_entries = self.entries(works, precomposed_entries)
+            return
+
         for work in works:
             self.add_entry(work)
 
@@ -1046,6 +1254,38 @@ class AcquisitionFeed(OPDSFeed):
                 entry = entry.tag
             self.feed.append(entry)
 
+    def entries(self, works, precomposed_entries=[]):
+        """Create <entry> tags for works, followed by any precomposed
+        entries and messages, one at a time.
+        """
+        for work in works:
+            entry = self.create_entry(work)
+            if entry is None:
+                continue
+            if isinstance(entry, OPDSMessage):
+                entry = entry.tag
+            yield entry
+
+        for entry in precomposed_entries:
+            if isinstance(entry, OPDSMessage):
+                entry = entry.tag
+            yield entry
+
+    def stream(self, entries=()):
+        """Serialize this feed a piece at a time, creating any deferred
+        entries along the way.
+        """
+        deferred = self.deferred_entries
+        self.deferred_entries = ()
+        return super(AcquisitionFeed, self).stream(
+            itertools.chain(deferred, entries)
+        )
+
+    def __unicode__(self):
+        if self.deferred_entries:
+            return "".join(self.stream())
+        return super(AcquisitionFeed, self).__unicode__()
+
     def add_entry(self, work):
         """Attempt to create an OPDS <entry>. If successful, append it to
         the feed.
@@ -1654,8 +1894,14 @@ class NavigationFeed(OPDSFeed):
 
     @classmethod
     def navigation(cls, _db, title, url, lane, annotator,
-                   cache_type=None, force_refresh=False, facets=None):
-        """The navigation feed with links to a given lane's sublanes."""
+                   cache_type=None, force_refresh=False, facets=None,
+                   feed_content=False):
+        """The navigation feed with links to a given lane's sublanes.
+
+        :param feed_content: If True, a cached feed is returned as a
+            FeedContent, which feed_response() can send to the client
+            without decompressing it.
+        """
 
         if not annotator:
             annotator = Annotator
@@ -1676,7 +1922,9 @@ class NavigationFeed(OPDSFeed):
                 force_refresh=force_refresh,
             )
             if usable:
-                return cached.content
+                if feed_content:
+                    return cached.content
+                return unicode(cached.content)
 
         feed = NavigationFeed(title, url)
 
@@ -1701,6 +1949,8 @@ class NavigationFeed(OPDSFeed):
         content = unicode(feed)
         if cached and use_cache:
             cached.update(_db, content)
+            if feed_content:
+                content = cached.content
         return content
 
     def add_entry(self, url, title, type=OPDSFeed.NAVIGATION_FEED_TYPE):
@@ -1712,6 +1962,311 @@ class NavigationFeed(OPDSFeed):
         self.feed.append(entry)
 
 
+class FeedPrewarmJob(DatabaseJob):
+    """Regenerate one grouped or paginated feed in a worker thread."""
+
+    log = logging.getLogger("Feed prewarmer")
+
+    def __init__(self, library_id, lane_id, type, entrypoint,
+                 annotator_factory):
+        """Constructor.
+
+        :param lane_id: The ID of the Lane whose feed should be
+            regenerated, or None for the library's top-level WorkList.
+        :param type: CachedFeed.GROUPS_TYPE or CachedFeed.PAGE_TYPE.
+        :param entrypoint: The internal name of an EntryPoint, or None.
+        :param annotator_factory: A callable that takes the job's
+            database session and returns the annotator (or class of
+            annotator) to use for the feed.
+        """
+        self.library_id = library_id
+        self.lane_id = lane_id
+        self.type = type
+        self.entrypoint = entrypoint
+        self.annotator_factory = annotator_factory
+
+        # These are filled in by FeedPrewarmMonitor.
+        self.lookup_key = None
+        self.depth = 0
+        self.feed_id = None
+        self.timestamp = None
+        self.stale = False
+        self.request_count = 0
+
+        # How long it took to regenerate the feed, in seconds.
+        self.elapsed = None
+
+    def __repr__(self):
+        return "<FeedPrewarmJob %s library=%s lane=%s entrypoint=%s>" % (
+            self.type, self.library_id, self.lane_id, self.entrypoint
+        )
+
+    def worklist(self, _db, library):
+        if self.lane_id is None:
+            return WorkList.top_level_for_library(_db, library)
+        return get_one(_db, Lane, id=self.lane_id)
+
+    def facets(self, library, worklist):
+        """Create the faceting object a patron would get by default,
+        having chosen this job's EntryPoint.
+        """
+        arguments = dict()
+        if self.entrypoint:
+            arguments[Facets.ENTRY_POINT_FACET_GROUP_NAME] = self.entrypoint
+        get_argument = arguments.get
+        get_header = dict().get
+        if self.type == CachedFeed.GROUPS_TYPE:
+            return FeaturedFacets.from_request(
+                library, library, get_argument, get_header, worklist,
+                minimum_featured_quality=library.minimum_featured_quality,
+                uses_customlists=worklist.uses_customlists
+            )
+        return Facets.from_request(
+            library, library, get_argument, get_header, worklist
+        )
+
+    def pagination(self):
+        if self.type == CachedFeed.GROUPS_TYPE:
+            return None
+        return Pagination.default()
+
+    def do_run(self, _db):
+        # Any lock taken here is released when run() commits or rolls
+        # back.
+        if self.feed_id:
+            if not CachedFeed.lock(_db, self.feed_id):
+                # Another process is regenerating this feed.
+                return
+            timestamp = _db.query(CachedFeed.timestamp).filter(
+                CachedFeed.id==self.feed_id
+            ).scalar()
+            if timestamp != self.timestamp:
+                # The feed was regenerated (or deleted) after the
+                # monitor decided it needed regenerating.
+                return
+        start = time.time()
+        self.generate(_db)
+        self.elapsed = time.time() - start
+        self.log.info("Regenerated %r in %.2f sec.", self, self.elapsed)
+
+    def generate(self, _db):
+        library = get_one(_db, Library, id=self.library_id)
+        worklist = self.worklist(_db, library)
+        facets = self.facets(library, worklist)
+        pagination = self.pagination()
+        # Annotators collect information as a feed is built, so every
+        # job gets its own.
+        annotator = self.annotator_factory(_db)
+        title = worklist.display_name
+        if self.type == CachedFeed.GROUPS_TYPE:
+            url = annotator.groups_url(worklist, facets)
+            return AcquisitionFeed.groups(
+                _db, title, url, worklist, annotator, facets=facets,
+                force_refresh=True
+            )
+        url = annotator.feed_url(worklist, facets, pagination)
+        return AcquisitionFeed.page(
+            _db, title, url, worklist, annotator, facets=facets,
+            pagination=pagination, force_refresh=True
+        )
+
+
+class FeedPrewarmMonitor(Monitor):
+    """Regenerate the feeds patrons see first, shortly before they
+    expire, so that patrons don't have to wait while they're generated.
+
+    For every library, this covers the grouped feed for every visible
+    WorkList that has visible children, and the first page of every
+    visible WorkList without children, under each enabled EntryPoint.
+    The first page of a WorkList that does have children is only kept
+    up to date once someone has asked for it.
+
+    Subclasses must define ANNOTATOR, or an annotator must be passed
+    into the constructor. Feeds are regenerated in worker threads, so
+    an annotator instance must be able to create copies of itself
+    through Annotator.background_factory().
+    """
+    SERVICE_NAME = "Feed Prewarmer"
+    INTERVAL_SECONDS = 60
+
+    # The Annotator used to generate feeds.
+    ANNOTATOR = None
+
+    # A feed is regenerated once it's this close to expiring. This
+    # needs to be longer than INTERVAL_SECONDS, or the feed may expire
+    # between one run and the next.
+    LEAD_TIME = datetime.timedelta(seconds=INTERVAL_SECONDS * 3)
+
+    # This many feeds are regenerated at once.
+    DEFAULT_WORKERS = 4
+
+    def __init__(self, _db, annotator=None, workers=None, pool=None,
+                 **kwargs):
+        """Constructor.
+
+        :param workers: Regenerate this many feeds at once, each in
+            its own database session.
+        :param pool: A DatabasePool (or other) object for use in
+            testing environments.
+        """
+        super(FeedPrewarmMonitor, self).__init__(_db, **kwargs)
+        annotator = annotator or self.ANNOTATOR
+        if not annotator:
+            raise ValueError(
+                "%s must define ANNOTATOR." % self.__class__.__name__
+            )
+        if isinstance(annotator, type):
+            # The feed will create its own annotator.
+            self.annotator_factory = lambda _db: annotator
+        else:
+            self.annotator_factory = annotator.background_factory()
+            if self.annotator_factory is None:
+                raise ValueError(
+                    "%r can't be recreated in a worker thread." % annotator
+                )
+        if workers is None:
+            workers = self.DEFAULT_WORKERS
+        self.workers = workers
+        self.pool = pool
+
+    def run_once(self, start, cutoff):
+        jobs = self.due(cutoff)
+        if not jobs:
+            return
+        self.log.info("Regenerating %d feed(s).", len(jobs))
+
+        # The jobs may run in other sessions, which could be blocked
+        # by this one.
+        self._db.commit()
+        if self.workers > 1 or self.pool:
+            session_factory = SessionManager.sessionmaker(session=self._db)
+            pool = self.pool or DatabasePool(self.workers, session_factory)
+            with pool as job_queue:
+                for job in jobs:
+                    job_queue.put(job)
+        else:
+            for job in jobs:
+                try:
+                    job.run(self._db)
+                except Exception, e:
+                    self.log.error(
+                        "Error regenerating %r", job, exc_info=e
+                    )
+
+        timings = [job.elapsed for job in jobs if job.elapsed is not None]
+        if timings:
+            self.log.info(
+                "Regenerated %d feed(s) in %.2f sec; the slowest took %.2f sec.",
+                len(timings), sum(timings), max(timings)
+            )
+
+    def due(self, now):
+        """Find the feeds that need to be regenerated.
+
+        :return: A list of FeedPrewarmJobs, the most frequently
+            requested feeds first.
+        """
+        candidates = []
+        for library in self._db.query(Library):
+            candidates.extend(self.candidates(library))
+        if not candidates:
+            return []
+
+        by_key = dict(
+            (job.lookup_key, job) for job, max_age, required in candidates
+        )
+        qu = self._db.query(
+            CachedFeed.lookup_key, CachedFeed.id, CachedFeed.timestamp,
+            CachedFeed.stale, CachedFeed.request_count
+        ).filter(CachedFeed.lookup_key.in_(by_key.keys()))
+        for lookup_key, feed_id, timestamp, stale, request_count in qu:
+            job = by_key[lookup_key]
+            job.feed_id = feed_id
+            job.timestamp = timestamp
+            job.stale = bool(stale)
+            job.request_count = request_count or 0
+
+        due = []
+        for job, max_age, required in candidates:
+            if not required and not job.feed_id:
+                # Nobody has asked for this feed yet.
+                continue
+            if self.is_due(job.timestamp, max_age, now, job.stale):
+                due.append(job)
+
+        # Busy feeds come first; among feeds that haven't been
+        # requested, feeds closer to the top level come first.
+        due.sort(key=lambda job: (-job.request_count, job.depth))
+        return due
+
+    def is_due(self, timestamp, max_age, now, stale=False):
+        """Should a feed with the given timestamp be regenerated?
+
+        :param max_age: A number of seconds, or
+            AcquisitionFeed.CACHE_FOREVER.
+        :param stale: Whether the feed has been marked stale.
+        """
+        if stale and timestamp is not None:
+            # Some of the works in this feed have changed.
+            return True
+        if max_age is AcquisitionFeed.CACHE_FOREVER:
+            # This feed never expires, but if there's no copy of it,
+            # patrons will get a less useful feed instead.
+            return timestamp is None
+        if not max_age:
+            # This feed isn't cached at all.
+            return False
+        if timestamp is None:
+            return True
+        expires = timestamp + datetime.timedelta(seconds=max_age)
+        return expires - self.LEAD_TIME <= now
+
+    def candidates(self, library):
+        """Find every feed in a library that might need regenerating.
+
+        :yield: A 3-tuple (FeedPrewarmJob, max age, required) for each
+            feed. If `required` is False, the feed should only be
+            regenerated if it's been cached before.
+        """
+        entrypoints = [x.INTERNAL_NAME for x in library.entrypoints] or [None]
+        for worklist, depth in self.worklists(library):
+            lane_id = None
+            if isinstance(worklist, Lane):
+                lane_id = worklist.id
+            has_children = worklist.has_visible_children
+            feeds = [(CachedFeed.PAGE_TYPE, not has_children)]
+            if has_children:
+                feeds.insert(0, (CachedFeed.GROUPS_TYPE, True))
+            for type, required in feeds:
+                max_age = CachedFeed.max_cache_age(self._db, worklist, type)
+                for entrypoint in entrypoints:
+                    job = FeedPrewarmJob(
+                        library.id, lane_id, type, entrypoint,
+                        self.annotator_factory
+                    )
+                    fields = CachedFeed.identifying_fields(
+                        self._db, worklist, type,
+                        job.facets(library, worklist), job.pagination()
+                    )
+                    job.lookup_key = CachedFeed.calculate_lookup_key(**fields)
+                    job.depth = depth
+                    yield job, max_age, required
+
+    def worklists(self, library):
+        """Yield a 2-tuple (WorkList, depth) for every visible WorkList
+        in a library, starting at the top level.
+        """
+        queue = [WorkList.top_level_for_library(self._db, library)]
+        depth = 0
+        while queue:
+            new_queue = []
+            for worklist in queue:
+                yield worklist, depth
+                new_queue.extend(worklist.visible_children)
+            queue = new_queue
+            depth += 1
+
+
 # Mock annotators for use in unit tests.
 
 class TestAnnotator(Annotator):
@@ -1719,6 +2274,9 @@ class TestAnnotator(Annotator):
     def __init__(self):
         self.lanes_by_work = defaultdict(list)
 
+    def background_factory(self):
+        return lambda _db: type(self)()
+
     @classmethod
     def lane_url(cls, lane):
         if lane and lane.has_visible_children:
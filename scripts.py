@@ -21,9 +21,13 @@ import unicodedata
 from collections import defaultdict
 from external_search import (
     ExternalSearchIndex,
+    ExternalSearchIndexVersions,
+    Filter,
+    Query,
     SearchIndexMonitor,
 )
 import json
+import multiprocessing
 from nose.tools import set_trace
 from sqlalchemy import (
     create_engine,
@@ -102,6 +106,7 @@ from util.personal_names import (
     is_corporate_name
 )
 from util.worker_pools import (
+    DatabaseJob,
     DatabaseWorker,
     DatabasePool,
 )
@@ -287,11 +292,277 @@ class UpdateSearchIndexScript(RunMonitorScript):
             '--works-index',
             help='The ElasticSearch index to update, if other than the default.'
         )
+        parser.add_argument(
+            '--force',
+            help="Upload every search document, even ones that haven't changed since they were last uploaded.",
+            action='store_true'
+        )
         parsed = parser.parse_args()
 
         super(UpdateSearchIndexScript, self).__init__(
             SearchIndexMonitor,
             index_name=parsed.works_index,
+            force=parsed.force,
+        )
+
+
+class RebuildSearchIndexScript(Script):
+    """Build a new version of the search index from scratch, using
+    several worker processes, and then point the -current alias at it.
+
+    Searches keep running against the old index until the new one has
+    been built and checked.
+    """
+
+    name = "Rebuild search index"
+
+    DEFAULT_WORKERS = 4
+
+    @classmethod
+    def arg_parser(cls):
+        parser = argparse.ArgumentParser()
+        parser.add_argument(
+            '--workers', type=int, default=cls.DEFAULT_WORKERS,
+            help='Number of worker processes. Each one indexes a separate range of works.'
+        )
+        parser.add_argument(
+            '--version',
+            help='Index version to build (e.g. "v3"). Defaults to the latest version.'
+        )
+        parser.add_argument(
+            '--batch-size', type=int,
+            help='Number of works each worker process loads from the database at once.'
+        )
+        parser.add_argument(
+            '--tolerance', type=float, default=0,
+            help='Swap the alias even if this fraction of presentation-ready works is missing from the new index.'
+        )
+        parser.add_argument(
+            '--no-swap', action='store_true',
+            help="Build the new index, but don't point the -current alias at it."
+        )
+        return parser
+
+    def __init__(self, _db=None, search_index_client=None):
+        super(RebuildSearchIndexScript, self).__init__(_db)
+        self.search = search_index_client or ExternalSearchIndex(self._db)
+
+    @classmethod
+    def slices(cls, min_id, max_id, workers):
+        """Divide a range of work IDs into `workers` disjoint ranges.
+
+        :return: A list of 2-tuples (lower, upper). Both bounds are
+            inclusive.
+        """
+        if min_id is None or max_id is None:
+            return []
+        workers = max(1, workers)
+        size = max(1, (max_id - min_id + workers) // workers)
+        slices = []
+        lower = min_id
+        while lower <= max_id:
+            upper = min(lower + size - 1, max_id)
+            slices.append((lower, upper))
+            lower = upper + 1
+        return slices
+
+    def do_run(self, cmd_args=None):
+        parsed = self.parse_command_line(self._db, cmd_args=cmd_args)
+        search = self.search
+        version = parsed.version or ExternalSearchIndexVersions.latest()
+        if not version.startswith('v'):
+            version = 'v' + version
+        base_name = search.base_index_name(search.works_index)
+        new_index = base_name + '-' + version
+
+        if search.alias_points_to(self._db, new_index):
+            self.log.error(
+                "%s is already in use for searches; choose a different version.",
+                new_index
+            )
+            return
+
+        if ExternalSearchIndexVersions.create_new_version(
+            search, base_name, version
+        ):
+            self.log.info("Created index %s.", new_index)
+        else:
+            self.log.info(
+                "Index %s already exists; resuming the build.", new_index
+            )
+
+        [(min_id, max_id)] = self._db.query(
+            func.min(Work.id), func.max(Work.id)
+        ).all()
+        slices = self.slices(min_id, max_id, parsed.workers)
+        # The worker processes need to see everything we know.
+        self._db.commit()
+
+        a = time.time()
+        original_settings = search.start_bulk_load(new_index)
+        try:
+            failed = self.run_workers(new_index, slices, parsed.batch_size)
+        finally:
+            search.finish_bulk_load(new_index, original_settings)
+        b = time.time()
+        self.log.info(
+            "Indexed %d slice(s) of works in %.2f sec.", len(slices), b-a
+        )
+
+        if failed:
+            self.log.error(
+                "Could not index works in these ranges: %r. Not switching to %s.",
+                failed, new_index
+            )
+            return
+
+        expected = self._db.query(Work).filter(
+            Work.presentation_ready==True
+        ).count()
+        actual = search.count_documents(new_index)
+        self.log.info(
+            "%s contains %d documents; %d works are presentation-ready.",
+            new_index, actual, expected
+        )
+        if actual < expected * (1 - parsed.tolerance):
+            self.log.error(
+                "Too many works are missing from %s. Not switching to it.",
+                new_index
+            )
+            return
+
+        if parsed.no_swap:
+            return
+        search.transfer_current_alias(self._db, new_index)
+        self.log.info("Searches now use %s.", new_index)
+
+    def run_workers(self, index_name, slices, batch_size):
+        """Index each slice of the works table in its own process.
+
+        :return: A list of the slices that could not be indexed.
+        """
+        processes = []
+        for id_range in slices:
+            process = multiprocessing.Process(
+                target=self.index_slice_in_new_process,
+                args=(index_name, id_range, batch_size)
+            )
+            process.start()
+            processes.append((id_range, process))
+
+        failed = []
+        for id_range, process in processes:
+            process.join()
+            if process.exitcode != 0:
+                failed.append(id_range)
+        return failed
+
+    def index_slice_in_new_process(self, index_name, id_range, batch_size):
+        """Set up a worker process with its own database and
+        Elasticsearch connections, then index one slice of works.
+        """
+        # Connections inherited from the parent process can't be
+        # shared with it, so forget about them and open new ones.
+        SessionManager.engine_for_url.clear()
+        ExternalSearchIndex.reset()
+        _db = production_session()
+        search = ExternalSearchIndex(_db)
+        search.works_index = index_name
+        if not self.index_slice(_db, search, id_range, batch_size):
+            sys.exit(1)
+
+    def index_slice(self, _db, search, id_range, batch_size):
+        """Index the works in one slice of the works table.
+
+        :return: True if every batch of works was processed.
+        """
+        monitor = SearchIndexMonitor(
+            _db, None, index_client=search, id_range=id_range,
+            batch_size=batch_size
+        )
+        monitor.run()
+        return monitor.completed
+
+
+class SearchQueryBenchmarkScript(Script):
+    """Measure the CPU time needed to turn search query strings into
+    Elasticsearch queries, with and without the query template cache.
+
+    This doesn't talk to the database or to Elasticsearch.
+    """
+
+    name = "Benchmark search query construction"
+
+    DEFAULT_CORPUS = os.path.join(
+        os.path.split(__file__)[0], "resources", "search_queries.txt"
+    )
+
+    @classmethod
+    def arg_parser(cls):
+        parser = argparse.ArgumentParser()
+        parser.add_argument(
+            '--corpus', default=cls.DEFAULT_CORPUS,
+            help='A file containing one search query string per line.'
+        )
+        parser.add_argument(
+            '--repetitions', type=int, default=10,
+            help='Build the query for each string this many times.'
+        )
+        return parser
+
+    class UncachedQuery(Query):
+        """A Query that builds its template from scratch every time."""
+        def template(self):
+            return self.query()
+
+    def __init__(self, _db=None, output=None):
+        super(SearchQueryBenchmarkScript, self).__init__(_db)
+        self.output = output or sys.stdout
+
+    def run(self, cmd_args=None):
+        # There's no need to load configuration from the database.
+        self.do_run(cmd_args=cmd_args)
+
+    def do_run(self, cmd_args=None):
+        parsed = self.parse_command_line(cmd_args=cmd_args)
+        query_strings = [
+            x.strip() for x in open(parsed.corpus) if x.strip()
+        ]
+        # Every search is filtered, so build a typical filter as part
+        # of each request.
+        def make_filter():
+            return Filter(
+                collections=[1, 2], media=[Edition.BOOK_MEDIUM],
+                languages=['eng'], audiences=['Adult', 'Young Adult']
+            )
+
+        def measure(query_class):
+            start = time.clock()
+            for i in range(parsed.repetitions):
+                for query_string in query_strings:
+                    query_class(query_string, make_filter()).build()
+            return (time.clock() - start) / (
+                len(query_strings) * parsed.repetitions
+            )
+
+        uncached = measure(self.UncachedQuery)
+
+        # Fill the cache so we only measure cache hits.
+        Query.TEMPLATE_CACHE.clear()
+        for query_string in query_strings:
+            Query(query_string).template()
+        cached = measure(Query)
+
+        self.output.write(
+            "%d query strings, %d repetitions each.\n" % (
+                len(query_strings), parsed.repetitions
+            )
+        )
+        self.output.write(
+            "Without template cache: %.3f ms CPU per query\n" % (uncached*1000)
+        )
+        self.output.write(
+            "With template cache: %.3f ms CPU per query\n" % (cached*1000)
         )
 
 
@@ -1913,9 +2184,31 @@ class MirrorResourcesScript(CollectionInputScript):
         )
 
 
+class UpdateLaneSizesJob(DatabaseJob):
+    """Recalculate the sizes of one library's lanes in a worker thread."""
+
+    def __init__(self, library_id, statistics=None, force=False):
+        self.library_id = library_id
+        self.statistics = statistics
+        self.force = force
+
+    def do_run(self, _db):
+        lanes = _db.query(Lane).filter(Lane.library_id==self.library_id)
+        Lane.update_sizes(
+            _db, lanes.all(), force=self.force, statistics=self.statistics
+        )
+
+
 class RefreshMaterializedViewsScript(Script):
     """Refresh all materialized views."""
 
+    # The Timestamp for this service records the last time cached
+    # feeds were checked for works and lists that had changed.
+    INVALIDATION_SERVICE_NAME = "Cached feed invalidation"
+
+    # Look for the lanes affected by this many changed works at once.
+    INVALIDATION_BATCH_SIZE = 1000
+
     @classmethod
     def arg_parser(cls):
         parser = argparse.ArgumentParser()
@@ -1924,6 +2217,16 @@ class RefreshMaterializedViewsScript(Script):
             help="Provide this argument if you're on an older version of Postgres and can't refresh materialized views concurrently.",
             action='store_true',
         )
+        parser.add_argument(
+            '--lane-size-workers',
+            help="Recalculate lane sizes for this many libraries at once.",
+            type=int, default=1,
+        )
+        parser.add_argument(
+            '--recalculate-all-lane-sizes',
+            help="Recalculate the size of every lane, even lanes that don't seem to have changed.",
+            action='store_true',
+        )
         return parser
 
     def do_run(self):
@@ -1940,6 +2243,18 @@ class RefreshMaterializedViewsScript(Script):
         # the end, to recalculate the sizes of lanes.
         db = self._db
 
+        # Find the works and lists that changed since the last
+        # refresh. A changed work may be about to leave some lanes, so
+        # note which lanes it's in before the refresh as well as after.
+        since = Timestamp.value(db, self.INVALIDATION_SERVICE_NAME, None)
+        cutoff = datetime.datetime.utcnow()
+        work_ids = customlists = None
+        lanes_before = set()
+        if since:
+            work_ids, customlists = self.changes(since, cutoff)
+            lanes_before = self.lanes_affected_by_works(work_ids)
+        db.commit()
+
         url = Configuration.database_url()
         engine = create_engine(url, isolation_level="AUTOCOMMIT")
         engine.autocommit = True
@@ -1962,14 +2277,116 @@ class RefreshMaterializedViewsScript(Script):
             self.log.info("%s vacuumed in %.2f sec", view_name, b-a)
 
         # Recalculate the sizes of lanes.
-        for lane in db.query(Lane):
-            lane.update_size(db)
-            self.log.info(
-                "Size of lane %s calculated as %s",
-                lane.full_identifier, lane.size
+        a = time.time()
+        self.update_lane_sizes(
+            args.lane_size_workers, args.recalculate_all_lane_sizes
+        )
+        b = time.time()
+        self.log.info("Lane sizes recalculated in %.2f sec.", b-a)
+
+        if since:
+            self.invalidate_cached_feeds(work_ids, customlists, lanes_before)
+        Timestamp.stamp(db, self.INVALIDATION_SERVICE_NAME, None, cutoff)
+
+    def changes(self, since, cutoff):
+        """Find the Works and CustomLists that changed during the
+        given period.
+
+        :return: A 2-tuple (list of Work IDs, list of CustomLists).
+        """
+        work_ids = [
+            work_id for work_id, in self._db.query(Work.id).filter(
+                Work.last_update_time >= since
+            ).filter(
+                Work.last_update_time < cutoff
+            )
+        ]
+        customlists = self._db.query(CustomList).filter(
+            CustomList.updated >= since
+        ).filter(
+            CustomList.updated < cutoff
+        ).all()
+        return work_ids, customlists
+
+    def lanes_affected_by_works(self, work_ids):
+        """Find the Lanes that contain any of the given Works."""
+        affected = set()
+        if not work_ids:
+            return affected
+        lanes = self._db.query(Lane).all()
+        batch_size = self.INVALIDATION_BATCH_SIZE
+        for start in range(0, len(work_ids), batch_size):
+            affected |= Lane.affected_by_works(
+                self._db, work_ids[start:start+batch_size], lanes
             )
+        return affected
+
+    def invalidate_cached_feeds(self, work_ids, customlists,
+                                lanes_before=None):
+        """Mark stale the cached feeds affected by changes to the given
+        Works and CustomLists.
+
+        :param lanes_before: The Lanes that contained any of the Works
+            before the materialized views were refreshed.
+        """
+        db = self._db
+        lanes = self.lanes_affected_by_works(work_ids)
+        lanes |= set(lanes_before or [])
+        count = Lane.invalidate_cached_feeds(db, lanes, work_ids)
+
+        # Any change to a list may change every work it features.
+        list_lanes = set()
+        for customlist in customlists:
+            list_lanes.update(Lane.affected_by_customlist(customlist))
+        if list_lanes:
+            count += Lane.invalidate_cached_feeds(db, list_lanes)
+
+        self.log.info(
+            "%d work(s) and %d list(s) changed; marked %d cached feed(s) stale.",
+            len(work_ids), len(customlists), count
+        )
         db.commit()
 
+    def update_lane_sizes(self, workers=1, force=False, pool=None):
+        """Recalculate the sizes of every library's lanes.
+
+        :param workers: If this is more than one, the libraries will
+            be handled in parallel by a pool of worker threads, each
+            with its own database session.
+        :param force: Recalculate lane sizes even if nothing seems
+            to have changed.
+        :param pool: A DatabasePool (or other) object for use in testing
+            environments.
+        """
+        db = self._db
+        statistics = None
+        if not force:
+            # The materialized view only needs to be summarized once,
+            # no matter how many libraries there are.
+            statistics = Lane.size_statistics(db)
+
+        if workers > 1 or pool:
+            library_ids = [x for x, in db.query(Library.id)]
+            session_factory = SessionManager.sessionmaker(session=db)
+            # Without a commit, the worker sessions could be blocked
+            # by this one.
+            db.commit()
+            with (pool or DatabasePool(workers, session_factory)) as jobs:
+                for library_id in library_ids:
+                    jobs.put(UpdateLaneSizesJob(library_id, statistics, force))
+            return
+
+        for library in db.query(Library):
+            updated = Lane.update_sizes(
+                db, library.lanes, force=force, statistics=statistics
+            )
+            for lane in updated:
+                self.log.info(
+                    "Size of lane %s calculated as %s",
+                    lane.full_identifier, lane.size
+                )
+            db.commit()
+
 
 class DatabaseMigrationScript(Script):
     """Runs new migrations.
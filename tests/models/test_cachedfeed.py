@@ -1,9 +1,13 @@
 # encoding: utf-8
 from nose.tools import (
+    assert_raises,
     eq_,
     set_trace,
 )
 import datetime
+import time
+from collections import Counter
+from sqlalchemy.orm.session import Session
 from .. import DatabaseTest
 from ...classifier import Classifier
 from ...lane import (
@@ -11,7 +15,19 @@ from ...lane import (
     Pagination,
     WorkList,
 )
-from ...model.cachedfeed import CachedFeed
+from ...config import Configuration
+from ...opds import AcquisitionFeed
+from ...model import (
+    create,
+    ConfigurationSetting,
+)
+from ...util.cache import LRUCache
+from ...model.cachedfeed import (
+    CachedFeed,
+    CachedFeedRevalidationJob,
+    FeedContent,
+    GzipFeedCodec,
+)
 
 class TestCachedFeed(DatabaseTest):
 
@@ -126,3 +142,480 @@ class TestCachedFeed(DatabaseTest):
         feed, usable = m(self._db, lane, groups, None, None, annotator,
                          force_refresh=True)
         eq_(False, usable)
+
+    def test_fetch_stale_while_revalidate(self):
+        m = CachedFeed.fetch
+        lane = self._lane()
+        page = CachedFeed.PAGE_TYPE
+        max_age = 30
+
+        # Here's a feed that expired thirty seconds ago.
+        feed, usable = m(self._db, lane, page, None, None, None)
+        feed.content = u"old content"
+        feed.timestamp = (
+            datetime.datetime.utcnow() - datetime.timedelta(seconds=60)
+        )
+
+        regenerated = []
+        def regenerate(_db):
+            regenerated.append(_db)
+            feed.update(_db, u"new content")
+
+        class MockPool(object):
+            def __init__(self):
+                self.jobs = []
+            def put(self, job):
+                self.jobs.append(job)
+
+        pool = MockPool()
+        old_pool = CachedFeed.revalidation_pool
+        CachedFeed.revalidation_pool = pool
+        try:
+            # By default, an expired feed is not usable, even if we
+            # know how to regenerate it.
+            feed2, usable = m(self._db, lane, page, None, None, None,
+                              max_age=max_age, regenerate=regenerate)
+            eq_(feed, feed2)
+            eq_(False, usable)
+            eq_([], pool.jobs)
+
+            # But if the site is configured to serve stale feeds, the
+            # expired feed is usable and a job is queued to
+            # regenerate it.
+            ConfigurationSetting.sitewide(
+                self._db, Configuration.STALE_FEED_MAX_AGE_POLICY
+            ).value = "120"
+            feed2, usable = m(self._db, lane, page, None, None, None,
+                              max_age=max_age, regenerate=regenerate)
+            eq_(True, usable)
+            [job] = pool.jobs
+            eq_(feed.id, job.feed_id)
+
+            # While that job is pending, other requests are served the
+            # stale feed without queuing another job.
+            feed2, usable = m(self._db, lane, page, None, None, None,
+                              max_age=max_age, regenerate=regenerate)
+            eq_(True, usable)
+            eq_(1, len(pool.jobs))
+
+            # A caller that can't regenerate the feed in the
+            # background can't use the stale feed.
+            feed2, usable = m(self._db, lane, page, None, None, None,
+                              max_age=max_age)
+            eq_(False, usable)
+
+            # Running the job regenerates the feed.
+            job.do_run(self._db)
+            eq_([self._db], regenerated)
+            eq_(u"new content", feed.content)
+            eq_(set(), CachedFeed._revalidating)
+
+            # If the feed was regenerated by the time a job gets to
+            # it, the job does nothing.
+            job = CachedFeedRevalidationJob(
+                feed.id, datetime.timedelta(seconds=max_age), regenerate
+            )
+            job.do_run(self._db)
+            eq_(1, len(regenerated))
+
+            # A feed that expired too long ago isn't usable.
+            feed.timestamp = (
+                datetime.datetime.utcnow() - datetime.timedelta(seconds=600)
+            )
+            feed2, usable = m(self._db, lane, page, None, None, None,
+                              max_age=max_age, regenerate=regenerate)
+            eq_(False, usable)
+            eq_(1, len(pool.jobs))
+        finally:
+            CachedFeed.revalidation_pool = old_pool
+            CachedFeed._revalidating.clear()
+
+    def test_lock(self):
+        # These sessions have their own connections, so their
+        # transactions are really committed and rolled back.
+        holder = Session(self.engine)
+        other = Session(self.engine)
+        feed_id = 1000000 + self._id
+        try:
+            # Only one session can hold the lock on a feed.
+            eq_(True, CachedFeed.lock(holder, feed_id))
+            eq_(False, CachedFeed.lock(other, feed_id))
+            other.rollback()
+
+            # Committing releases it, even though the connection goes
+            # back to the pool rather than being used to unlock.
+            holder.commit()
+            eq_(True, CachedFeed.lock(other, feed_id))
+            other.rollback()
+
+            # A revalidation job holds the lock while it regenerates
+            # the feed, and releases it when the job is committed.
+            locked = []
+            def regenerate(_db):
+                locked.append(CachedFeed.lock(other, feed_id))
+                other.rollback()
+            job = CachedFeedRevalidationJob(feed_id, None, regenerate)
+            job.run(holder)
+            eq_([False], locked)
+            eq_(True, CachedFeed.lock(other, feed_id))
+            other.rollback()
+
+            # The lock is also released if regeneration fails.
+            def fail(_db):
+                raise Exception("Oops")
+            job = CachedFeedRevalidationJob(feed_id, None, fail)
+            assert_raises(Exception, job.run, holder)
+            eq_(True, CachedFeed.lock(other, feed_id))
+        finally:
+            other.rollback()
+            holder.close()
+            other.close()
+
+    def test_fetch_stale_feed(self):
+        m = CachedFeed.fetch
+        lane = self._lane()
+        page = CachedFeed.PAGE_TYPE
+        max_age = 30
+
+        # Here's a feed that hasn't expired.
+        feed, usable = m(self._db, lane, page, None, None, None)
+        feed.update(self._db, u"old content")
+        feed2, usable = m(self._db, lane, page, None, None, None,
+                          max_age=max_age)
+        eq_(True, usable)
+
+        # Now it's marked stale.
+        eq_(1, CachedFeed.mark_stale(self._db, CachedFeed.id==feed.id))
+        self._db.expire(feed)
+        eq_(True, feed.stale)
+
+        # Marking it stale again does nothing.
+        eq_(0, CachedFeed.mark_stale(self._db, CachedFeed.id==feed.id))
+
+        regenerated = []
+        def regenerate(_db):
+            regenerated.append(_db)
+            feed.update(_db, u"new content")
+
+        class MockPool(object):
+            def __init__(self):
+                self.jobs = []
+            def put(self, job):
+                self.jobs.append(job)
+
+        pool = MockPool()
+        old_pool = CachedFeed.revalidation_pool
+        CachedFeed.revalidation_pool = pool
+        try:
+            # A stale feed isn't usable, even though it hasn't expired.
+            feed2, usable = m(self._db, lane, page, None, None, None,
+                              max_age=max_age)
+            eq_(False, usable)
+
+            # Unless it can be regenerated in the background.
+            feed2, usable = m(self._db, lane, page, None, None, None,
+                              max_age=max_age, regenerate=regenerate)
+            eq_(True, usable)
+            [job] = pool.jobs
+
+            # The job regenerates the feed even though it hasn't
+            # expired, and the new feed isn't stale.
+            job.do_run(self._db)
+            eq_([self._db], regenerated)
+            eq_(u"new content", feed.content)
+            eq_(False, feed.stale)
+            self._db.expire(feed)
+            eq_(False, feed.stale)
+
+            # A feed that's cached forever is also regenerated in the
+            # background once it's stale.
+            CachedFeed.mark_stale(self._db, CachedFeed.id==feed.id)
+            self._db.expire(feed)
+            feed2, usable = m(self._db, lane, page, None, None, None,
+                              max_age=AcquisitionFeed.CACHE_FOREVER,
+                              regenerate=regenerate)
+            eq_(True, usable)
+            eq_(2, len(pool.jobs))
+            job = pool.jobs[-1]
+            eq_(None, job.max_age)
+            job.do_run(self._db)
+            eq_(2, len(regenerated))
+            eq_(False, feed.stale)
+        finally:
+            CachedFeed.revalidation_pool = old_pool
+            CachedFeed._revalidating.clear()
+
+    def test_memory_cache(self):
+        old_cache = CachedFeed.memory_cache
+        CachedFeed.memory_cache = LRUCache(max_bytes=1024*1024)
+        try:
+            m = CachedFeed.fetch
+            lane = self._lane()
+            page = CachedFeed.PAGE_TYPE
+
+            feed, usable = m(self._db, lane, page, None, None, None)
+            eq_(False, usable)
+            eq_(0, len(CachedFeed.memory_cache))
+
+            # Updating a feed puts its content in memory.
+            feed.update(self._db, u"some content")
+            stats = CachedFeed.memory_cache_statistics()
+            eq_(1, stats['entries'])
+            assert stats['resident_bytes'] > 0
+
+            # Let's change the content in the database behind the
+            # cache's back, without changing the timestamp, and
+            # forget what we know about the content.
+            self._db.execute(
+                "update cachedfeeds set content='database content', "
+                "compressed_content=null, content_encoding=null where id=%d"
+                % feed.id
+            )
+            self._db.expire(
+                feed, ['_content', 'compressed_content', 'content_encoding']
+            )
+
+            # Since the timestamp hasn't changed, the content comes
+            # from memory rather than the database.
+            feed2, usable = m(self._db, lane, page, None, None, None)
+            eq_(feed, feed2)
+            eq_(True, usable)
+            eq_(u"some content", feed2.content)
+            eq_(1, CachedFeed.memory_cache.hits)
+
+            # Loading the content from memory didn't make the feed
+            # look like it had changed.
+            assert feed not in self._db.dirty
+
+            # Once the timestamp changes, the cached content is no
+            # longer used.
+            self._db.execute(
+                "update cachedfeeds set timestamp=now() at time zone 'utc' where id=%d"
+                % feed.id
+            )
+            self._db.expire(feed)
+            feed2, usable = m(self._db, lane, page, None, None, None)
+            eq_(True, usable)
+            eq_(u"database content", feed2.content)
+
+            # The fresh content was put into memory instead.
+            [(feed_id, timestamp, content)] = [
+                value for value, size, expires
+                in CachedFeed.memory_cache._entries.values()
+            ]
+            eq_((u"database content", None), content)
+
+            # force_refresh bypasses the memory cache.
+            hits = CachedFeed.memory_cache.hits
+            feed2, usable = m(self._db, lane, page, None, None, None,
+                              force_refresh=True)
+            eq_(False, usable)
+            eq_(hits, CachedFeed.memory_cache.hits)
+        finally:
+            CachedFeed.memory_cache = old_cache
+
+    def test_compressed_content(self):
+        lane = self._lane()
+        page = CachedFeed.PAGE_TYPE
+        feed, usable = CachedFeed.fetch(self._db, lane, page, None, None, None)
+
+        # Feed content is stored compressed.
+        feed.update(self._db, u"some content \u2603")
+        eq_(None, feed._content)
+        eq_(GzipFeedCodec.NAME, feed.content_encoding)
+        eq_(u"some content \u2603".encode("utf8"),
+            GzipFeedCodec.decompress(feed.compressed_content))
+
+        # It comes out of the database still compressed.
+        self._db.expire(feed)
+        content = feed.content
+        assert isinstance(content, FeedContent)
+        eq_(bytes(feed.compressed_content), content.compressed)
+        eq_(GzipFeedCodec.NAME, content.content_encoding)
+        eq_(True, feed.has_content)
+        eq_(False, content.decompressed)
+
+        # It's decompressed when something needs the actual feed.
+        eq_(u"some content \u2603", unicode(content))
+        eq_(u"some content \u2603".encode("utf8"), str(content))
+        eq_(u"some content \u2603", content)
+        assert u"\u2603" in content
+        eq_(True, content.decompressed)
+
+        # The content is only decompressed once.
+        assert content is feed.content
+
+        # A feed cached before feeds were compressed is still usable.
+        self._db.execute(
+            "update cachedfeeds set content='old content', "
+            "compressed_content=null, content_encoding=null where id=%d"
+            % feed.id
+        )
+        self._db.expire(feed)
+        eq_(u"old content", feed.content)
+        eq_(None, feed.content.compressed)
+        eq_(True, feed.has_content)
+
+        # Setting the content compresses it and clears out the old
+        # uncompressed content.
+        feed.content = u"new content"
+        eq_(None, feed._content)
+        eq_(u"new content", feed.content)
+        eq_("new content",
+            GzipFeedCodec.decompress(feed.content.compressed))
+
+        feed.content = None
+        eq_(None, feed.content)
+        eq_(False, feed.has_content)
+        eq_(None, feed.compressed_content)
+        eq_(None, feed.content_encoding)
+
+    def test_content_hash(self):
+        lane = self._lane()
+        page = CachedFeed.PAGE_TYPE
+        feed, usable = CachedFeed.fetch(self._db, lane, page, None, None, None)
+
+        # When a feed is updated, a hash of its content is stored
+        # alongside it.
+        feed.update(self._db, u"some content \u2603")
+        expect = CachedFeed.calculate_content_hash(u"some content \u2603")
+        eq_(expect, feed.content_hash)
+        eq_(expect, feed.content.content_hash)
+
+        # The hash survives a trip through the database.
+        self._db.expire(feed)
+        eq_(expect, feed.content.content_hash)
+
+        # Different content has a different hash.
+        feed.update(self._db, u"other content")
+        assert feed.content_hash != expect
+        eq_(feed.content_hash, feed.content.content_hash)
+
+        # Unicode content and its UTF-8 encoding have the same hash.
+        eq_(expect, CachedFeed.calculate_content_hash(
+            u"some content \u2603".encode("utf8")
+        ))
+
+    def test_record_request(self):
+        lane = self._lane()
+        page = CachedFeed.PAGE_TYPE
+        old_interval = CachedFeed.REQUEST_COUNT_FLUSH_INTERVAL
+        CachedFeed.REQUEST_COUNT_FLUSH_INTERVAL = 1000
+        CachedFeed._request_counts_flushed = time.time()
+        try:
+            # Fetching a feed counts as a request for it.
+            feed, usable = CachedFeed.fetch(
+                self._db, lane, page, None, None, None
+            )
+            eq_(1, CachedFeed._request_counts[feed.id])
+
+            # But the count isn't written to the database right away.
+            CachedFeed.record_request(self._db, feed)
+            eq_(2, CachedFeed._request_counts[feed.id])
+            self._db.refresh(feed)
+            eq_(0, feed.request_count)
+
+            # Regenerating a feed doesn't count as a request.
+            CachedFeed.fetch(
+                self._db, lane, page, None, None, None, force_refresh=True
+            )
+            eq_(2, CachedFeed._request_counts[feed.id])
+
+            # Once enough time has passed, the counts are written to
+            # the database.
+            CachedFeed.REQUEST_COUNT_FLUSH_INTERVAL = 0
+            CachedFeed.record_request(self._db, feed)
+            eq_(0, len(CachedFeed._request_counts))
+            self._db.refresh(feed)
+            eq_(3, feed.request_count)
+
+            # Counts can also be written explicitly.
+            CachedFeed.flush_request_counts(self._db, Counter({feed.id: 4}))
+            self._db.refresh(feed)
+            eq_(7, feed.request_count)
+        finally:
+            CachedFeed.REQUEST_COUNT_FLUSH_INTERVAL = old_interval
+
+    def test_generation_time(self):
+        lane = self._lane()
+        page = CachedFeed.PAGE_TYPE
+
+        # When fetch() asks for a feed to be generated, the time it
+        # takes to generate it is recorded.
+        feed, usable = CachedFeed.fetch(self._db, lane, page, None, None, None)
+        eq_(None, feed.generation_time)
+        feed.update(self._db, u"some content")
+        assert feed.generation_time >= 0
+
+        feed, usable = CachedFeed.fetch(
+            self._db, lane, page, None, None, None, force_refresh=True
+        )
+        feed.update(self._db, u"new content")
+        generation_time = feed.generation_time
+        assert generation_time >= 0
+        self._db.expire(feed)
+        eq_(generation_time, feed.generation_time)
+
+        # Updating a feed that wasn't fetched for generation keeps
+        # the previous time.
+        previous = feed.generation_time
+        feed.update(self._db, u"newer content")
+        eq_(previous, feed.generation_time)
+
+    def test_lookup_key(self):
+        lane = self._lane()
+        page = CachedFeed.PAGE_TYPE
+        feed, usable = CachedFeed.fetch(self._db, lane, page, None, None, None)
+
+        # The feed's lookup key is a hash of the values that identify it.
+        expect = CachedFeed.calculate_lookup_key(
+            lane.id, None, self._default_library.id, None, page, u"", u""
+        )
+        eq_(expect, feed.lookup_key)
+        eq_(32, len(feed.lookup_key))
+
+        # Fetching the feed again finds the same row through its
+        # lookup key.
+        feed2, usable = CachedFeed.fetch(
+            self._db, lane, page, None, None, None
+        )
+        eq_(feed, feed2)
+
+        # If one of those values changes, the lookup key is recalculated.
+        feed.pagination = u"size=10"
+        self._db.flush()
+        assert feed.lookup_key != expect
+
+        # A feed created through some other means gets a lookup key
+        # as well.
+        feed3 = create(
+            self._db, CachedFeed, lane=lane, type=CachedFeed.GROUPS_TYPE,
+            pagination=u""
+        )[0]
+        self._db.flush()
+        eq_(CachedFeed.calculate_lookup_key(
+            lane.id, None, None, None, CachedFeed.GROUPS_TYPE, None, u""
+        ), feed3.lookup_key)
+
+    def test_update_upserts(self):
+        lane = self._lane()
+        page = CachedFeed.PAGE_TYPE
+        feed, usable = CachedFeed.fetch(self._db, lane, page, None, None, None)
+
+        feed.update(self._db, u"some content")
+        assert feed not in self._db.dirty
+        self._db.expire(feed)
+        eq_(u"some content", feed.content)
+
+        # If the row is deleted out from under us (say, by the
+        # reaper), updating the feed recreates it instead of losing
+        # the content.
+        lookup_key = feed.lookup_key
+        self._db.execute("delete from cachedfeeds where id=%d" % feed.id)
+        feed.update(self._db, u"new content")
+        [(encoding, compressed)] = self._db.execute(
+            "select content_encoding, compressed_content from cachedfeeds "
+            "where lookup_key='%s'" % lookup_key
+        ).fetchall()
+        codec = CachedFeed.CODECS[encoding]
+        eq_("new content", codec.decompress(bytes(compressed)))
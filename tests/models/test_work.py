@@ -33,6 +33,7 @@ from ...model.resource import (
     Representation,
 )
 from ...model.work import (
+    SearchIndexChange,
     Work,
     WorkGenre,
 )
@@ -831,6 +832,16 @@ class TestWork(DatabaseTest):
         work.summary_text = self._str
         work.rating = 5
         work.popularity = 4
+        work.random = 0.123
+        work.last_update_time = datetime.datetime(2018, 1, 2, 3, 4, 5)
+        edition.series_position = 3
+
+        # The book is checked out in the first collection, and is
+        # open access in the second.
+        pool.open_access = False
+        pool.licenses_owned = 1
+        pool.licenses_available = 0
+        pool2.open_access = True
 
         # Make sure all of this will show up in a database query.
         self._db.flush()
@@ -838,9 +849,11 @@ class TestWork(DatabaseTest):
 
         search_doc = work.to_search_document()
         eq_(work.id, search_doc['_id'])
+        eq_(work.id, search_doc['work_id'])
         eq_(work.title, search_doc['title'])
         eq_(edition.subtitle, search_doc['subtitle'])
         eq_(edition.series, search_doc['series'])
+        eq_(3, search_doc['series_position'])
         eq_(edition.language, search_doc['language'])
         eq_(work.sort_title, search_doc['sort_title'])
         eq_(work.author, search_doc['author'])
@@ -855,6 +868,8 @@ class TestWork(DatabaseTest):
         eq_(work.quality, search_doc['quality'])
         eq_(work.rating, search_doc['rating'])
         eq_(work.popularity, search_doc['popularity'])
+        eq_(0.123, search_doc['random'])
+        eq_("2018-01-02T03:04:05", search_doc['last_update_time'])
         eq_(dict(lower=7, upper=8), search_doc['target_age'])
 
         # Each collection in which the Work is found is listed in
@@ -864,6 +879,13 @@ class TestWork(DatabaseTest):
         for collection in self._default_library.collections:
             assert dict(collection_id=collection.id) in collections
 
+        # The book is only available right now in the collection
+        # where it's open access.
+        eq_([dict(collection_id=collection2.id)],
+            search_doc['available_collections'])
+        eq_([dict(collection_id=collection2.id)],
+            search_doc['open_access_collections'])
+
         contributors = search_doc['contributors']
         eq_(2, len(contributors))
         [contributor1_doc] = [c for c in contributors if c['sort_name'] == contributor1.sort_name]
@@ -1006,12 +1028,19 @@ class TestWork(DatabaseTest):
         pool.licenses_owned = 1
         eq_(success, record.status)
 
-        # If its licenses_available changes, nothing happens
-        pool.licenses_available = 0
+        # If its licenses_available changes, but not to or from zero,
+        # nothing happens.
+        pool.licenses_available = 1
         eq_(success, record.status)
 
+        # If its licenses_available goes to zero, it needs to be
+        # reindexed, since it's no longer available now.
+        pool.licenses_available = 0
+        eq_(registered, record.status)
+
         # If its licenses_owned goes from nonzero to zero, it needs to
         # be reindexed.
+        record.status = success
         pool.licenses_owned = 0
         eq_(registered, record.status)
 
@@ -1035,6 +1064,73 @@ class TestWork(DatabaseTest):
         record = find_record(work)
         eq_(registered, record.status)
 
+    def test_availability_change_is_availability_only(self):
+        # When a LicensePool's availability changes, the SearchIndexChange
+        # indicates that only the availability information in the
+        # work's search document needs to change.
+        work = self._work(with_license_pool=True)
+        [pool] = work.license_pools
+        pool.open_access = False
+        pool.licenses_owned = 1
+        pool.licenses_available = 1
+        self._db.commit()
+        self._db.query(SearchIndexChange).delete()
+
+        pool.licenses_available = 0
+        [change] = work.search_index_changes
+        eq_(True, change.availability_only)
+
+        # Other changes require the entire document to be rebuilt.
+        work.external_index_needs_updating()
+        self._db.flush()
+        eq_([True, False], sorted(
+            [x.availability_only for x in work.search_index_changes],
+            reverse=True
+        ))
+
+    def test_to_search_availability_documents(self):
+        # Create a work with two LicensePools in different collections.
+        work = self._work(with_license_pool=True)
+        [pool1] = work.license_pools
+        pool1.open_access = False
+        pool1.licenses_owned = 2
+        pool1.licenses_available = 0
+        collection2 = self._collection()
+        edition, pool2 = self._edition(
+            with_license_pool=True, with_open_access_download=True,
+            collection=collection2
+        )
+        pool2.work = work
+        work.last_update_time = datetime.datetime(2018, 1, 2, 3, 4, 5)
+
+        # A work with no LicensePools.
+        work2 = self._work()
+        self._db.flush()
+
+        documents = Work.to_search_availability_documents([work, work2])
+        eq_(set([work.id, work2.id]), set(documents.keys()))
+
+        # The partial document contains the same availability
+        # information as the complete search document.
+        full = work.to_search_document()
+        partial = documents[work.id]
+        for field in ('collections', 'available_collections',
+                      'open_access_collections'):
+            eq_(sorted(full[field]), sorted(partial[field]))
+        eq_(
+            [dict(collection_id=self._default_collection.id),
+             dict(collection_id=collection2.id)],
+            partial['collections']
+        )
+        eq_([dict(collection_id=collection2.id)],
+            partial['available_collections'])
+        eq_("2018-01-02T03:04:05", partial['last_update_time'])
+
+        eq_(dict(collections=None, available_collections=None,
+                 open_access_collections=None, last_update_time=None),
+            documents[work2.id])
+        eq_({}, Work.to_search_availability_documents([]))
+
     def test_reset_coverage(self):
         # Test the methods that reset coverage for works, indicating
         # that some task needs to be performed again.
@@ -1077,6 +1173,25 @@ class TestWork(DatabaseTest):
         # WorkCoverageRecord is processed.
         eq_([], index.docs.values())
 
+    def test_external_index_needs_updating(self):
+        # Marking a work as needing to be reindexed records a
+        # SearchIndexChange, as well as resetting the work's coverage.
+        work = self._work()
+        self._db.commit()
+        before = len(work.search_index_changes)
+
+        record = work.external_index_needs_updating()
+        eq_(WorkCoverageRecord.UPDATE_SEARCH_INDEX_OPERATION, record.operation)
+        eq_(WorkCoverageRecord.REGISTERED, record.status)
+        self._db.commit()
+
+        eq_(before + 1, len(work.search_index_changes))
+        change = work.search_index_changes[-1]
+        eq_(work.id, change.work_id)
+        assert isinstance(change.timestamp, datetime.datetime)
+        eq_(change, self._db.query(SearchIndexChange).filter(
+            SearchIndexChange.id==change.id).one())
+
     def test_for_unchecked_subjects(self):
 
         w1 = self._work(with_license_pool=True)
@@ -3,6 +3,7 @@ import json
 
 import flask
 from flask import Flask
+from lxml import etree
 from flask_babel import (
     Babel,
     lazy_gettext as _
@@ -21,21 +22,30 @@ from . import (
 from ..opds import TestAnnotator
 
 from ..model import Identifier
+from ..model.cachedfeed import (
+    CachedFeed,
+    FeedContent,
+    GzipFeedCodec,
+)
 
 from ..lane import (
     Facets,
     Pagination,
     SearchFacets,
+    SortKeyPagination,
     WorkList,
 )
 
 from ..app_server import (
+    entry_response,
+    feed_response,
     HeartbeatController,
     URNLookupController,
     ErrorHandler,
     ComplaintController,
     load_facets_from_request,
     load_pagination_from_request,
+    load_search_pagination_from_request,
 )
 
 from ..config import Configuration
@@ -95,6 +105,148 @@ class TestHeartbeatController(object):
         eq_('ba.na.na-10-ssssssssss', data['releaseID'])
 
 
+class TestFeedResponse(object):
+
+    def test_compressed_feed(self):
+        app = Flask(__name__)
+        compressed = GzipFeedCodec.compress("<feed/>")
+        content = FeedContent(
+            u"<feed/>", compressed=compressed,
+            content_encoding=GzipFeedCodec.NAME
+        )
+
+        # A client that accepts gzip gets the compressed feed as-is.
+        with app.test_request_context(
+            '/', headers={"Accept-Encoding": "gzip, deflate"}
+        ):
+            response = feed_response(content)
+        eq_("gzip", response.headers['Content-Encoding'])
+        eq_("Accept-Encoding", response.headers['Vary'])
+        eq_(compressed, response.data)
+
+        # Any other client gets the uncompressed feed.
+        with app.test_request_context('/'):
+            response = feed_response(content)
+        eq_(None, response.headers.get('Content-Encoding'))
+        eq_("Accept-Encoding", response.headers['Vary'])
+        eq_("<feed/>", response.data)
+
+        # A feed that was never compressed is sent normally.
+        with app.test_request_context(
+            '/', headers={"Accept-Encoding": "gzip"}
+        ):
+            response = feed_response(u"<feed/>")
+        eq_(None, response.headers.get('Content-Encoding'))
+        eq_(None, response.headers.get('Vary'))
+        eq_("<feed/>", response.data)
+
+    def test_etag(self):
+        app = Flask(__name__)
+        compressed = GzipFeedCodec.compress("<feed/>")
+        content = FeedContent(
+            u"<feed/>", compressed=compressed,
+            content_encoding=GzipFeedCodec.NAME, content_hash=u"abc"
+        )
+
+        # A cached feed's ETag is its stored content hash.
+        with app.test_request_context('/'):
+            response = feed_response(content)
+        eq_(200, response.status_code)
+        eq_('"abc"', response.headers['ETag'])
+
+        # The compressed version of the feed has its own ETag.
+        with app.test_request_context(
+            '/', headers={"Accept-Encoding": "gzip"}
+        ):
+            response = feed_response(content)
+        eq_('"abc-gzip"', response.headers['ETag'])
+
+        # A client that already has the feed gets a 304 response with
+        # no body. Either ETag will do.
+        for etag in ('"abc"', '"abc-gzip"', 'W/"abc"', '"xyz", "abc"', '*'):
+            with app.test_request_context(
+                '/', headers={"Accept-Encoding": "gzip",
+                              "If-None-Match": etag}
+            ):
+                response = feed_response(content)
+            eq_(304, response.status_code)
+            eq_('"abc-gzip"', response.headers['ETag'])
+            eq_("", response.data)
+
+        # Deciding on a 304 response doesn't involve decompressing
+        # the feed.
+        lazy = FeedContent(
+            compressed=compressed, content_encoding=GzipFeedCodec.NAME,
+            content_hash=u"abc"
+        )
+        with app.test_request_context(
+            '/', headers={"If-None-Match": '"abc"'}
+        ):
+            response = feed_response(lazy)
+        eq_(304, response.status_code)
+        eq_(False, lazy.decompressed)
+
+        # Neither does sending the compressed feed to a client that
+        # can handle it.
+        with app.test_request_context(
+            '/', headers={"Accept-Encoding": "gzip"}
+        ):
+            response = feed_response(lazy)
+        eq_(200, response.status_code)
+        eq_(compressed, response.data)
+        eq_(False, lazy.decompressed)
+
+        # Only a client that needs the plain feed makes it necessary
+        # to decompress it.
+        with app.test_request_context('/'):
+            response = feed_response(lazy)
+        eq_("<feed/>", response.data)
+        eq_(True, lazy.decompressed)
+
+        # A client with some other version of the feed gets the feed.
+        with app.test_request_context(
+            '/', headers={"If-None-Match": '"xyz"'}
+        ):
+            response = feed_response(content)
+        eq_(200, response.status_code)
+        eq_("<feed/>", response.data)
+
+        # Content that didn't come from the cache is hashed when it's
+        # served. The same goes for OPDS entries.
+        etag = '"%s"' % CachedFeed.calculate_content_hash("<entry/>")
+        with app.test_request_context('/'):
+            response = entry_response("<entry/>")
+        eq_(etag, response.headers['ETag'])
+
+        with app.test_request_context(
+            '/', headers={"If-None-Match": etag}
+        ):
+            response = entry_response(etree.fromstring("<entry/>"))
+        eq_(304, response.status_code)
+
+    def test_streamed_feed(self):
+        app = Flask(__name__)
+        produced = []
+        def pieces():
+            for piece in ("<feed>", "<entry/>", "</feed>"):
+                produced.append(piece)
+                yield piece
+
+        # A feed that's being generated a piece at a time is sent the
+        # same way.
+        with app.test_request_context(
+            '/', headers={"If-None-Match": "*"}
+        ):
+            response = feed_response(pieces())
+
+            # Nothing has been produced yet.
+            eq_([], produced)
+            eq_(True, response.is_streamed)
+            eq_(200, response.status_code)
+            eq_(None, response.headers.get('ETag'))
+            eq_("<feed><entry/></feed>", response.data)
+
+
 class TestURNLookupController(DatabaseTest):
 
     def setup(self):
@@ -360,6 +512,61 @@ class TestLoadMethods(DatabaseTest):
             pagination = load_pagination_from_request()
             eq_(100, pagination.size)
 
+    def test_load_pagination_from_request_base_class(self):
+        key = SortKeyPagination([1.0, u"5"], offset=10).pagination_key
+        with self.app.test_request_context('/?size=10&key=%s' % key):
+            pagination = load_pagination_from_request(
+                base_class=SortKeyPagination
+            )
+            assert isinstance(pagination, SortKeyPagination)
+            eq_(10, pagination.size)
+            eq_(10, pagination.offset)
+            eq_([1.0, u"5"], pagination.last_item_on_previous_page)
+
+        with self.app.test_request_context('/?key=nonsense'):
+            pagination = load_pagination_from_request(
+                base_class=SortKeyPagination
+            )
+            eq_(INVALID_INPUT.uri, pagination.uri)
+
+    def test_load_pagination_from_request_base_class_offset(self):
+        # A SortKeyPagination can also be loaded from a link that
+        # uses an offset.
+        with self.app.test_request_context('/?size=10&after=20'):
+            pagination = load_pagination_from_request(
+                base_class=SortKeyPagination
+            )
+            assert isinstance(pagination, SortKeyPagination)
+            eq_(20, pagination.offset)
+            eq_(None, pagination.last_item_on_previous_page)
+
+        with self.app.test_request_context('/?after=string'):
+            pagination = load_pagination_from_request(
+                base_class=SortKeyPagination
+            )
+            eq_(INVALID_INPUT.uri, pagination.uri)
+
+    def test_load_search_pagination_from_request(self):
+        old_value = SortKeyPagination.SEARCH_AFTER_SUPPORTED
+        try:
+            # If Elasticsearch supports it, search results are paged
+            # through by sort key.
+            SortKeyPagination.SEARCH_AFTER_SUPPORTED = True
+            with self.app.test_request_context('/?after=20'):
+                pagination = load_search_pagination_from_request()
+                assert isinstance(pagination, SortKeyPagination)
+                eq_(Pagination.DEFAULT_SEARCH_SIZE, pagination.size)
+                eq_(20, pagination.offset)
+
+            # Otherwise, they're paged through by offset.
+            SortKeyPagination.SEARCH_AFTER_SUPPORTED = False
+            with self.app.test_request_context('/?after=20'):
+                pagination = load_search_pagination_from_request()
+                eq_(Pagination, pagination.__class__)
+                eq_(20, pagination.offset)
+        finally:
+            SortKeyPagination.SEARCH_AFTER_SUPPORTED = old_value
+
     def test_load_pagination_from_request_default_size(self):
         with self.app.test_request_context('/?size=50&after=10'):
             pagination = load_pagination_from_request(default_size=10)
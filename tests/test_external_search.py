@@ -4,6 +4,8 @@ from nose.tools import (
     eq_,
     set_trace,
 )
+import datetime
+import json
 import logging
 import time
 from psycopg2.extras import NumericRange
@@ -12,29 +14,37 @@ from . import (
     DatabaseTest,
 )
 
-from elasticsearch.exceptions import ElasticsearchException
+from elasticsearch.exceptions import (
+    ElasticsearchException,
+    TransportError,
+)
 
 from ..config import CannotLoadConfiguration
 from ..lane import (
     Lane,
     Pagination,
+    SortKeyPagination,
 )
 from ..model import (
     Edition,
     ExternalIntegration,
     Genre,
+    SearchIndexChange,
     Work,
     WorkCoverageRecord,
 )
+from .. import external_search
 from ..external_search import (
     ExternalSearchIndex,
     ExternalSearchIndexVersions,
     Filter,
     MAJOR_VERSION,
+    MULTI_SEARCH_RAISE_ON_ERROR,
     MockExternalSearchIndex,
     Query,
     QueryParser,
     SearchBase,
+    SearchIndexChangeMonitor,
     SearchIndexCoverageProvider,
     SearchIndexMonitor,
 )
@@ -48,6 +58,9 @@ from ..external_search import (
 )
 
 from ..classifier import Classifier
+from ..config import Configuration
+from ..facets import FacetConstants
+from ..util.cache import LRUCache
 
 
 class TestingClient(ExternalSearchIndex):
@@ -84,7 +97,9 @@ class ExternalSearchTest(DatabaseTest):
         )
 
         try:
-            self.search = TestingClient(self._db)
+            # Many tests run the same search before and after changing
+            # the index, so don't cache search results.
+            self.search = TestingClient(self._db, result_cache_ttl=0)
         except Exception as e:
             self.search = None
             print "Unable to set up elasticsearch index, search tests will be skipped."
@@ -140,7 +155,7 @@ class TestExternalSearch(ExternalSearchTest):
         """
         if not self.search:
             return
-        eq_("test_index-v3", self.search.works_index_name(self._db))
+        eq_("test_index-v4", self.search.works_index_name(self._db))
 
     def test_setup_index_creates_new_index(self):
         if not self.search:
@@ -917,6 +932,371 @@ class TestExactMatches(EndToEndExternalSearchTest):
         expect(order, "peter graves biography")
 
 
+class TestExternalSearchIndexVersions(object):
+
+    def test_v4_body(self):
+        # The fields used to sort works are stored without being
+        # analyzed.
+        body = ExternalSearchIndexVersions.v4_body()
+        mapping = body['mappings'][ExternalSearchIndex.work_document_type]
+        for field in Filter.SORTABLE_STRING_FIELDS:
+            if MAJOR_VERSION == 1:
+                eq_(dict(type="string", index="not_analyzed"),
+                    mapping['properties'][field])
+            else:
+                eq_(dict(type="keyword"), mapping['properties'][field])
+
+        # Otherwise, it's the same as the v3 body.
+        v3 = ExternalSearchIndexVersions.v3_body()
+        v3_mapping = v3['mappings'][ExternalSearchIndex.work_document_type]
+        for field in Filter.SORTABLE_STRING_FIELDS:
+            del mapping['properties'][field]
+            v3_mapping['properties'].pop(field, None)
+        eq_(v3, body)
+
+
+class TestSearchResultCache(DatabaseTest):
+
+    class MockSearch(object):
+        """Stands in for an elasticsearch_dsl Search object."""
+        def __init__(self):
+            self.requests = []
+
+        def query(self, query):
+            return self
+
+        def fields(self, fields):
+            return self
+        source = fields
+
+        def sort(self, *order):
+            self.order = order
+            return self
+
+        def to_dict(self):
+            if hasattr(self, 'order'):
+                return dict(sort=list(self.order))
+            return {}
+
+        def extra(self, **kwargs):
+            self.search_after = kwargs['search_after']
+            return self
+
+        def __getitem__(self, window):
+            self.window = window
+            return self
+
+        def execute(self):
+            window = self.window
+            self.requests.append((window.start, window.stop))
+            class Meta(dict):
+                def __getattr__(self, key):
+                    if key not in self:
+                        raise AttributeError(key)
+                    return self[key]
+            class Result(object):
+                def __init__(self, id):
+                    self.meta = Meta(id=unicode(id))
+                    if self.sort_keys:
+                        self.meta['sort'] = [1.0, unicode(id)]
+            Result.sort_keys = hasattr(self, 'order')
+            return [Result(i) for i in range(window.start, window.stop)]
+
+    def setup(self):
+        super(TestSearchResultCache, self).setup()
+        self.index = MockExternalSearchIndex()
+        self.index.search = self.MockSearch()
+        self.index.result_cache = LRUCache(ttl=60)
+
+    def query_works(self, *args, **kwargs):
+        # MockExternalSearchIndex overrides query_works, so call the
+        # real implementation directly.
+        return ExternalSearchIndex.query_works(self.index, *args, **kwargs)
+
+    def query_works_multi(self, queries):
+        return ExternalSearchIndex.query_works_multi(self.index, queries)
+
+    def test_repeated_search_uses_cache(self):
+        filter = Filter(media=Edition.BOOK_MEDIUM)
+        pagination = Pagination(offset=2, size=3)
+        eq_([2, 3, 4], self.query_works("Harry Potter", filter, pagination))
+        eq_(1, len(self.index.search.requests))
+
+        # Trivial differences in the query string don't matter.
+        eq_([2, 3, 4], self.query_works(" harry  POTTER", filter, pagination))
+        eq_(1, len(self.index.search.requests))
+        eq_(1, self.index.result_cache.hits)
+
+        # But a different filter or page is a different search.
+        self.query_works(
+            "harry potter", Filter(media=Edition.AUDIO_MEDIUM), pagination
+        )
+        self.query_works(
+            "harry potter", filter, Pagination(offset=5, size=3)
+        )
+        eq_(3, len(self.index.search.requests))
+
+        # Requests for raw search results aren't cached.
+        self.query_works(
+            "harry potter", filter, pagination, return_raw_results=True
+        )
+        eq_(4, len(self.index.search.requests))
+
+    def test_different_order_is_different_search(self):
+        # Two searches that differ only in how the works are sorted
+        # don't share cached results.
+        pagination = Pagination(offset=0, size=3)
+        by_title = Filter(media=Edition.BOOK_MEDIUM)
+        by_title.order = "sort_title"
+        by_author = Filter(media=Edition.BOOK_MEDIUM)
+        by_author.order = "sort_author"
+
+        self.query_works("harry potter", by_title, pagination)
+        self.query_works("harry potter", by_author, pagination)
+        eq_(2, len(self.index.search.requests))
+        eq_(0, self.index.result_cache.hits)
+
+        # Neither does the same order in the other direction.
+        descending = Filter(media=Edition.BOOK_MEDIUM)
+        descending.order = "sort_title"
+        descending.order_ascending = False
+        self.query_works("harry potter", descending, pagination)
+        eq_(3, len(self.index.search.requests))
+
+        # But the same search, sorted the same way, is cached.
+        self.query_works("harry potter", by_title, Pagination(offset=0, size=3))
+        eq_(3, len(self.index.search.requests))
+        eq_(1, self.index.result_cache.hits)
+
+    def test_cache_cleared_when_configuration_changes(self):
+        self.query_works("romance")
+        self.query_works("romance")
+        eq_(1, len(self.index.search.requests))
+
+        Configuration.site_configuration_last_update(
+            self._db, known_value=datetime.datetime.utcnow()
+        )
+        self.query_works("romance")
+        eq_(2, len(self.index.search.requests))
+
+    def test_clear_result_cache(self):
+        self.index.result_cache.set("key", (1,2,3))
+        self.index.clear_result_cache()
+        eq_(0, len(self.index.result_cache))
+
+    def test_result_cache_key(self):
+        filter = Filter(media=Edition.BOOK_MEDIUM)
+        key = self.index._result_cache_key(
+            "  Harry Potter", filter, Pagination(offset=0, size=10)
+        )
+        alias, query, built_filter, sort_order, page = key
+        eq_("works-current", alias)
+        eq_("harry potter", query)
+        eq_(filter.build().to_dict(), json.loads(built_filter))
+        eq_(None, sort_order)
+        eq_((("after", 0), ("size", 10)), page)
+
+        # If the works are sorted, the sort order is part of the key.
+        filter.order = "sort_title"
+        key = self.index._result_cache_key(
+            "Harry Potter", filter, Pagination(offset=0, size=10)
+        )
+        eq_(filter.sort_order, json.loads(key[3]))
+
+        # A page found through a pagination key is identified by the key.
+        pagination = SortKeyPagination([1.0, "4"], size=10, offset=10)
+        key = self.index._result_cache_key("Harry Potter", filter, pagination)
+        eq_(
+            (("key", pagination.pagination_key), ("size", 10)), key[-1]
+        )
+
+    class OldMockMultiSearch(object):
+        """Stands in for a MultiSearch object from an older version of
+        elasticsearch_dsl.
+        """
+        ERROR = dict(type="search_phase_execution_exception")
+
+        class ErrorResponse(object):
+            """A response to a failed query, which wraps the raw
+            response from Elasticsearch.
+            """
+            def __init__(self, error):
+                self._d_ = dict(error=error)
+
+            def __nonzero__(self):
+                return False
+
+        def __init__(self, search, errors=[], empty=[]):
+            self.search = search
+            self.errors = errors
+            self.empty = empty
+            self.windows = []
+            self.executed = 0
+
+        def add(self, search):
+            self.windows.append(search.window)
+            return self
+
+        def execute(self, ignore_cache=False):
+            # A failed query doesn't raise an exception; its response
+            # describes the error.
+            return self._responses(self.ErrorResponse(self.ERROR))
+
+        def _responses(self, error_response):
+            self.executed += 1
+            responses = []
+            for window in self.windows:
+                if window.start in self.errors:
+                    responses.append(error_response)
+                elif window.start in self.empty:
+                    # The query succeeded but found nothing.
+                    responses.append([])
+                else:
+                    self.search.window = window
+                    responses.append(self.search.execute())
+            return responses
+
+    class NewMockMultiSearch(OldMockMultiSearch):
+        """Stands in for a MultiSearch object from a newer version of
+        elasticsearch_dsl.
+        """
+        def execute(self, ignore_cache=False, raise_on_error=True):
+            # A failed query raises an exception unless
+            # raise_on_error is False, in which case its response is
+            # None.
+            if raise_on_error and self.errors:
+                raise TransportError(
+                    "N/A", self.ERROR['type'], self.ERROR
+                )
+            return self._responses(None)
+
+    def test_query_works_multi(self):
+        if MULTI_SEARCH_RAISE_ON_ERROR:
+            MockMultiSearch = self.NewMockMultiSearch
+        else:
+            MockMultiSearch = self.OldMockMultiSearch
+        search = self.index.search
+        multi = MockMultiSearch(search)
+        self.index.multi_search = multi
+        filter = Filter(media=Edition.BOOK_MEDIUM)
+        queries = [
+            ("dogs", None, Pagination(offset=0, size=2)),
+            ("cats", filter, Pagination(offset=2, size=2)),
+        ]
+
+        # Both queries are sent in a single request, and the results
+        # come back in the same order as the queries.
+        eq_([[0, 1], [2, 3]], self.query_works_multi(queries))
+        eq_(1, multi.executed)
+        eq_([(0, 2), (2, 4)], search.requests)
+
+        # The results were put in the result cache, so running the
+        # same queries again doesn't make another request.
+        eq_([[0, 1], [2, 3]], self.query_works_multi(queries))
+        eq_(1, multi.executed)
+
+        # The cache is shared with query_works.
+        eq_(
+            [2, 3],
+            self.query_works("cats", filter, Pagination(offset=2, size=2))
+        )
+        eq_(2, len(search.requests))
+
+        # Only the queries that weren't cached are sent to
+        # Elasticsearch. A query that fails doesn't stop the other
+        # queries from returning results. This works with both old
+        # and new versions of elasticsearch_dsl.
+        old_value = external_search.MULTI_SEARCH_RAISE_ON_ERROR
+        mock_classes = [
+            (False, self.OldMockMultiSearch), (True, self.NewMockMultiSearch)
+        ]
+        try:
+            for supported, mock_class in mock_classes:
+                external_search.MULTI_SEARCH_RAISE_ON_ERROR = supported
+                self.index.result_cache = LRUCache(ttl=60)
+                self.index.multi_search = mock_class(search)
+                self.query_works_multi(queries[:1])
+                multi = mock_class(search, errors=[10])
+                self.index.multi_search = multi
+                eq_(
+                    [[0, 1], [], [5]],
+                    self.query_works_multi(
+                        queries[:1] + [
+                            ("mice", None, Pagination(offset=10, size=2)),
+                            ("owls", None, Pagination(offset=5, size=1)),
+                        ]
+                    )
+                )
+                eq_([slice(10, 12), slice(5, 6)], multi.windows)
+
+                # The failed query wasn't cached, so it's tried again.
+                multi = mock_class(search)
+                self.index.multi_search = multi
+                self.query_works_multi(
+                    [("mice", None, Pagination(offset=10, size=2))]
+                )
+                eq_(1, multi.executed)
+        finally:
+            external_search.MULTI_SEARCH_RAISE_ON_ERROR = old_value
+
+        # A query that finds nothing isn't a failure. Its empty
+        # result is cached like any other.
+        multi = MockMultiSearch(search, empty=[20])
+        self.index.multi_search = multi
+        ferrets = [("ferrets", None, Pagination(offset=20, size=2))]
+        pagination = ferrets[0][2]
+        eq_([[0, 1], []], self.query_works_multi(queries[:1] + ferrets))
+        eq_(0, pagination.this_page_size)
+        eq_(1, multi.executed)
+        eq_([[]], self.query_works_multi(ferrets))
+        eq_(1, multi.executed)
+
+        # If there's no search index, every query gets an empty list.
+        self.index.works_alias = None
+        eq_([[], []], self.query_works_multi(queries))
+
+    def test_sort_key_pagination(self):
+        pagination = SortKeyPagination(size=3)
+        old_value = SortKeyPagination.SEARCH_AFTER_SUPPORTED
+        SortKeyPagination.SEARCH_AFTER_SUPPORTED = True
+        try:
+            eq_([0, 1, 2], self.query_works("dogs", None, pagination))
+            eq_(SortKeyPagination.SORT_ORDER, list(self.index.search.order))
+
+            # The sort key of the last item on the page was recorded,
+            # so the next page can pick up from there.
+            eq_([1.0, "2"], pagination.last_item_on_this_page)
+            eq_([1.0, "2"], pagination.next_page.last_item_on_previous_page)
+
+            # A cached page of results still knows where it left off.
+            pagination = SortKeyPagination(size=3)
+            self.query_works("dogs", None, pagination)
+            eq_(1, len(self.index.search.requests))
+            eq_([1.0, "2"], pagination.last_item_on_this_page)
+
+            # The next page is found with search_after, not an offset.
+            self.query_works("dogs", None, pagination.next_page)
+            eq_([1.0, "2"], self.index.search.search_after)
+            eq_((0, 3), self.index.search.requests[-1])
+        finally:
+            SortKeyPagination.SEARCH_AFTER_SUPPORTED = old_value
+
+    def test_filter_sort_order(self):
+        # If the filter specifies an order, search results are sorted
+        # in that order rather than by relevance -- even when the
+        # pagination is based on sort keys.
+        filter = Filter()
+        filter.order = "sort_title"
+        old_value = SortKeyPagination.SEARCH_AFTER_SUPPORTED
+        SortKeyPagination.SEARCH_AFTER_SUPPORTED = True
+        try:
+            pagination = SortKeyPagination(size=3)
+            eq_([0, 1, 2], self.query_works(None, filter, pagination))
+            eq_(filter.sort_order, list(self.index.search.order))
+        finally:
+            SortKeyPagination.SEARCH_AFTER_SUPPORTED = old_value
+
+
 class TestSearchBase(object):
 
     def test__match_range(self):
@@ -967,6 +1347,39 @@ class TestQuery(DatabaseTest):
         eq_(unfiltered, m.query())
         assert not hasattr(unfiltered, 'filter')
 
+    def test_template(self):
+        # The query built from a given query string is cached and
+        # reused, no matter what filter is applied to it.
+        class Mock(Query):
+            calls = 0
+            def query(self):
+                Mock.calls += 1
+                return Q("simple_query_string", query=self.query_string)
+
+        Query.TEMPLATE_CACHE.clear()
+        first = Mock("dogs").template()
+        second = Mock("dogs", Filter(fiction=True)).template()
+        eq_(1, Mock.calls)
+        assert first is second
+
+        # The cached template is used when building a filtered query.
+        filtered = Mock("dogs", Filter(fiction=True)).build()
+        eq_(1, Mock.calls)
+        if MAJOR_VERSION == 1:
+            eq_(first, filtered.query)
+        else:
+            eq_([first], filtered.must)
+
+        # A different query string gets a different template.
+        Mock("cats").template()
+        eq_(2, Mock.calls)
+
+        # So does a different Query subclass.
+        Query("dogs").template()
+        eq_(2, Mock.calls)
+        eq_(3, len(Query.TEMPLATE_CACHE))
+        Query.TEMPLATE_CACHE.clear()
+
     def test_query(self):
         # The query() method calls a number of other methods
         # to generate hypotheses, then creates a dis_max query
@@ -1065,6 +1478,10 @@ class TestQuery(DatabaseTest):
 
         eq_(200, query._boosts['parsed query matches'])
 
+        # If there's no query string, every work matches, and it's up
+        # to the filter to narrow things down.
+        eq_({'match_all': {}}, Query(None).query().to_dict())
+
     def test__hypothesize(self):
         # Verify that _hypothesize() adds a query to a list,
         # boosting it if necessary.
@@ -1761,6 +2178,85 @@ class TestFilter(DatabaseTest):
         filter.fiction = False
         eq_({'term': {'fiction': 'nonfiction'}}, filter.build().to_dict())
 
+    def test_build_facet_restrictions(self):
+        # Test the restrictions that can only be imposed on a Filter
+        # by a Facets object.
+        collection_ids = [self._default_collection.id]
+        available_now = {'terms': {'available_collections.collection_id': collection_ids}}
+        open_access = {'terms': {'open_access_collections.collection_id': collection_ids}}
+
+        filter = Filter(collections=[self._default_collection])
+        [collection] = filter.build(_chain_filters=self._chain)
+
+        filter.availability = FacetConstants.AVAILABLE_NOW
+        [collection, availability] = filter.build(_chain_filters=self._chain)
+        eq_(available_now, availability.to_dict())
+
+        filter.availability = FacetConstants.AVAILABLE_OPEN_ACCESS
+        [collection, availability] = filter.build(_chain_filters=self._chain)
+        eq_(open_access, availability.to_dict())
+
+        # AVAILABLE_ALL imposes no restriction.
+        filter.availability = FacetConstants.AVAILABLE_ALL
+        [collection] = filter.build(_chain_filters=self._chain)
+
+        # The 'main' collection excludes low-quality open-access books.
+        filter.subcollection = FacetConstants.COLLECTION_MAIN
+        [collection, subcollection] = filter.build(_chain_filters=self._chain)
+        eq_(
+            {'bool': {'must_not': [
+                {'bool': {'must': [
+                    open_access, {'range': {'quality': {'lt': 0.3}}}
+                ]}}
+            ]}},
+            subcollection.to_dict()
+        )
+
+        # The 'featured' collection includes only books that meet the
+        # library's standard for featured books.
+        filter.subcollection = FacetConstants.COLLECTION_FEATURED
+        filter.minimum_featured_quality = 0.65
+        [collection, subcollection] = filter.build(_chain_filters=self._chain)
+        eq_({'range': {'quality': {'gte': 0.65}}}, subcollection.to_dict())
+
+    def _chain(self, filters, new_filter):
+        """A mock of Filter._chain_filters that builds a list of
+        filters rather than combining them.
+        """
+        if filters is None:
+            filters = []
+        filters.append(new_filter)
+        return filters
+
+    def test__collection_filter(self):
+        # With no collection IDs, a work matches as long as it
+        # shows up in some collection under the given field.
+        eq_({'exists': {'field': 'open_access_collections.collection_id'}},
+            Filter._collection_filter('open_access_collections', []).to_dict())
+
+        eq_({'terms': {'available_collections.collection_id': [1, 2]}},
+            Filter._collection_filter('available_collections', [1, 2]).to_dict())
+
+    def test_sort_order(self):
+        # By default, works are sorted by relevance.
+        filter = Filter()
+        eq_(None, filter.sort_order)
+
+        # Once a sort field is specified, ties are broken using the
+        # default sort order.
+        filter.order = "last_update_time"
+        filter.order_ascending = False
+        eq_([{'last_update_time': 'desc'}, {'sort_author': 'asc'},
+             {'sort_title': 'asc'}, {'work_id': 'asc'}],
+            filter.sort_order)
+
+        # A field in the default sort order isn't used twice.
+        filter.order = "sort_title"
+        filter.order_ascending = True
+        eq_([{'sort_title': 'asc'}, {'sort_author': 'asc'},
+             {'work_id': 'asc'}],
+            filter.sort_order)
+
     def test_target_age_filter(self):
         # Test an especially complex subfilter.
 
@@ -1937,6 +2433,177 @@ class TestBulkUpdate(DatabaseTest):
         eq_(set([w1, w2, w3]), set(successes))
         eq_([], failures)
 
+    def test_works_uploaded_in_chunks(self):
+        works = []
+        for i in range(5):
+            work = self._work()
+            work.set_presentation_ready()
+            works.append(work)
+        not_ready = self._work()
+        works.append(not_ready)
+
+        class ChunkRecordingIndex(MockExternalSearchIndex):
+            BULK_CHUNK_SIZE = 2
+            def __init__(self, *args, **kwargs):
+                super(ChunkRecordingIndex, self).__init__(*args, **kwargs)
+                self.requests = []
+            def bulk(self, docs, **kwargs):
+                self.requests.append(sorted(x['_id'] for x in docs))
+                return super(ChunkRecordingIndex, self).bulk(docs, **kwargs)
+
+        # Whether the uploads happen on this thread or in worker
+        # threads, the outcome is the same.
+        for in_flight in (0, 2):
+            # Make sure every document is uploaded, even the ones that
+            # were uploaded last time through the loop.
+            for work in works:
+                work.search_document_hash = None
+            index = ChunkRecordingIndex()
+            index.bulk_requests_in_flight = in_flight
+            successes, failures = index.bulk_update(works)
+            eq_(set(works), set(successes))
+            eq_([], failures)
+
+            # Three bulk requests were made, one per chunk, and the
+            # work that's not presentation ready was part of one of
+            # them.
+            eq_(sorted(x.id for x in works),
+                sorted(sum(index.requests, [])))
+            eq_(3, len(index.requests))
+            eq_(set(x.id for x in works[:5]),
+                set(x[-1] for x in index.docs.keys()))
+
+    def test_failures_matched_to_works(self):
+        w1 = self._work()
+        w1.set_presentation_ready()
+        w2 = self._work()
+        w2.set_presentation_ready()
+
+        class PartiallyDoomedIndex(MockExternalSearchIndex):
+            def bulk(self, docs, **kwargs):
+                # Elasticsearch reports document IDs as strings.
+                return 1, [dict(index=dict(_id=str(w2.id), status=500,
+                                           error="Too many cooks"))]
+        index = PartiallyDoomedIndex()
+        successes, failures = index.bulk_update([w1, w2])
+        eq_([w1], successes)
+        eq_([(w2, "Too many cooks")], failures)
+
+    def test_unchanged_documents_not_uploaded(self):
+        w1 = self._work()
+        w1.set_presentation_ready()
+        w2 = self._work()
+        w2.set_presentation_ready()
+
+        class UploadRecordingIndex(MockExternalSearchIndex):
+            def bulk(self, docs, **kwargs):
+                self.uploaded = sorted(x['_id'] for x in docs)
+                return super(UploadRecordingIndex, self).bulk(docs, **kwargs)
+        index = UploadRecordingIndex()
+
+        # The first time the works are indexed, both documents are
+        # uploaded, and the hash of each document is stored.
+        successes, failures = index.bulk_update([w1, w2])
+        eq_(sorted([w1.id, w2.id]), index.uploaded)
+        for work in (w1, w2):
+            eq_(
+                index.search_document_hash(
+                    index.works_index, work.to_search_document()
+                ),
+                work.search_document_hash
+            )
+
+        # If we index them again, only the work whose search document
+        # changed is uploaded -- but both works are successes, since
+        # the index is accurate for both.
+        w2.presentation_edition.title = u"A new title"
+        self._db.flush()
+        successes, failures = index.bulk_update([w1, w2])
+        eq_([w2.id], index.uploaded)
+        eq_(set([w1, w2]), set(successes))
+        eq_([], failures)
+
+        # A document is considered new if it's going into a
+        # different index.
+        index.works_index = "other-index"
+        index.bulk_update([w1])
+        eq_([w1.id], index.uploaded)
+
+        # The hash can be ignored, for when the index might not
+        # contain what we think it contains.
+        index.uploaded = []
+        index.bulk_update([w1], force=True)
+        eq_([w1.id], index.uploaded)
+
+        # Once a work is removed from the index, its hash is
+        # cleared so it will be uploaded again if it comes back.
+        w1.presentation_ready = False
+        index.bulk_update([w1])
+        eq_(None, w1.search_document_hash)
+
+    def test_failed_upload_not_hashed(self):
+        work = self._work()
+        work.set_presentation_ready()
+
+        class DoomedIndex(MockExternalSearchIndex):
+            def bulk(self, docs, **kwargs):
+                return 0, [dict(index=dict(_id=str(work.id), status=500,
+                                           error="Oops"))]
+        index = DoomedIndex()
+        successes, failures = index.bulk_update([work])
+        eq_([(work, "Oops")], failures)
+
+        # Since the upload failed, the work will be uploaded again
+        # next time.
+        eq_(None, work.search_document_hash)
+
+    def test_bulk_update_availability(self):
+        w1 = self._work(with_license_pool=True)
+        w1.set_presentation_ready()
+        w2 = self._work(with_license_pool=True)
+        w2.set_presentation_ready()
+        w2.search_document_hash = u"out of date"
+        index = MockExternalSearchIndex()
+
+        # w1 is in the index; w2 isn't.
+        index.bulk_update([w1])
+        assert w1.search_document_hash is not None
+        [pool] = w1.license_pools
+        pool.open_access = False
+        pool.licenses_owned = 1
+        pool.licenses_available = 0
+        self._db.flush()
+
+        successes, failures = index.bulk_update_availability([w1, w2])
+
+        # Only the availability information in w1's search document
+        # was changed.
+        [doc] = index.docs.values()
+        eq_(w1.id, doc['_id'])
+        eq_(None, doc['available_collections'])
+        eq_(None, doc['open_access_collections'])
+        eq_(w1.title, doc['title'])
+        eq_([w1], successes)
+
+        # Since w1's document in the index has changed, the next time
+        # it's reindexed the full document will be uploaded.
+        eq_(None, w1.search_document_hash)
+
+        # w2 couldn't be updated because it's not in the index. Its
+        # document hash is cleared so the full document will be
+        # uploaded next time, even if it hasn't changed.
+        eq_([(w2, "document_missing_exception")], failures)
+        eq_(None, w2.search_document_hash)
+
+    def test__bulk_error_details(self):
+        m = ExternalSearchIndex._bulk_error_details
+        eq_(('index', 5, 500, "oops"),
+            m(dict(index=dict(_id="5", status=500, error="oops"))))
+        eq_(('delete', 5, 404, None),
+            m(dict(delete=dict(_id=5, status=404))))
+        eq_((None, 6, None, "oops"),
+            m(dict(data=dict(_id=6), error="oops", exception="Exception")))
+
 class TestSearchErrors(ExternalSearchTest):
 
     def test_search_connection_timeout(self):
@@ -2088,3 +2755,146 @@ class TestSearchIndexMonitor(DatabaseTest):
         # The next time we call process_batch, no work is done and the
         # result is 0, meaning we're done with every work in the system.
         eq_(0, monitor.process_batch(work.id))
+
+
+class TestSearchIndexChangeMonitor(DatabaseTest):
+
+    def setup(self):
+        super(TestSearchIndexChangeMonitor, self).setup()
+        self.index = MockExternalSearchIndex()
+        self.monitor = SearchIndexChangeMonitor(
+            self._db, index_client=self.index, batch_size=2
+        )
+
+        # Start with a clean slate -- creating works in the test
+        # database records changes of its own.
+        self.w1 = self._work(with_license_pool=True)
+        self.w2 = self._work(with_license_pool=True)
+        self.w3 = self._work(with_license_pool=True)
+        for work in (self.w1, self.w2, self.w3):
+            work.presentation_ready = True
+        self._db.query(SearchIndexChange).delete()
+        self._db.commit()
+
+    def changes(self):
+        """The IDs of the pending SearchIndexChanges."""
+        return [
+            x.id for x in self._db.query(SearchIndexChange).order_by(
+                SearchIndexChange.id
+            )
+        ]
+
+    def test_process_batch(self):
+        # Nothing has changed, so there's nothing to do.
+        eq_(None, self.monitor.process_batch())
+
+        # w1 changes twice and w2 changes once.
+        for work in (self.w1, self.w2, self.w1):
+            work.external_index_needs_updating()
+        self._db.commit()
+        first, second, third = self.changes()
+
+        # The first batch covers the first two changes, which
+        # affect two different works.
+        eq_(second, self.monitor.process_batch())
+        eq_(set([self.w1.id, self.w2.id]),
+            set([id for (index, type, id) in self.index.docs.keys()]))
+
+        # The works that were indexed got WorkCoverageRecords.
+        for work in (self.w1, self.w2):
+            [record] = [
+                x for x in work.coverage_records
+                if x.operation==WorkCoverageRecord.UPDATE_SEARCH_INDEX_OPERATION
+            ]
+            eq_(WorkCoverageRecord.SUCCESS, record.status)
+
+        # The changes that were handled are gone; the other one is
+        # left for the next batch.
+        eq_([third], self.changes())
+        eq_(third, self.monitor.process_batch())
+        eq_([], self.changes())
+
+        # w3 never changed, so it was never indexed.
+        assert self.w3.id not in [
+            id for (index, type, id) in self.index.docs.keys()
+        ]
+
+    def test_run(self):
+        for work in (self.w1, self.w2, self.w3):
+            work.external_index_needs_updating()
+        self._db.commit()
+        last_change = self.changes()[-1]
+
+        # A single run handles every pending change, in batches.
+        self.monitor.run()
+        eq_([], self.changes())
+        eq_(3, len(self.index.docs))
+
+        # The ID of the last change handled is stored as the
+        # high-water mark.
+        timestamp = self.monitor.timestamp()
+        eq_(last_change, timestamp.counter)
+
+        # Running the Monitor again does nothing, and the high-water
+        # mark doesn't move.
+        self.index.docs = {}
+        self.monitor.run()
+        eq_({}, self.index.docs)
+        eq_(last_change, timestamp.counter)
+
+        # A change that was committed late, with an ID lower than the
+        # high-water mark, is still picked up.
+        self.w1.presentation_edition.title = u"A new title"
+        late = SearchIndexChange(work=self.w1, id=last_change-1)
+        self._db.add(late)
+        self._db.commit()
+        self.monitor.run()
+        eq_([self.w1.id], [id for (index, type, id) in self.index.docs.keys()])
+        eq_(last_change, timestamp.counter)
+
+    def test_availability_only_changes(self):
+        # Put all three works in the search index.
+        self.index.bulk_update([self.w1, self.w2, self.w3])
+        self._db.query(SearchIndexChange).delete()
+
+        class Mock(MockExternalSearchIndex):
+            def bulk_update(self, works, *args, **kwargs):
+                self.full = sorted(x.id for x in works)
+                return super(Mock, self).bulk_update(works, *args, **kwargs)
+
+            def bulk_update_availability(self, works):
+                self.partial = sorted(x.id for x in works)
+                return super(Mock, self).bulk_update_availability(works)
+        index = Mock()
+        index.docs = self.index.docs
+        self.monitor.search_index_client = index
+        self.monitor.batch_size = 10
+
+        # w1 has an availability change and then some other change.
+        # w2 only has an availability change. w3 has an availability
+        # change, but it's no longer presentation-ready.
+        self.w1.external_index_availability_needs_updating()
+        self.w1.external_index_needs_updating()
+        self.w2.external_index_availability_needs_updating()
+        self.w3.external_index_availability_needs_updating()
+        self.w3.presentation_ready = False
+        self._db.commit()
+
+        self.monitor.process_batch()
+
+        # Only w2 could be handled with a partial update.
+        eq_([self.w2.id], index.partial)
+        eq_(sorted([self.w1.id, self.w3.id]), index.full)
+        eq_(sorted([self.w1.id, self.w2.id]),
+            sorted(x[-1] for x in index.docs.keys()))
+        eq_([], self.changes())
+
+        # If a work can't be partially updated because it's not in
+        # the index, it gets a full update instead.
+        index.docs.clear()
+        self.w2.external_index_availability_needs_updating()
+        self._db.commit()
+        self.monitor.process_batch()
+        eq_([self.w2.id], index.partial)
+        eq_([self.w2.id], index.full)
+        eq_([self.w2.id], [x[-1] for x in index.docs.keys()])
@@ -12,12 +12,14 @@ from . import DatabaseTest
 from sqlalchemy.sql.elements import Case
 from sqlalchemy import (
     and_,
+    event,
     func,
 )
 
 from elasticsearch.exceptions import ElasticsearchException
 
 from ..classifier import Classifier
+from ..config import Configuration
 
 from ..entrypoint import (
     AudiobooksEntryPoint,
@@ -35,16 +37,23 @@ from ..lane import (
     Facets,
     FacetsWithEntryPoint,
     FeaturedFacets,
+    FeaturedWork,
+    FeaturedWorksMonitor,
+    KeysetPagination,
+    LaneTreeSnapshot,
     Pagination,
     SearchFacets,
+    SortKeyPagination,
     WorkList,
     Lane,
 )
 
 from ..model import (
     dump_query,
+    create,
     get_one_or_create,
     tuple_to_numericrange,
+    CachedFeed,
     CustomListEntry,
     DataSource,
     Edition,
@@ -472,6 +481,56 @@ class TestFacets(DatabaseTest):
         eq_([work_model.random],
             fields(Facets.ORDER_RANDOM))
 
+    def test_order_facet_to_search_field(self):
+        m = Facets.order_facet_to_search_field
+        eq_("sort_title", m(Facets.ORDER_TITLE))
+        eq_("sort_author", m(Facets.ORDER_AUTHOR))
+        eq_("work_id", m(Facets.ORDER_WORK_ID))
+        eq_("last_update_time", m(Facets.ORDER_LAST_UPDATE))
+        eq_("series_position", m(Facets.ORDER_SERIES_POSITION))
+        eq_("random", m(Facets.ORDER_RANDOM))
+
+        # The search index doesn't know when a work was added to a
+        # collection, so it can't sort works that way.
+        eq_(None, m(Facets.ORDER_ADDED_TO_COLLECTION))
+
+    def test_modify_search_filter(self):
+        # Test superclass behavior -- filter is modified by entrypoint.
+        facets = Facets(
+            self._default_library, Facets.COLLECTION_MAIN,
+            Facets.AVAILABLE_NOW, Facets.ORDER_LAST_UPDATE,
+            order_ascending=False, entrypoint=AudiobooksEntryPoint
+        )
+        filter = Filter()
+        facets.modify_search_filter(filter)
+        eq_([Edition.AUDIO_MEDIUM], filter.media)
+
+        # The availability and collection facets are passed along.
+        eq_(Facets.AVAILABLE_NOW, filter.availability)
+        eq_(Facets.COLLECTION_MAIN, filter.subcollection)
+        eq_(None, filter.minimum_featured_quality)
+
+        # So is the order, converted into the name of a search field.
+        eq_("last_update_time", filter.order)
+        eq_(False, filter.order_ascending)
+
+        # The 'featured' collection brings in the library's standard
+        # for featured books.
+        self._default_library.setting(
+            Library.MINIMUM_FEATURED_QUALITY
+        ).value = 0.72
+        facets = Facets(
+            self._default_library, Facets.COLLECTION_FEATURED,
+            Facets.AVAILABLE_ALL, Facets.ORDER_ADDED_TO_COLLECTION
+        )
+        filter = Filter()
+        facets.modify_search_filter(filter)
+        eq_(Facets.COLLECTION_FEATURED, filter.subcollection)
+        eq_(0.72, filter.minimum_featured_quality)
+
+        # An order the search index doesn't understand is left out.
+        eq_(None, filter.order)
+
     def test_order_by(self):
         from ..model import MaterializedWorkWithGenre as m
 
@@ -1200,6 +1259,158 @@ class TestPagination(DatabaseTest):
         pagination.this_page_size = 1
         eq_(True, pagination.has_next_page)
 
+    def test_from_request(self):
+        # No arguments -> default values.
+        pagination = Pagination.from_request({}.get)
+        eq_(0, pagination.offset)
+        eq_(Pagination.DEFAULT_SIZE, pagination.size)
+
+        pagination = Pagination.from_request({}.get, default_size=10)
+        eq_(10, pagination.size)
+
+        pagination = Pagination.from_request(
+            dict(size="20", after="40").get
+        )
+        eq_((40, 20), (pagination.offset, pagination.size))
+
+        # The page size can't go over the maximum.
+        pagination = Pagination.from_request(dict(size="5000").get)
+        eq_(Pagination.MAX_SIZE, pagination.size)
+
+        problem = Pagination.from_request(dict(size="big").get)
+        eq_(INVALID_INPUT.uri, problem.uri)
+        eq_("Invalid page size: big", str(problem.detail))
+
+        problem = Pagination.from_request(dict(after="later").get)
+        eq_(INVALID_INPUT.uri, problem.uri)
+        eq_("Invalid offset: later", str(problem.detail))
+
+    def test_modify_search_query(self):
+        class MockSearch(object):
+            def __getitem__(self, window):
+                return (window.start, window.stop)
+        eq_((20, 30), Pagination(20, 10).modify_search_query(MockSearch()))
+
+
+class TestSortKeyPagination(object):
+
+    class MockSearch(object):
+        def __init__(self):
+            self.sort_order = None
+            self.search_after = None
+            self.window = None
+
+        def sort(self, *order):
+            self.sort_order = order
+            return self
+
+        def to_dict(self):
+            if self.sort_order:
+                return dict(sort=list(self.sort_order))
+            return {}
+
+        def extra(self, search_after):
+            self.search_after = search_after
+            return self
+
+        def __getitem__(self, window):
+            self.window = (window.start, window.stop)
+            return self
+
+    def test_pagination_key(self):
+        # The first page has no pagination key.
+        first = SortKeyPagination(size=10)
+        eq_(None, first.pagination_key)
+        eq_([("size", 10)], list(first.items()))
+
+        # Once a page has been loaded, the next page picks up after
+        # the last item.
+        first.page_loaded([1, 2, 3], (5.5, u"3"))
+        eq_(3, first.this_page_size)
+        second = first.next_page
+        eq_([5.5, u"3"], second.last_item_on_previous_page)
+        eq_(10, second.offset)
+        eq_(10, second.size)
+
+        # The pagination key is opaque, but it can be turned back
+        # into the same page.
+        key = second.pagination_key
+        eq_([("key", key), ("size", 10)], list(second.items()))
+        eq_("key=%s&size=10" % key, second.query_string)
+        restored = SortKeyPagination.from_pagination_key(key, size=10)
+        eq_([5.5, u"3"], restored.last_item_on_previous_page)
+        eq_(10, restored.offset)
+
+        # The offset is kept in the key, so there's always a way to
+        # find the first and previous pages.
+        eq_(None, restored.first_page.pagination_key)
+        previous = restored.previous_page
+        eq_(0, previous.offset)
+        eq_(None, previous.last_item_on_previous_page)
+        eq_(None, first.previous_page)
+
+        # Garbage pagination keys are rejected.
+        for bad in ["not a key", "WzEsIDJd", "WyJhIiwgbnVsbF0="]:
+            assert_raises(
+                ValueError, SortKeyPagination.from_pagination_key, bad
+            )
+
+    def test_from_request(self):
+        pagination = SortKeyPagination.from_request({}.get, default_size=10)
+        eq_(10, pagination.size)
+        eq_(None, pagination.last_item_on_previous_page)
+
+        key = SortKeyPagination([1.0, u"5"], offset=20).pagination_key
+        pagination = SortKeyPagination.from_request(
+            dict(key=key, size="20").get
+        )
+        eq_(20, pagination.size)
+        eq_(20, pagination.offset)
+        eq_([1.0, u"5"], pagination.last_item_on_previous_page)
+
+        problem = SortKeyPagination.from_request(dict(key="garbage").get)
+        eq_(INVALID_INPUT.uri, problem.uri)
+        eq_("Invalid page key: garbage", str(problem.detail))
+
+        problem = SortKeyPagination.from_request(dict(size="big").get)
+        eq_("Invalid page size: big", str(problem.detail))
+
+    def test_modify_search_query(self):
+        old_value = SortKeyPagination.SEARCH_AFTER_SUPPORTED
+        try:
+            # If search_after is not supported, the offset is used.
+            SortKeyPagination.SEARCH_AFTER_SUPPORTED = False
+            pagination = SortKeyPagination([1.0, u"5"], size=10, offset=20)
+            search = pagination.modify_search_query(self.MockSearch())
+            eq_((20, 30), search.window)
+            eq_(None, search.sort_order)
+            eq_(None, search.search_after)
+
+            # Otherwise, results are explicitly sorted, so that each
+            # one comes back with its sort key...
+            SortKeyPagination.SEARCH_AFTER_SUPPORTED = True
+            search = SortKeyPagination(size=10).modify_search_query(
+                self.MockSearch()
+            )
+            eq_((0, 10), search.window)
+            eq_(tuple(SortKeyPagination.SORT_ORDER), search.sort_order)
+            eq_(None, search.search_after)
+
+            # ...and later pages start after the last item on the
+            # previous page, no matter how deep they are.
+            search = pagination.modify_search_query(self.MockSearch())
+            eq_((0, 10), search.window)
+            eq_([1.0, u"5"], search.search_after)
+
+            # If the search is already sorted in some other way, that
+            # order is kept.
+            search = self.MockSearch().sort("sort_title")
+            search = pagination.modify_search_query(search)
+            eq_(("sort_title",), search.sort_order)
+            eq_([1.0, u"5"], search.search_after)
+        finally:
+            SortKeyPagination.SEARCH_AFTER_SUPPORTED = old_value
+
 
 class MockFeaturedWorks(object):
     """A mock WorkList that mocks featured_works()."""
@@ -1257,6 +1468,130 @@ class MockWorks(WorkList):
         return query[:target_size]
 
 
+class TestKeysetPagination(DatabaseTest):
+
+    def test_sort_key(self):
+        work = self._work(title="A Title", authors="An Author",
+                          with_license_pool=True)
+        [pool] = work.license_pools
+        pool.availability_time = datetime.datetime(2018, 1, 2, 3, 4, 5)
+        self.add_to_materialized_view([work])
+        [mw] = self._db.query(work_model).all()
+
+        facets = Facets(
+            self._default_library, None, None, Facets.ORDER_ADDED_TO_COLLECTION
+        )
+        eq_(["2018-01-02T03:04:05", mw.sort_author, mw.sort_title,
+             mw.works_id],
+            KeysetPagination.sort_key(mw, facets))
+
+        facets = facets.navigate(order=Facets.ORDER_RANDOM)
+        eq_([str(mw.random), mw.sort_author, mw.sort_title, mw.works_id],
+            KeysetPagination.sort_key(mw, facets))
+
+        # Without a Facets object there's no definite order.
+        eq_(None, KeysetPagination.sort_key(mw, FeaturedFacets(0)))
+
+    def test_next_page_carries_sort_key(self):
+        pagination = KeysetPagination(size=2)
+        pagination.page_loaded([1, 2], [u"title", u"author", 2])
+        next_page = pagination.next_page
+        assert isinstance(next_page, KeysetPagination)
+        eq_(2, next_page.offset)
+        eq_([u"title", u"author", 2], next_page.last_item_on_previous_page)
+
+        # The key survives a trip through a URL.
+        from_request = KeysetPagination.from_request(
+            dict(next_page.items()).get
+        )
+        eq_(next_page.last_item_on_previous_page,
+            from_request.last_item_on_previous_page)
+        assert isinstance(next_page.first_page, KeysetPagination)
+        assert isinstance(next_page.previous_page, KeysetPagination)
+
+    def test_after_clause(self):
+        title = work_model.sort_title
+        work_id = work_model.works_id
+        order_by = [title.desc(), work_id.asc()]
+
+        # The number of values must match the ORDER BY clause.
+        assert_raises(
+            ValueError, KeysetPagination.after_clause, order_by, [u"a"]
+        )
+        # So must their types.
+        assert_raises(
+            ValueError, KeysetPagination.after_clause, order_by,
+            [u"a", {}]
+        )
+        assert_raises(
+            ValueError, KeysetPagination.after_clause,
+            [work_model.availability_time.asc()], [u"yesterday"]
+        )
+
+        # Nothing sorts after NULL in ascending order.
+        clause = KeysetPagination.after_clause([title.asc()], [None])
+        eq_("false", str(clause))
+
+    def test_works_pages_through_lane(self):
+        """Using KeysetPagination with WorkList.works() finds every
+        work exactly once, in the same order as OFFSET would.
+        """
+        works = [
+            self._work(title="Title B", authors="Author", with_license_pool=True),
+            self._work(title="Title A", authors="Author", with_license_pool=True),
+            self._work(title="Title A", authors="Author", with_license_pool=True),
+            self._work(title="Title C", with_license_pool=True),
+            self._work(title="Title D", authors="Author", with_license_pool=True),
+        ]
+        # One of the works has no sort author.
+        works[3].presentation_edition.sort_author = None
+        for i, work in enumerate(works):
+            [pool] = work.license_pools
+            pool.availability_time = datetime.datetime(2018, 1, 1+i)
+        works[4].license_pools[0].availability_time = None
+        self.add_to_materialized_view(works)
+
+        wl = WorkList()
+        wl.initialize(self._default_library)
+
+        def page_through(facets):
+            pagination = KeysetPagination(size=2)
+            found = []
+            for i in range(10):
+                page = wl.works(self._db, facets, pagination).all()
+                if not page:
+                    break
+                found.extend(x.works_id for x in page)
+                pagination.page_loaded(
+                    [x.works_id for x in page],
+                    KeysetPagination.sort_key(page[-1], facets)
+                )
+                pagination = pagination.next_page
+            return found
+
+        for order in (Facets.ORDER_TITLE, Facets.ORDER_AUTHOR,
+                      Facets.ORDER_ADDED_TO_COLLECTION):
+            for ascending in (True, False):
+                facets = Facets(
+                    self._default_library, Facets.COLLECTION_FULL,
+                    Facets.AVAILABLE_ALL, order, order_ascending=ascending
+                )
+                expect = [
+                    x.works_id for x in wl.works(self._db, facets).all()
+                ]
+                eq_(5, len(expect))
+                eq_(expect, page_through(facets))
+
+    def test_works_from_search_index_declines(self):
+        """The search index can't continue from a database sort key."""
+        wl = WorkList()
+        wl.initialize(self._default_library)
+        facets = Facets.default(self._default_library)
+        eq_(None, wl.works_from_search_index(
+            self._db, facets, KeysetPagination(), object()
+        ))
+
+
 class TestWorkList(DatabaseTest):
 
     def test_initialize(self):
@@ -1580,6 +1915,78 @@ class TestWorkList(DatabaseTest):
         wl.works_in_window(self._db, facets, 10)
         eq_(audio, wl.works_called_with.entrypoint)
 
+    def test_facet_counts(self):
+        library = self._default_library
+        library.setting(Library.ALLOW_HOLDS).value = "True"
+
+        # A high-quality open-access work.
+        open_access_high = self._work(with_open_access_download=True)
+        open_access_high.quality = 0.8
+
+        # A low-quality open-access work.
+        open_access_low = self._work(with_open_access_download=True)
+        open_access_low.quality = 0.2
+
+        # A high-quality licensed work which is not currently available.
+        licensed_high = self._work(with_license_pool=True)
+        licensed_high.quality = 0.8
+        [pool] = licensed_high.license_pools
+        pool.open_access = False
+        pool.licenses_owned = 1
+        pool.licenses_available = 0
+
+        self.add_to_materialized_view(
+            [open_access_high, open_access_low, licensed_high]
+        )
+
+        wl = WorkList()
+        wl.initialize(library)
+        facets = Facets(
+            library, Facets.COLLECTION_MAIN, Facets.AVAILABLE_ALL,
+            Facets.ORDER_TITLE
+        )
+
+        # Each availability facet is counted within the main
+        # collection, and each collection facet is counted among all
+        # available books, the way the patron would see them after
+        # following a facet link.
+        expect = {
+            Facets.AVAILABILITY_FACET_GROUP_NAME: {
+                Facets.AVAILABLE_ALL: 2,
+                Facets.AVAILABLE_NOW: 1,
+                Facets.AVAILABLE_OPEN_ACCESS: 1,
+            },
+            Facets.COLLECTION_FACET_GROUP_NAME: {
+                Facets.COLLECTION_FULL: 3,
+                Facets.COLLECTION_MAIN: 2,
+                Facets.COLLECTION_FEATURED: 2,
+            },
+        }
+        eq_(expect, wl.facet_counts(self._db, facets))
+
+        # The counts match what we'd find by actually applying each
+        # facet.
+        for group, value, new_facets, selected in facets.facet_groups:
+            if group in expect:
+                eq_(expect[group][value],
+                    wl.works(self._db, facets=new_facets).count())
+
+        # The counts were cached.
+        [cached] = self._db.query(CachedFeed).filter(
+            CachedFeed.type==CachedFeed.FACET_COUNTS_TYPE
+        ).all()
+        eq_(expect, json.loads(unicode(cached.content)))
+
+        # So a new book doesn't show up in the counts right away...
+        another = self._work(with_open_access_download=True)
+        another.quality = 0.8
+        self.add_to_materialized_view([another])
+        eq_(expect, wl.facet_counts(self._db, facets))
+
+        # ...unless the cache is bypassed.
+        counts = wl.facet_counts(self._db, facets, use_cache=False)
+        eq_(4, counts[Facets.COLLECTION_FACET_GROUP_NAME][Facets.COLLECTION_FULL])
+
     def test_works(self):
         """Verify that WorkList.works() correctly locates works
         that match the criteria specified by apply_filters().
@@ -1674,6 +2081,75 @@ class TestWorkList(DatabaseTest):
             self._db.delete(lpdm)
         eq_([], wl.works_for_specific_ids(self._db, [w2.id]))
 
+    def test_works_from_search_index(self):
+        w1 = self._work(with_license_pool=True)
+        w2 = self._work(with_license_pool=True)
+        self.add_to_materialized_view([w1, w2])
+
+        class MockSearchIndex(object):
+            error = None
+            def query_works(self, query_string, filter, pagination, debug):
+                if self.error:
+                    raise self.error
+                self.called_with = (query_string, filter, pagination, debug)
+                return [w2.id, w1.id]
+        search = MockSearchIndex()
+
+        wl = WorkList()
+        wl.initialize(self._default_library)
+        facets = Facets(
+            self._default_library, Facets.COLLECTION_FULL,
+            Facets.AVAILABLE_ALL, Facets.ORDER_TITLE
+        )
+        pagination = Pagination(size=2)
+
+        # The works are found through the search index, in the order
+        # given by the search index, and turned into
+        # MaterializedWorkWithGenre objects.
+        works = wl.works_from_search_index(
+            self._db, facets, pagination, search, debug=True
+        )
+        eq_([w2.id, w1.id], [x.works_id for x in works])
+
+        # The search index was asked for every work that matches a
+        # Filter built from the WorkList and the facets.
+        query_string, filter, used_pagination, debug = search.called_with
+        eq_(None, query_string)
+        eq_([self._default_collection.id], filter.collection_ids)
+        eq_("sort_title", filter.order)
+        eq_(pagination, used_pagination)
+        eq_(True, debug)
+
+        # In some cases the search index can't be used, and None is
+        # returned to indicate that works() should be used instead.
+        search.called_with = None
+        def from_index(facets=facets):
+            return wl.works_from_search_index(
+                self._db, facets, pagination, search
+            )
+
+        # The search index can't sort by the time a work was added to
+        # a collection.
+        facets = Facets(
+            self._default_library, Facets.COLLECTION_FULL,
+            Facets.AVAILABLE_ALL, Facets.ORDER_ADDED_TO_COLLECTION
+        )
+        eq_(None, from_index(facets))
+
+        # A Facets object is needed to know what order to use.
+        eq_(None, from_index(FacetsWithEntryPoint()))
+
+        # The search index doesn't know when a work was last seen on
+        # a list.
+        wl.list_seen_in_previous_days = 30
+        eq_(None, from_index())
+        wl.list_seen_in_previous_days = None
+        eq_(None, search.called_with)
+
+        # If the search index can't be reached, the database is used.
+        search.error = ElasticsearchException("oops")
+        eq_(None, from_index())
+
     def test_apply_filters(self):
 
         called = dict()
@@ -2129,6 +2605,19 @@ class TestWorkList(DatabaseTest):
         eq_(set([i1, i2, i3, i4, i5, i6, i7, i8, i9, i10]),
             set(sample))
 
+        # If the estimated size of the query is too high, the random
+        # offset can go past the end of the query. When that happens,
+        # the sample is taken from the start of the query instead.
+        from .. import lane as lane_module
+        old_count_estimate = lane_module.count_estimate
+        lane_module.count_estimate = lambda query: 1000
+        random.seed(42)
+        try:
+            sample = WorkList.random_sample(qu, 2, quality_coefficient=1)
+        finally:
+            lane_module.count_estimate = old_count_estimate
+        eq_(set([i1, i2]), set(sample))
+
         # We weight the random sample towards the front of the list.
         # By default we only choose from the first 10% of the list.
         #
@@ -2340,6 +2829,135 @@ class TestLane(DatabaseTest):
         }
         eq_(expect, fiction.size_by_entrypoint)
 
+    def test_update_sizes(self):
+        work = self._work(fiction=True, with_license_pool=True,
+                          genre="Science Fiction")
+        fiction = self._lane(display_name="Fiction", fiction=True)
+        sf = self._lane(display_name="SF", genres=["Science Fiction"])
+        romance = self._lane(display_name="Romance", genres=["Romance"])
+        self.add_to_materialized_view([work])
+        lanes = [fiction, sf, romance]
+
+        # The sizes of all three lanes are calculated with a single
+        # query against the materialized view.
+        queries = []
+        def count_queries(conn, cursor, statement, *args):
+            if work_model.__table__.name in statement:
+                queries.append(statement)
+        connection = self._db.connection()
+        event.listen(connection, "before_cursor_execute", count_queries)
+        try:
+            statistics = Lane.size_statistics(self._db)
+            updated = Lane.update_sizes(self._db, lanes, statistics=statistics)
+        finally:
+            event.remove(connection, "before_cursor_execute", count_queries)
+        eq_(2, len(queries))
+        eq_(lanes, updated)
+        eq_([1, 1, 0], [x.size for x in lanes])
+        eq_(0, romance.size_by_entrypoint[AudiobooksEntryPoint.URI])
+        for lane in lanes:
+            assert lane.size_fingerprint is not None
+
+        # If nothing has changed, no lanes are recalculated.
+        eq_([], Lane.update_sizes(self._db, lanes))
+
+        # A new science fiction book shows up. The Romance lane can't
+        # be affected, so it's skipped.
+        work2 = self._work(fiction=True, with_license_pool=True,
+                           genre="Science Fiction")
+        self.add_to_materialized_view([work2])
+        eq_([fiction, sf], Lane.update_sizes(self._db, lanes))
+        eq_([2, 2, 0], [x.size for x in lanes])
+
+        # Changing a lane's definition also means its size has to be
+        # recalculated.
+        romance.languages = ["spa"]
+        eq_([romance], Lane.update_sizes(self._db, lanes))
+
+        # If we insist, every lane is recalculated.
+        eq_(lanes, Lane.update_sizes(self._db, lanes, force=True))
+
+    def test_update_sizes_notices_customlist_changes(self):
+        work = self._work(fiction=True, with_license_pool=True)
+        work2 = self._work(fiction=True, with_license_pool=True)
+        customlist, ignore = self._customlist(num_entries=0)
+        customlist.add_entry(work)
+        self.add_to_materialized_view([work, work2])
+
+        lane = self._lane(display_name="Best Sellers")
+        lane.customlists.append(customlist)
+        from_data_source = self._lane(display_name="All Lists")
+        from_data_source.list_datasource = customlist.data_source
+        lanes = [lane, from_data_source]
+        self._db.flush()
+
+        eq_(lanes, Lane.update_sizes(self._db, lanes))
+        eq_([1, 1], [x.size for x in lanes])
+        eq_([], Lane.update_sizes(self._db, lanes))
+
+        # Putting a work that's already in the materialized view on
+        # the list doesn't change the summary of the materialized
+        # view, but it does change the size of both lanes.
+        customlist.add_entry(work2)
+        self.add_to_materialized_view([work2])
+        eq_(lanes, Lane.update_sizes(self._db, lanes))
+        eq_([2, 2], [x.size for x in lanes])
+
+        # So does taking a work off the list.
+        customlist.remove_entry(work)
+        self.add_to_materialized_view([work])
+        eq_(lanes, Lane.update_sizes(self._db, lanes))
+        eq_([1, 1], [x.size for x in lanes])
+
+        # A lane that doesn't draw from lists has nothing to
+        # summarize.
+        eq_(None, self._lane()._customlist_statistics(self._db))
+
+    def test_update_featured_works(self):
+        # One work in two subgenres of fiction.
+        work = self._work(fiction=True, with_license_pool=True,
+                          genre="Science Fiction")
+        romance, ignore = Genre.lookup(self._db, "Romance")
+        work.genres.append(romance)
+        fiction = self._lane(display_name="Fiction", fiction=True)
+        self.add_to_materialized_view([work])
+
+        # There's an outdated pool of featured works.
+        old_work = self._work()
+        FeaturedWork(lane=fiction, work=old_work, entrypoint=u"foo")
+        self._db.flush()
+
+        fiction.update_featured_works(self._db)
+        self._db.expire_all()
+
+        # The old pool was replaced. The work shows up once for each
+        # entry point that would show it, even though it's in the
+        # materialized view twice.
+        featured = sorted(
+            (x.entrypoint, x.work) for x in fiction.featured_work_pool
+        )
+        eq_([(EbooksEntryPoint.URI, work),
+             (EverythingEntryPoint.URI, work)], featured)
+        [f1, f2] = fiction.featured_work_pool
+        eq_(f1.quality_tier, f2.quality_tier)
+
+        # Running it again doesn't create duplicates.
+        fiction.update_featured_works(self._db)
+        self._db.expire_all()
+        eq_(2, len(fiction.featured_work_pool))
+
+        # The pool is built from a random window over the lane, so
+        # that it changes from one refresh to the next.
+        windows = []
+        def restrict(query, target_size, facets):
+            windows.append((target_size, facets.entrypoint))
+            return query
+        fiction._restrict_query_to_window = restrict
+        fiction.update_featured_works(self._db)
+        pool_size = (self._default_library.featured_lane_size *
+                     Lane.FEATURED_POOL_MULTIPLIER)
+        eq_([(pool_size, x) for x in EntryPoint.ENTRY_POINTS], windows)
+
     def test_visibility(self):
         parent = self._lane()
         visible_child = self._lane(parent=parent)
@@ -2446,6 +3064,124 @@ class TestLane(DatabaseTest):
         eq_([lane2], Lane.affected_by_customlist(l1).all())
         eq_(0, Lane.affected_by_customlist(l2).count())
 
+    def test_affected_by_works(self):
+        sf_work = self._work(fiction=True, with_license_pool=True,
+                             genre="Science Fiction")
+        romance_work = self._work(fiction=True, with_license_pool=True,
+                                  genre="Romance")
+        self.add_to_materialized_view([sf_work, romance_work])
+        fiction = self._lane(display_name="Fiction", fiction=True)
+        sf = self._lane(display_name="SF", genres=["Science Fiction"])
+        romance = self._lane(display_name="Romance", genres=["Romance"])
+
+        m = Lane.affected_by_works
+        eq_(set([fiction, sf]), m(self._db, [sf_work.id]))
+        eq_(set([fiction, sf, romance]),
+            m(self._db, [sf_work.id, romance_work.id]))
+        eq_(set(), m(self._db, []))
+
+        # The search can be restricted to certain lanes.
+        eq_(set([sf]), m(self._db, [sf_work.id], lanes=[sf, romance]))
+
+        # Lanes are checked in batches, with one query per batch.
+        queries = []
+        def count_queries(conn, cursor, statement, *args):
+            if work_model.__table__.name in statement:
+                queries.append(statement)
+        connection = self._db.connection()
+        event.listen(connection, "before_cursor_execute", count_queries)
+        old_batch_size = Lane.SIZE_BATCH_SIZE
+        Lane.SIZE_BATCH_SIZE = 2
+        try:
+            eq_(set([fiction, sf]), m(self._db, [sf_work.id]))
+        finally:
+            Lane.SIZE_BATCH_SIZE = old_batch_size
+            event.remove(connection, "before_cursor_execute", count_queries)
+        eq_(2, len(queries))
+
+    def test_invalidate_cached_feeds(self):
+        library = self._default_library
+        work = self._work()
+        fiction = self._lane(display_name="Fiction")
+        sf = self._lane(display_name="SF", parent=fiction)
+        romance = self._lane(display_name="Romance", parent=fiction)
+        nonfiction = self._lane(display_name="Nonfiction")
+
+        groups = CachedFeed.GROUPS_TYPE
+        page = CachedFeed.PAGE_TYPE
+        top_level = WorkList.top_level_for_library(self._db, library)
+        top_level_key = CachedFeed.identifying_fields(
+            self._db, top_level, None, None, None
+        )['unique_key']
+        def feed(lane, type, work=None, unique_key=top_level_key):
+            if lane:
+                unique_key = None
+            feed, ignore = create(
+                self._db, CachedFeed, lane=lane, type=type, work=work,
+                library=library, unique_key=unique_key, facets=u"",
+                pagination=u""
+            )
+            return feed
+        feeds = dict(
+            sf_page=feed(sf, page), sf_groups=feed(sf, groups),
+            sf_navigation=feed(sf, CachedFeed.NAVIGATION_TYPE),
+            fiction_page=feed(fiction, page),
+            fiction_groups=feed(fiction, groups),
+            romance_page=feed(romance, page),
+            nonfiction_page=feed(nonfiction, page),
+            nonfiction_groups=feed(nonfiction, groups),
+            top_page=feed(None, page), top_groups=feed(None, groups),
+            series_page=feed(None, page, unique_key=u"A Series-eng-All"),
+            work_feed=feed(None, CachedFeed.RECOMMENDATIONS_TYPE, work),
+        )
+
+        def stale_feeds():
+            for f in feeds.values():
+                self._db.expire(f)
+            stale = set(name for name, f in feeds.items() if f.stale)
+            self._db.query(CachedFeed).update(
+                {CachedFeed.stale: False}, synchronize_session=False
+            )
+            return stale
+
+        # A work in SF has changed. SF doesn't have a pool of
+        # featured works, so the work might be featured in the
+        # grouped feeds for SF and its parent.
+        m = Lane.invalidate_cached_feeds
+        eq_(5, m(self._db, [sf], [work.id]))
+        eq_(set(["sf_page", "sf_groups", "fiction_groups", "top_page",
+                 "work_feed"]), stale_feeds())
+
+        # Once SF has a pool of featured works, its grouped feeds are
+        # only affected by changes to those works.
+        create(self._db, FeaturedWork, lane=sf, work=self._work(),
+               entrypoint=EbooksEntryPoint.URI)
+        eq_(3, m(self._db, [sf], [work.id]))
+        eq_(set(["sf_page", "top_page", "work_feed"]), stale_feeds())
+
+        create(self._db, FeaturedWork, lane=sf, work=work,
+               entrypoint=EbooksEntryPoint.URI)
+        m(self._db, [sf], [work.id])
+        eq_(set(["sf_page", "sf_groups", "fiction_groups", "top_page",
+                 "work_feed"]), stale_feeds())
+
+        # If the lane is at the top level, its works may be featured
+        # in the grouped feed for the library's top-level WorkList.
+        m(self._db, [nonfiction])
+        eq_(set(["nonfiction_page", "nonfiction_groups", "top_page",
+                 "top_groups"]), stale_feeds())
+
+        # None of this affects feeds for WorkLists other than the
+        # top-level one, such as the feed for a series.
+        m(self._db, [sf, nonfiction])
+        assert "series_page" not in stale_feeds()
+
+        # A feed that's already stale isn't counted again.
+        eq_(4, m(self._db, [nonfiction]))
+        eq_(0, m(self._db, [nonfiction]))
+
+        eq_(0, m(self._db, []))
+
     def test_inherited_value(self):
         # Test WorkList.inherited_value.
         #
@@ -3088,6 +3824,168 @@ class TestLane(DatabaseTest):
         Lane._groups_for_lanes = old_value
 
 
+class TestLaneTreeSnapshot(DatabaseTest):
+
+    def test_build(self):
+        """A snapshot holds the same values the Lane properties
+        would calculate by walking the lane tree.
+        """
+        library = self._default_library
+        fiction = self._lane("Fiction", fiction=True, languages=["eng"])
+        fiction.audiences = [Classifier.AUDIENCE_ADULT]
+        fantasy = self._lane("Fantasy", parent=fiction)
+        fantasy.add_genre("Fantasy")
+        fantasy.add_genre("Urban Fantasy", inclusive=False)
+        no_fantasy = self._lane("Not Fantasy", parent=fiction)
+        no_fantasy.add_genre("Fantasy", inclusive=False)
+        no_fantasy.inherit_parent_restrictions = False
+
+        best_sellers, ignore = self._customlist(num_entries=0)
+        best_seller_fantasy = self._lane("Best Sellers", parent=fantasy)
+        best_seller_fantasy.customlists.append(best_sellers)
+        nyt, ignore = self._customlist(
+            num_entries=0, data_source_name=DataSource.NYT
+        )
+        nyt_lane = self._lane("NYT", parent=fiction)
+        nyt_lane.list_datasource = DataSource.lookup(self._db, DataSource.NYT)
+        self._db.flush()
+
+        snapshot = LaneTreeSnapshot.build(self._db, library.id)
+        lanes = [fiction, fantasy, no_fantasy, best_seller_fantasy, nyt_lane]
+        eq_(set([x.id for x in lanes]), set(snapshot.entries.keys()))
+        for lane in lanes:
+            entry = snapshot.entry(lane.id)
+            eq_(lane._gather_genre_ids(), entry.genre_ids)
+            if lane != nyt_lane:
+                eq_(lane._gather_customlist_ids(), entry.customlist_ids)
+            for k in LaneTreeSnapshot.INHERITED_FIELDS:
+                eq_(WorkList.inherited_value(lane, k), entry.inherited[k])
+            for k in LaneTreeSnapshot.ACCUMULATED_FIELDS:
+                if lane == nyt_lane and k == 'customlist_ids':
+                    continue
+                eq_(WorkList.inherited_values(lane, k), entry.accumulated[k])
+
+        # Spot-check some of the values.
+        entry = snapshot.entry(best_seller_fantasy.id)
+        eq_(True, entry.inherited['fiction'])
+        eq_([Classifier.AUDIENCE_ADULT], entry.inherited['audiences'])
+        eq_([fantasy.genre_ids], entry.accumulated['genre_ids'])
+        eq_([[best_sellers.id]], entry.accumulated['customlist_ids'])
+        # The lists from a DataSource aren't part of the snapshot.
+        nyt_entry = snapshot.entry(nyt_lane.id)
+        eq_(None, nyt_entry.customlist_ids)
+        eq_(None, nyt_entry.accumulated['customlist_ids'])
+        eq_(None, snapshot.entry(no_fantasy.id).inherited['fiction'])
+
+        # A lane from another library isn't in the snapshot.
+        other_library_lane = self._lane(library=self._library())
+        eq_(None, snapshot.entry(other_library_lane.id))
+
+    def test_for_library_caches_snapshot(self):
+        library = self._default_library
+        lane = self._lane()
+        snapshot = LaneTreeSnapshot.for_library(self._db, library.id)
+        eq_(snapshot, LaneTreeSnapshot.for_library(self._db, library.id))
+
+        # Looking up a snapshot doesn't flush pending changes.
+        lane.fiction = True
+        eq_(snapshot, LaneTreeSnapshot.for_library(self._db, library.id))
+        eq_(True, LaneTreeSnapshot.has_pending_changes(self._db))
+
+        # But once a change to the lane hierarchy is flushed in this
+        # process, the snapshot is obsolete.
+        self._db.flush()
+        eq_(False, LaneTreeSnapshot.has_pending_changes(self._db))
+        snapshot2 = LaneTreeSnapshot.for_library(self._db, library.id)
+        assert snapshot2 != snapshot
+        eq_(True, snapshot2.entry(lane.id).values['fiction'])
+        eq_(snapshot2, LaneTreeSnapshot.for_library(self._db, library.id))
+
+        # So does a change to the site configuration, which may have
+        # happened in some other process.
+        key = Configuration.SITE_CONFIGURATION_LAST_UPDATE
+        old_value = Configuration.instance.get(key)
+        Configuration.instance[key] = datetime.datetime(2000, 1, 1)
+        try:
+            snapshot3 = LaneTreeSnapshot.for_library(self._db, library.id)
+        finally:
+            Configuration.instance[key] = old_value
+        assert snapshot3 != snapshot2
+
+    def test_customlist_lifecycle(self):
+        # A Lane that takes every list from a DataSource sees a new
+        # list right away, even though creating the list didn't make
+        # the snapshot obsolete -- it might have been created by
+        # another process.
+        nyt = DataSource.lookup(self._db, DataSource.NYT)
+        nyt_lane = self._lane("NYT")
+        nyt_lane.list_datasource = nyt
+        self._db.flush()
+        snapshot = LaneTreeSnapshot.for_library(
+            self._db, self._default_library.id
+        )
+        generation = LaneTreeSnapshot._generation
+        eq_([], nyt_lane.inherited_values('customlist_ids'))
+
+        customlist, ignore = self._customlist(num_entries=0)
+        self._db.flush()
+        eq_(generation, LaneTreeSnapshot._generation)
+        del nyt_lane._customlist_ids
+        eq_([customlist.id], nyt_lane.customlist_ids)
+        eq_([[customlist.id]], nyt_lane.inherited_values('customlist_ids'))
+        eq_(snapshot, LaneTreeSnapshot.for_library(
+            self._db, self._default_library.id
+        ))
+
+        # Deleting a CustomList makes this process's snapshots
+        # obsolete, but it's not a change to the site configuration.
+        key = Configuration.SITE_CONFIGURATION_LAST_UPDATE
+        old_value = Configuration.instance.get(key)
+        last_update = datetime.datetime(2000, 1, 1)
+        Configuration.instance[key] = last_update
+        try:
+            generation = LaneTreeSnapshot._generation
+            self._db.delete(customlist)
+            self._db.flush()
+            assert LaneTreeSnapshot._generation > generation
+            eq_(last_update, Configuration.instance.get(key))
+        finally:
+            Configuration.instance[key] = old_value
+
+    def test_lane_uses_snapshot(self):
+        """Lane reads its genre IDs, custom list IDs and inherited
+        values from a LaneTreeSnapshot instead of calculating them.
+        """
+        parent = self._lane(fiction=True)
+        lane = self._lane(parent=parent)
+        lane.add_genre("Fantasy")
+        customlist, ignore = self._customlist(num_entries=0)
+        lane.customlists.append(customlist)
+        self._db.flush()
+
+        expect_genre_ids = lane._gather_genre_ids()
+        del lane._genre_ids
+        def doomed():
+            raise Exception("Should not be called")
+        lane._gather_genre_ids = doomed
+        lane._gather_customlist_ids = doomed
+
+        eq_(expect_genre_ids, lane.genre_ids)
+        eq_([customlist.id], lane.customlist_ids)
+        eq_(True, lane.inherited_value('fiction'))
+        eq_([expect_genre_ids], lane.inherited_values('genre_ids'))
+
+        # A lane that's not in the database yet calculates the values
+        # itself.
+        eq_(None, Lane().inherited_value('fiction'))
+
+        # So does a lane whose hierarchy has changes that haven't
+        # been flushed yet.
+        parent.fiction = False
+        eq_(False, lane.inherited_value('fiction'))
+        eq_(True, LaneTreeSnapshot.has_pending_changes(self._db))
+
+
 class TestWorkListGroups(DatabaseTest):
     """Tests of WorkList.groups() and the helper methods."""
 
@@ -3438,43 +4336,215 @@ class TestWorkListGroups(DatabaseTest):
         eq_(wl.uses_customlists, facets2.uses_customlists)
 
     def test_featured_works_with_lanes(self):
-        """_featured_works_with_lanes calls works_in_window on every lane
-        pass in to it.
+        """_featured_works_with_lanes finds a window of works for every
+        lane passed in to it, using a single query.
         """
-        class Mock(object):
-            """A Mock of Lane.works_in_window."""
+        library = self._default_library
+        library.setting(library.FEATURED_LANE_SIZE).value = "2"
+
+        def _w(**kwargs):
+            return self._work(with_license_pool=True, fiction=True, **kwargs)
+        hq_sf = _w(title="HQ SF", genre="Science Fiction")
+        hq_sf.quality = 0.8
+        lq_sf = _w(title="LQ SF", genre="Science Fiction")
+        lq_sf.quality = 0.1
+        hq_ro = _w(title="HQ Romance", genre="Romance")
+        hq_ro.quality = 0.8
+        self.add_to_materialized_view([hq_sf, lq_sf, hq_ro])
+
+        fiction = self._lane("Fiction")
+        fiction.fiction = True
+        sf_lane = self._lane(
+            "Science Fiction", parent=fiction, genres=["Science Fiction"]
+        )
+        romance_lane = self._lane(
+            "Romance", parent=fiction, genres=["Romance"]
+        )
+        empty_lane = self._lane("Westerns", parent=fiction, genres=["Westerns"])
+
+        class QueryCounter(object):
+            """Count queries against the materialized view."""
+            count = 0
+            def __call__(self, conn, cursor, statement, *args):
+                if work_model.__table__.name in statement:
+                    self.count += 1
+        counter = QueryCounter()
+        connection = self._db.connection()
+        event.listen(connection, "before_cursor_execute", counter)
+
+        facets = FeaturedFacets(0.5)
+        try:
+            results = list(fiction._featured_works_with_lanes(
+                self._db, [romance_lane, empty_lane, sf_lane], facets
+            ))
+        finally:
+            event.remove(connection, "before_cursor_execute", counter)
+
+        # Every lane's window was found with a single query against
+        # the materialized view.
+        eq_(1, counter.count)
+
+        # Each work was tagged with the lane that found it. The lanes
+        # show up in the order they were passed in, and within each
+        # lane, higher-quality works show up first.
+        eq_(
+            [(hq_ro.id, romance_lane), (hq_sf.id, sf_lane),
+             (lq_sf.id, sf_lane)],
+            [(mw.works_id, lane) for mw, quality_tier, lane in results]
+        )
+        sf_tiers = [quality_tier for mw, quality_tier, lane in results
+                    if lane == sf_lane]
+        eq_(sorted(sf_tiers, reverse=True), sf_tiers)
+
+        # A lane whose works() returns None is left out of the query.
+        class NoWorks(object):
+            def works_in_window(self, _db, facets, target_size,
+                                featured_work_ids=None):
+                return None
+        eq_([], list(fiction._featured_works_with_lanes(
+            self._db, [NoWorks()], facets
+        )))
+
+        # If no lanes were given, no query is run.
+        eq_([], list(fiction._featured_works_with_lanes(
+            self._db, [], facets
+        )))
+
+        # A lane with a pool of featured works is restricted to works
+        # from the pool. A small lane's pool may be shorter than the
+        # lane -- that's fine.
+        pool = [FeaturedWork(lane=sf_lane, work=lq_sf, quality_tier=1,
+                             entrypoint=EverythingEntryPoint.URI)]
+        self._db.flush()
+        results = fiction._featured_works_with_lanes(
+            self._db, [romance_lane, sf_lane], facets
+        )
+        eq_([(hq_ro.id, romance_lane), (lq_sf.id, sf_lane)],
+            [(mw.works_id, lane) for mw, quality_tier, lane in results])
+
+        # But if works in the pool have left the lane, the pool is
+        # stale, and the lane gets a random window of works instead.
+        sf_lane.featured_work_pool = [
+            FeaturedWork(work=hq_ro, quality_tier=1,
+                         entrypoint=EverythingEntryPoint.URI)
+        ]
+        self._db.flush()
+        results = fiction._featured_works_with_lanes(
+            self._db, [romance_lane, sf_lane], facets
+        )
+        eq_([(hq_ro.id, romance_lane), (hq_sf.id, sf_lane),
+             (lq_sf.id, sf_lane)],
+            [(mw.works_id, lane) for mw, quality_tier, lane in results])
 
-            def __init__(self, mock_works):
-                self.mock_works = mock_works
+    def test_featured_work_sample(self):
+        library = self._default_library
+        lane1 = self._lane()
+        lane2 = self._lane()
+        no_pool = self._lane()
+        wl = WorkList()
+        wl.initialize(library)
+
+        hq = [self._work() for i in range(3)]
+        lq = [self._work() for i in range(3)]
+        for work in hq:
+            FeaturedWork(lane=lane1, work=work, quality_tier=8,
+                         entrypoint=EverythingEntryPoint.URI)
+        for work in lq:
+            FeaturedWork(lane=lane1, work=work, quality_tier=1,
+                         entrypoint=EverythingEntryPoint.URI)
+        FeaturedWork(lane=lane2, work=lq[0], quality_tier=1,
+                     entrypoint=AudiobooksEntryPoint.URI)
+        self._db.flush()
+
+        facets = FeaturedFacets(0.5)
+        samples = FeaturedWork.sample(
+            self._db, [lane1, lane2, no_pool, wl], facets, 2
+        )
+
+        # Only lanes with a pool for the relevant entry point show up.
+        eq_([lane1], samples.keys())
+
+        # We asked for two works, and got two high-quality works.
+        eq_(2, len(samples[lane1]))
+        assert set(samples[lane1]).issubset(set([x.id for x in hq]))
+
+        # A larger target size allows some overage, and dips into
+        # the lower quality tier. The high-quality works come first.
+        [sample] = FeaturedWork.sample(
+            self._db, [lane1], facets, 4
+        ).values()
+        eq_(5, len(sample))
+        eq_(set([x.id for x in hq]), set(sample[:3]))
+        assert set(sample[3:]).issubset(set([x.id for x in lq]))
+
+        # The facets' entry point picks the pool.
+        facets = FeaturedFacets(0.5, entrypoint=AudiobooksEntryPoint)
+        eq_({lane2: [lq[0].id]},
+            FeaturedWork.sample(self._db, [lane1, lane2], facets, 2))
+
+        # If no Lanes are given, there's nothing to look up.
+        eq_({}, FeaturedWork.sample(self._db, [wl], facets, 2))
+
+    def test_works_in_window_with_featured_work_ids(self):
+        """If featured_work_ids is passed into works_in_window(),
+        only those works are considered.
+        """
+        w1 = self._work(with_license_pool=True)
+        w2 = self._work(with_license_pool=True)
+        self.add_to_materialized_view([w1, w2])
+        lane = self._lane()
+        facets = FeaturedFacets(0)
 
-            def works_in_window(self, _db, facets, target_size):
-                self.called_with = [_db, facets, target_size]
-                return [self.mock_works]
+        qu = lane.works_in_window(self._db, facets, 2, featured_work_ids=[w2.id])
+        eq_([w2.id], [mw.works_id for mw, quality_tier in qu])
 
-        mock1 = Mock(("mw1","quality1"))
-        mock2 = Mock(("mw2","quality2"))
+        qu = lane.works_in_window(self._db, facets, 2)
+        eq_(set([w1.id, w2.id]),
+            set([mw.works_id for mw, quality_tier in qu]))
 
+    def test_featured_works_uses_pool(self):
+        """If a Lane has a pool of featured works, featured_works()
+        picks from the pool.
+        """
+        library = self._default_library
+        library.setting(library.FEATURED_LANE_SIZE).value = "3"
+        w1 = self._work(with_license_pool=True)
+        w2 = self._work(with_license_pool=True)
+        self.add_to_materialized_view([w1, w2])
         lane = self._lane()
-        facets = FeaturedFacets(0.1)
-        results = lane._featured_works_with_lanes(
-            self._db, [mock1, mock2], facets
-        )
 
-        # The results of works_in_window were annotated with the
-        # 'lane' that produced the result.
-        eq_([('mw1', 'quality1', mock1), ('mw2', 'quality2', mock2)],
-            list(results))
+        # The pool is shorter than the featured lane size, but that
+        # doesn't mean it's stale, so no random sample is taken.
+        FeaturedWork(lane=lane, work=w2, quality_tier=1,
+                     entrypoint=EverythingEntryPoint.URI)
+        self._db.flush()
+        def doomed(*args, **kwargs):
+            raise Exception("Should not be called")
+        lane.random_sample = doomed
+        eq_([w2.id], [x.works_id for x in lane.featured_works(self._db)])
+        del lane.random_sample
+
+        # If works in the pool are no longer in the lane,
+        # featured_works() takes a random sample of the lane instead.
+        w3 = self._work(with_license_pool=True)
+        lane.featured_work_pool = [
+            FeaturedWork(work=w3, quality_tier=1,
+                         entrypoint=EverythingEntryPoint.URI)
+        ]
+        self._db.flush()
+        eq_(set([w1.id, w2.id]),
+            set([x.works_id for x in lane.featured_works(self._db)]))
 
-        # Each Mock's works_in_window was called with the same
-        # arguments.
-        eq_(mock1.called_with, mock2.called_with)
+    def test_featured_works_monitor(self):
+        work = self._work(with_license_pool=True, fiction=True)
+        self.add_to_materialized_view([work])
+        fiction = self._lane(fiction=True)
+        nonfiction = self._lane(fiction=False)
 
-        # The Facets object passed in to _featured_works_with_lanes()
-        # is passed on into works_in_window().
-        _db, called_with_facets, target_size = mock1.called_with
-        eq_(self._db, _db)
-        eq_(facets, called_with_facets)
-        eq_(lane.library.featured_lane_size, target_size)
+        FeaturedWorksMonitor(self._db).run_once(None, None)
+        self._db.expire_all()
+        eq_(set([work]), set([x.work for x in fiction.featured_work_pool]))
+        eq_([], nonfiction.featured_work_pool)
 
     def test_featured_window(self):
         lane = self._lane()
@@ -1,6 +1,9 @@
 from collections import defaultdict
 import feedparser
 import datetime
+import flask
+from flask import Flask
+import json
 from lxml import etree
 from StringIO import StringIO
 from nose.tools import (
@@ -35,6 +38,7 @@ from ..model import (
     DeliveryMechanism,
     ExternalIntegration,
     Genre,
+    Library,
     MaterializedWorkWithGenre,
     Measurement,
     Representation,
@@ -49,15 +53,19 @@ from ..facets import FacetConstants
 from ..lane import (
     Facets,
     FeaturedFacets,
+    KeysetPagination,
     Lane,
     Pagination,
     SearchFacets,
+    SortKeyPagination,
     WorkList,
 )
 
 from ..opds import (
     AcquisitionFeed,
     Annotator,
+    FeedPrewarmJob,
+    FeedPrewarmMonitor,
     LookupAcquisitionFeed,
     NavigationFeed,
     OPDSFeed,
@@ -73,6 +81,7 @@ from ..util.opds_writer import (
     OPDSFeed,
     OPDSMessage,
 )
+from ..model.cachedfeed import FeedContent
 from ..opds_import import OPDSXMLParser
 
 from ..classifier import (
@@ -563,6 +572,35 @@ class TestOPDS(DatabaseTest):
         [with_author] = parsed['entries']
         eq_("Alice", with_author['authors'][0]['name'])
 
+    def test_deferred_entries(self):
+        work = self._work(with_open_access_download=True, authors="Alice")
+        message = OPDSMessage("urn:message", 404, "not found")
+
+        feed = AcquisitionFeed(self._db, "test", "http://the-url.com/",
+                               [work], precomposed_entries=[message],
+                               defer_entries=True)
+
+        # No entries are created until the feed is serialized.
+        eq_([], feed.feed.findall("{%s}entry" % AtomFeed.ATOM_NS))
+
+        # The serialized feed is the same as one whose entries were
+        # created up front.
+        u = "".join(feed.stream())
+        parsed = feedparser.parse(u)
+        [with_author] = parsed['entries']
+        eq_("Alice", with_author['authors'][0]['name'])
+        assert "urn:message" in u
+
+        # A feed can only be streamed once; the entries aren't kept
+        # around.
+        assert "Alice" not in "".join(feed.stream())
+
+        # Converting a feed with deferred entries to a string streams
+        # it.
+        feed = AcquisitionFeed(self._db, "test", "http://the-url.com/",
+                               [work], defer_entries=True)
+        eq_(1, len(feedparser.parse(unicode(feed))['entries']))
+
     def test_acquisition_feed_includes_license_source(self):
         work = self._work(with_open_access_download=True)
         feed = AcquisitionFeed(self._db, "test", "http://the-url.com/",
@@ -1054,6 +1092,109 @@ class TestOPDS(DatabaseTest):
         # they were cached before.
         eq_(sorted(parsed.entries), sorted(feedparser.parse(raw_page).entries))
 
+    def test_regenerate_function(self):
+        m = AcquisitionFeed._regenerate_function
+        calls = []
+        def method(_db, **kwargs):
+            calls.append((kwargs, flask.has_app_context()))
+            return "new feed"
+
+        facets = Facets.default(self._default_library)
+        annotator = TestAnnotator()
+
+        # A Lane is looked up again in the new session, and a new
+        # annotator is created for the new thread.
+        regenerate = m(method, self.fantasy, facets, annotator, title="t")
+        eq_("new feed", regenerate(self._db))
+        [(kwargs, in_app)] = calls
+        eq_(self.fantasy, kwargs['lane'])
+        eq_(self._default_library, kwargs['facets'].library)
+        assert isinstance(kwargs['annotator'], TestAnnotator)
+        assert kwargs['annotator'] is not annotator
+        eq_(True, kwargs['force_refresh'])
+        eq_("t", kwargs['title'])
+        eq_(False, in_app)
+
+        # A class of annotator is passed along as is.
+        regenerate = m(method, self.fantasy, facets, TestAnnotator)
+        regenerate(self._db)
+        eq_(TestAnnotator, calls[-1][0]['annotator'])
+
+        # If the feed was requested by a web application, it's
+        # regenerated within that application.
+        app = Flask(__name__)
+        with app.app_context():
+            regenerate = m(method, self.fantasy, facets, TestAnnotator)
+        regenerate(self._db)
+        eq_(True, calls[-1][1])
+
+        # The library's top-level WorkList is built again from scratch.
+        top_level = WorkList.top_level_for_library(
+            self._db, self._default_library
+        )
+        regenerate = m(method, top_level, facets, TestAnnotator)
+        regenerate(self._db)
+        new_top_level = calls[-1][0]['lane']
+        assert new_top_level is not top_level
+        eq_(top_level.display_name, new_top_level.display_name)
+        eq_(set(top_level.children), set(new_top_level.children))
+
+        # Unless the library's lanes have changed so much that it's
+        # not the same feed.
+        self._default_library.name = "A new name"
+        eq_(None, regenerate(self._db))
+
+        # Other kinds of WorkList can't be regenerated in the
+        # background, and neither can feeds whose annotators can't be
+        # recreated.
+        class OtherWorkList(WorkList):
+            pass
+        other = OtherWorkList()
+        other.initialize(self._default_library)
+        eq_(None, m(method, other, facets, TestAnnotator))
+
+        class MockAnnotator(Annotator):
+            def __init__(self, patron):
+                self.patron = patron
+        eq_(None, m(method, self.fantasy, facets, MockAnnotator(None)))
+
+        # An annotator without any arguments can always be recreated.
+        factory = Annotator().background_factory()
+        assert isinstance(factory(self._db), Annotator)
+
+    def test_page_feed_with_keyset_pagination(self):
+        """The 'next' link of a page found with KeysetPagination
+        carries the sort key of the last work on the page.
+        """
+        lane = self.contemporary_romance
+        work1 = self._work(genre=Contemporary_Romance, with_open_access_download=True)
+        work2 = self._work(genre=Contemporary_Romance, with_open_access_download=True)
+        self.add_to_materialized_view([work1, work2], True)
+        facets = Facets.default(self._default_library)
+
+        def make_page(pagination):
+            return AcquisitionFeed.page(
+                self._db, "test", self._url, lane, TestAnnotator,
+                pagination=pagination, cache_type=AcquisitionFeed.NO_CACHE
+            )
+        pagination = KeysetPagination(size=1)
+        parsed = feedparser.parse(make_page(pagination))
+        [entry] = parsed['entries']
+        eq_(work1.title, entry['title'])
+
+        [mw] = lane.works(self._db, facets, Pagination(size=1)).all()
+        eq_(KeysetPagination.sort_key(mw, facets),
+            pagination.last_item_on_this_page)
+        [next_link] = self.links(parsed, 'next')
+        eq_(TestAnnotator.feed_url(lane, facets, pagination.next_page),
+            next_link['href'])
+        assert 'key=' in next_link['href']
+
+        # The next page picks up after the first work.
+        parsed = feedparser.parse(make_page(pagination.next_page))
+        [entry] = parsed['entries']
+        eq_(work2.title, entry['title'])
+
     def test_page_feed_for_worklist(self):
         """Test the ability to create a paginated feed of works for a
         WorkList instead of a Lane.
@@ -1117,6 +1258,60 @@ class TestOPDS(DatabaseTest):
         # they were cached before.
         eq_(sorted(parsed.entries), sorted(feedparser.parse(raw_page).entries))
 
+    def test_page_feed_from_search_index(self):
+        """Test the ability to find the works in a paginated feed
+        through the search index instead of the database.
+        """
+        lane = self.conf
+        work1 = self._work(genre=Contemporary_Romance, with_open_access_download=True)
+        work2 = self._work(genre=Contemporary_Romance, with_open_access_download=True)
+        self.add_to_materialized_view([work1, work2], True)
+
+        class MockSearchEngine(object):
+            called = False
+            def query_works(self, *args):
+                self.called = True
+                return [work2.id]
+        search_engine = MockSearchEngine()
+
+        facets = Facets.default(self._default_library)
+        def make_page(pagination):
+            return AcquisitionFeed.page(
+                self._db, "test", self._url, lane, TestAnnotator,
+                facets=facets, pagination=pagination,
+                cache_type=AcquisitionFeed.NO_CACHE,
+                search_engine=search_engine
+            )
+
+        # By default, the search engine isn't used, even if it's
+        # provided.
+        parsed = feedparser.parse(make_page(Pagination(size=10)))
+        eq_(2, len(parsed['entries']))
+        eq_(False, search_engine.called)
+
+        # Once the library is configured to find lane works through
+        # the search index, the search engine decides which works
+        # show up in the feed.
+        self._default_library.setting(
+            Library.WORKS_FROM_SEARCH_INDEX
+        ).value = "true"
+        pagination = Pagination(size=10)
+        parsed = feedparser.parse(make_page(pagination))
+        eq_([work2.title], [x['title'] for x in parsed['entries']])
+        eq_(True, search_engine.called)
+        eq_(1, pagination.this_page_size)
+
+        # If the facets specify an order the search index can't
+        # handle, the database is used instead.
+        search_engine.called = False
+        facets = Facets(
+            self._default_library, Facets.COLLECTION_FULL,
+            Facets.AVAILABLE_ALL, Facets.ORDER_ADDED_TO_COLLECTION
+        )
+        parsed = feedparser.parse(make_page(Pagination(size=10)))
+        eq_(2, len(parsed['entries']))
+        eq_(False, search_engine.called)
+
     def test_from_query(self):
         """Test creating a feed for a custom list from a query.
         """
@@ -1170,6 +1365,13 @@ class TestOPDS(DatabaseTest):
         eq_(1, len(parsed['entries']))
         eq_([], self.links(parsed, 'next'))
 
+        # A page that holds exactly the rest of the list doesn't have
+        # a 'next' link either.
+        works = from_query(Pagination(size=2))
+        parsed = feedparser.parse(unicode(works))
+        eq_(2, len(parsed['entries']))
+        eq_([], self.links(parsed, 'next'))
+
 
     def test_groups_feed(self):
         """Test the ability to create a grouped feed of recommended works for
@@ -1329,7 +1531,7 @@ class TestOPDS(DatabaseTest):
         work2 = self._work(genre=Epic_Fantasy, with_open_access_download=True)
         self.add_to_materialized_view([work1, work2], True)
 
-        pagination = Pagination(size=1)
+        pagination = SortKeyPagination(size=1)
         search_client = MockExternalSearchIndex()
         search_client.bulk_update([work1, work2])
 
@@ -1349,8 +1551,11 @@ class TestOPDS(DatabaseTest):
         eq_(TestAnnotator.groups_url(None), start['href'])
         eq_(TestAnnotator.top_level_title(), start['title'])
 
+        # The 'next' link uses a pagination key rather than an offset.
         [next_link] = self.links(parsed, 'next')
         eq_(TestAnnotator.search_url(fantasy_lane, "test", pagination.next_page), next_link['href'])
+        assert 'key=' in next_link['href']
+        assert 'after=' not in next_link['href']
 
         # This was the first page, so no previous link.
         eq_([], self.links(parsed, 'previous'))
@@ -1368,6 +1573,28 @@ class TestOPDS(DatabaseTest):
         eq_(TestAnnotator.search_url(fantasy_lane, "test", pagination), previous['href'])
         eq_(work2.title, parsed['entries'][0]['title'])
 
+        # If a plain Pagination object is passed in, the 'next' link
+        # uses an offset, since that's what the caller knows how to
+        # read.
+        feed = make_page(Pagination(size=1))
+        parsed = feedparser.parse(feed)
+        [next_link] = self.links(parsed, 'next')
+        assert 'after=1' in next_link['href']
+        assert 'key=' not in next_link['href']
+
+        # If no pagination is passed in, search results are paged
+        # through by sort key if Elasticsearch supports it, and by
+        # offset otherwise.
+        old_value = SortKeyPagination.SEARCH_AFTER_SUPPORTED
+        try:
+            for supported, expect in ((True, 'key='), (False, 'after=')):
+                SortKeyPagination.SEARCH_AFTER_SUPPORTED = supported
+                parsed = feedparser.parse(make_page(None))
+                [next_link] = self.links(parsed, 'next')
+                assert expect in next_link['href']
+        finally:
+            SortKeyPagination.SEARCH_AFTER_SUPPORTED = old_value
+
         # The feed has breadcrumb links
         parentage = list(fantasy_lane.parentage)
         root = ET.fromstring(feed)
@@ -1416,6 +1643,19 @@ class TestOPDS(DatabaseTest):
         assert work2.title not in feed2
         assert cached.timestamp == old_timestamp
 
+        # The cached feed is returned as unicode, just like a feed
+        # that was generated for this request...
+        eq_(True, isinstance(feed2, unicode))
+
+        # ...unless the caller asks for the FeedContent, which can be
+        # sent to a client without being decompressed.
+        content = AcquisitionFeed.page(
+            self._db, "test", self._url, fantasy_lane, TestAnnotator,
+            pagination=Pagination.default(), feed_content=True
+        )
+        eq_(True, isinstance(content, FeedContent))
+        eq_(feed2, unicode(content))
+
         # Change the policy to disable caching, and we get
         # a brand new page with the new work.
         policy.value = "0"
@@ -2447,3 +2687,252 @@ class TestNavigationFeed(DatabaseTest):
         eq_("http://%s/" % self.fantasy.id, fantasy_link["href"])
         eq_("subsection", fantasy_link["rel"])
         eq_(NavigationFeed.ACQUISITION_FEED_TYPE, fantasy_link["type"])
+
+
+class TestFeedPrewarmMonitor(DatabaseTest):
+
+    def setup(self):
+        super(TestFeedPrewarmMonitor, self).setup()
+        self.fiction = self._lane("Fiction")
+        self.fantasy = self._lane("Fantasy", parent=self.fiction)
+        self.nonfiction = self._lane("Nonfiction")
+
+        # This library only uses lanes, not entry points.
+        self._default_library.setting(
+            EntryPoint.ENABLED_SETTING
+        ).value = json.dumps([])
+
+        ConfigurationSetting.sitewide(
+            self._db, AcquisitionFeed.NONGROUPED_MAX_AGE_POLICY
+        ).value = 600
+
+        self.monitor = FeedPrewarmMonitor(
+            self._db, TestAnnotator, workers=1
+        )
+
+    def summary(self, jobs):
+        return [(job.type, job.lane_id, job.entrypoint) for job in jobs]
+
+    def cache(self, job, age, request_count=0):
+        """Create a cached copy of the feed a job would regenerate."""
+        library = self._default_library
+        worklist = job.worklist(self._db, library)
+        feed, usable = CachedFeed.fetch(
+            self._db, worklist, job.type, job.facets(library, worklist),
+            job.pagination(), None, max_age=0
+        )
+        feed.update(self._db, u"some content")
+        feed.timestamp = (
+            datetime.datetime.utcnow() - datetime.timedelta(seconds=age)
+        )
+        feed.request_count = request_count
+        return feed
+
+    def test_annotator_required(self):
+        assert_raises(ValueError, FeedPrewarmMonitor, self._db)
+
+        # An annotator instance that can't create copies of itself
+        # can't be used, since the feeds are generated in worker
+        # threads.
+        class LibraryAnnotator(Annotator):
+            def __init__(self, library):
+                self.library = library
+        assert_raises(
+            ValueError, FeedPrewarmMonitor, self._db,
+            LibraryAnnotator(self._default_library)
+        )
+
+    def test_candidates(self):
+        groups = CachedFeed.GROUPS_TYPE
+        page = CachedFeed.PAGE_TYPE
+
+        candidates = list(self.monitor.candidates(self._default_library))
+        jobs = [job for job, max_age, required in candidates]
+
+        # Grouped feeds are regenerated for WorkLists with children,
+        # starting with the top-level WorkList. The first page of a
+        # WorkList with children is only regenerated if it's been
+        # cached before.
+        eq_([(groups, None, None, True), (page, None, None, False),
+             (groups, self.fiction.id, None, True),
+             (page, self.fiction.id, None, False),
+             (page, self.nonfiction.id, None, True),
+             (page, self.fantasy.id, None, True)],
+            [(job.type, job.lane_id, job.entrypoint, required)
+             for job, max_age, required in candidates])
+        eq_([0, 0, 1, 1, 1, 2], [job.depth for job in jobs])
+        eq_([AcquisitionFeed.CACHE_FOREVER, 600] * 2 + [600, 600],
+            [max_age for job, max_age, required in candidates])
+
+        # A job's lookup key is the key CachedFeed.fetch will use to
+        # find the feed.
+        job = jobs[-1]
+        feed = self.cache(job, 0)
+        eq_(feed.lookup_key, job.lookup_key)
+
+        # Every feed is regenerated under every enabled entry point.
+        self._default_library.setting(
+            EntryPoint.ENABLED_SETTING
+        ).value = json.dumps([
+            EbooksEntryPoint.INTERNAL_NAME, AudiobooksEntryPoint.INTERNAL_NAME
+        ])
+        jobs = [job for job, max_age, required
+                in self.monitor.candidates(self._default_library)]
+        eq_(12, len(jobs))
+        eq_([(groups, None, EbooksEntryPoint.INTERNAL_NAME),
+             (groups, None, AudiobooksEntryPoint.INTERNAL_NAME)],
+            self.summary(jobs[:2]))
+        eq_(12, len(set(job.lookup_key for job in jobs)))
+
+    def test_is_due(self):
+        m = self.monitor.is_due
+        now = datetime.datetime.utcnow()
+        forever = AcquisitionFeed.CACHE_FOREVER
+
+        # A feed that doesn't exist yet is always due.
+        eq_(True, m(None, 600, now))
+        eq_(True, m(None, forever, now))
+
+        # A feed that's cached forever is never due otherwise.
+        eq_(False, m(now - datetime.timedelta(days=300), forever, now))
+
+        # A feed that isn't cached is never due.
+        eq_(False, m(None, 0, now))
+
+        # Otherwise a feed is due once it's about to expire.
+        eq_(False, m(now, 600, now))
+        about_to_expire = now - datetime.timedelta(seconds=600) + (
+            self.monitor.LEAD_TIME / 2
+        )
+        eq_(True, m(about_to_expire, 600, now))
+        eq_(True, m(now - datetime.timedelta(days=1), 600, now))
+
+        # A feed that's been marked stale is due, no matter how long
+        # it's meant to be cached.
+        eq_(True, m(now, 600, now, stale=True))
+        eq_(True, m(now, forever, now, stale=True))
+
+    def test_due(self):
+        now = datetime.datetime.utcnow()
+        groups = CachedFeed.GROUPS_TYPE
+        page = CachedFeed.PAGE_TYPE
+
+        # At first, every required feed is due, the ones closest to
+        # the top level first.
+        eq_([(groups, None, None), (groups, self.fiction.id, None),
+             (page, self.nonfiction.id, None), (page, self.fantasy.id, None)],
+            self.summary(self.monitor.due(now)))
+
+        jobs = dict(
+            ((job.type, job.lane_id), job) for job, max_age, required
+            in self.monitor.candidates(self._default_library)
+        )
+
+        # A fresh feed isn't due.
+        self.cache(jobs[(page, self.fantasy.id)], 0)
+
+        # A grouped feed that's cached forever isn't due.
+        self.cache(jobs[(groups, self.fiction.id)], 10000)
+
+        # A feed that's about to expire is due.
+        nonfiction = self.cache(
+            jobs[(page, self.nonfiction.id)], 500, request_count=5
+        )
+
+        # A feed that's only regenerated once it's been requested is
+        # due once it's been requested.
+        self.cache(jobs[(page, self.fiction.id)], 1000, request_count=1)
+
+        # The most frequently requested feeds come first.
+        due = self.monitor.due(now)
+        eq_([(page, self.nonfiction.id, None), (page, self.fiction.id, None),
+             (groups, None, None)],
+            self.summary(due))
+
+        # The jobs know about the feeds they'll regenerate.
+        job = due[0]
+        eq_(nonfiction.id, job.feed_id)
+        eq_(nonfiction.timestamp, job.timestamp)
+        eq_(5, job.request_count)
+        eq_(None, due[-1].feed_id)
+
+    def test_run_once(self):
+        class MockPool(object):
+            def __init__(self):
+                self.jobs = []
+            def __enter__(self):
+                return self
+            def __exit__(self, *args):
+                pass
+            def put(self, job):
+                self.jobs.append(job)
+
+        # Given a pool, the monitor hands it the due jobs in order.
+        pool = MockPool()
+        monitor = FeedPrewarmMonitor(self._db, TestAnnotator, pool=pool)
+        now = datetime.datetime.utcnow()
+        monitor.run_once(None, now)
+        eq_(self.summary(monitor.due(now)), self.summary(pool.jobs))
+
+    def test_job(self):
+        [job] = [
+            job for job, max_age, required
+            in self.monitor.candidates(self._default_library)
+            if job.lane_id == self.nonfiction.id
+        ]
+
+        # Running the job creates the feed.
+        job.run(self._db)
+        feed = get_one(self._db, CachedFeed, lookup_key=job.lookup_key)
+        assert u'<feed' in feed.content
+        assert job.elapsed is not None
+
+        # How long it took was recorded.
+        assert feed.generation_time is not None
+
+        # A job that regenerates an existing feed doesn't do anything
+        # if the feed changed after the job was created.
+        class MockJob(FeedPrewarmJob):
+            generated = False
+            def generate(self, _db):
+                self.generated = True
+
+        job = MockJob(
+            self._default_library.id, self.nonfiction.id,
+            CachedFeed.PAGE_TYPE, None, lambda _db: TestAnnotator
+        )
+        job.feed_id = feed.id
+        job.timestamp = feed.timestamp - datetime.timedelta(seconds=1)
+        job.run(self._db)
+        eq_(False, job.generated)
+        eq_(None, job.elapsed)
+
+        # Otherwise the feed is regenerated.
+        job.timestamp = feed.timestamp
+        job.run(self._db)
+        eq_(True, job.generated)
+        assert job.elapsed is not None
+
+    def test_job_with_annotator_instance(self):
+        # Given an annotator instance, the monitor gives every job its
+        # own copy of the annotator, so that jobs running in different
+        # threads don't share one.
+        class RecordingAnnotator(TestAnnotator):
+            instances = []
+            def __init__(self):
+                super(RecordingAnnotator, self).__init__()
+                self.instances.append(self)
+        annotator = RecordingAnnotator()
+        monitor = FeedPrewarmMonitor(self._db, annotator, workers=1)
+        jobs = [job for job, max_age, required
+                in monitor.candidates(self._default_library)]
+        groups_job = [x for x in jobs if x.type==CachedFeed.GROUPS_TYPE][0]
+        page_job = [x for x in jobs if x.type==CachedFeed.PAGE_TYPE][0]
+        groups_job.run(self._db)
+        page_job.run(self._db)
+
+        # Two new annotators were created, one for each job. The
+        # annotator passed into the monitor was never used.
+        eq_(3, len(RecordingAnnotator.instances))
+        assert annotator not in RecordingAnnotator.instances[1:]
+        eq_({}, annotator.lanes_by_work)
@@ -72,7 +72,10 @@ from ..scripts import (
     MockStdin,
     OPDSImportScript,
     PatronInputScript,
+    RebuildSearchIndexScript,
     ReclassifyWorksForUncheckedSubjectsScript,
+    RefreshMaterializedViewsScript,
+    SearchQueryBenchmarkScript,
     RunCollectionMonitorScript,
     RunCoverageProviderScript,
     RunMonitorScript,
@@ -319,6 +322,110 @@ class TestRunMonitorScript(DatabaseTest):
             eq_("test value", c.ran_with_argument)
 
 
+class MockRebuildSearchIndex(MockExternalSearchIndex):
+    """A mock search index that knows which indexes have been created."""
+
+    def __init__(self, *args, **kwargs):
+        super(MockRebuildSearchIndex, self).__init__(*args, **kwargs)
+        self.created = set([self.works_index])
+        mock = self
+        class Indices(object):
+            def exists(self, index):
+                return index in mock.created
+        self.indices = Indices()
+
+    def setup_index(self, new_index=None):
+        self.created.add(new_index)
+
+
+class MockRebuildSearchIndexScript(RebuildSearchIndexScript):
+    """Index slices in this process rather than in worker processes."""
+
+    def __init__(self, *args, **kwargs):
+        super(MockRebuildSearchIndexScript, self).__init__(*args, **kwargs)
+        self.slices_run = []
+        self.fail = False
+
+    def run_workers(self, index_name, slices, batch_size):
+        self.slices_run.extend(slices)
+        self.search.works_index = index_name
+        failed = []
+        for id_range in slices:
+            if self.fail or not self.index_slice(
+                self._db, self.search, id_range, batch_size
+            ):
+                failed.append(id_range)
+        return failed
+
+
+class TestRebuildSearchIndexScript(DatabaseTest):
+
+    def test_slices(self):
+        m = RebuildSearchIndexScript.slices
+        eq_([], m(None, None, 4))
+        eq_([(1, 3), (4, 6), (7, 9), (10, 10)], m(1, 10, 4))
+        eq_([(5, 5)], m(5, 5, 4))
+        eq_([(1, 100)], m(1, 100, 0))
+
+    def test_do_run(self):
+        works = [self._work() for i in range(3)]
+        for work in works:
+            work.set_presentation_ready()
+
+        search = MockRebuildSearchIndex()
+        search.transfer_current_alias(self._db, "works-v2")
+        script = MockRebuildSearchIndexScript(self._db, search)
+        script.do_run(["--workers=2", "--version=3"])
+
+        # A new index was created and filled with documents by two
+        # workers, each working on its own range of works.
+        assert "works-v3" in search.created
+        eq_(2, len(script.slices_run))
+        eq_(set(("works-v3", "work-type", w.id) for w in works),
+            set(search.docs.keys()))
+
+        # Each worker kept its own checkpoint.
+        timestamps = self._db.query(Timestamp).filter(
+            Timestamp.service.like("Search index update (works-v3, works %")
+        )
+        eq_(2, timestamps.count())
+
+        # Bulk-load mode is over, and the alias now points to the
+        # new index.
+        eq_({}, search.bulk_loading)
+        eq_("works-v3", search.alias_index)
+
+    def test_do_run_does_not_swap_on_failure(self):
+        work = self._work()
+        work.set_presentation_ready()
+        search = MockRebuildSearchIndex()
+        search.transfer_current_alias(self._db, "works-v2")
+
+        # A worker failed, so the alias stays where it was.
+        script = MockRebuildSearchIndexScript(self._db, search)
+        script.fail = True
+        script.do_run(["--version=3"])
+        eq_("works-v2", search.alias_index)
+        eq_({}, search.bulk_loading)
+
+        # The same thing happens if the new index is missing works.
+        script = MockRebuildSearchIndexScript(self._db, search)
+        search.count_documents = lambda index: 0
+        script.do_run(["--version=3"])
+        eq_("works-v2", search.alias_index)
+
+        # ...unless that's within tolerance.
+        script.do_run(["--version=3", "--tolerance=1"])
+        eq_("works-v3", search.alias_index)
+
+    def test_do_run_refuses_to_rebuild_live_index(self):
+        search = MockRebuildSearchIndex()
+        search.transfer_current_alias(self._db, "works-v3")
+        script = MockRebuildSearchIndexScript(self._db, search)
+        script.do_run(["--version=3"])
+        eq_([], script.slices_run)
+
+
 class TestRunMultipleMonitorsScript(DatabaseTest):
 
     def test_do_run(self):
@@ -1481,6 +1588,18 @@ class TestShowLibrariesScript(DatabaseTest):
         eq_(expect_1 + "\n" + expect_2 + "\n", output.getvalue())
 
 
+class TestSearchQueryBenchmarkScript(object):
+
+    def test_do_run(self):
+        output = StringIO()
+        script = SearchQueryBenchmarkScript(output=output)
+        script.do_run(["--repetitions=1"])
+        lines = output.getvalue().split("\n")
+        assert lines[0].endswith("query strings, 1 repetitions each.")
+        assert lines[1].startswith("Without template cache:")
+        assert lines[2].startswith("With template cache:")
+
+
 class TestConfigureSiteScript(DatabaseTest):
 
     def test_unknown_setting(self):
@@ -2664,6 +2783,108 @@ class TestNYTBestSellerListsScript(object):
     pass
 
 
-class TestRefreshMaterializedViewsScript(object):
-    """TODO"""
-    pass
+class TestRefreshMaterializedViewsScript(DatabaseTest):
+
+    def test_update_lane_sizes(self):
+        work = self._work(fiction=True, with_license_pool=True)
+        fiction = self._lane(display_name="Fiction", fiction=True)
+        nonfiction = self._lane(display_name="Nonfiction", fiction=False)
+        self.add_to_materialized_view([work])
+
+        script = RefreshMaterializedViewsScript(self._db)
+        script.update_lane_sizes()
+        eq_(1, fiction.size)
+        eq_(0, nonfiction.size)
+
+        # Nothing has changed, so running it again doesn't recalculate
+        # anything.
+        fiction.size = 100
+        script.update_lane_sizes()
+        eq_(100, fiction.size)
+
+        # Unless we insist.
+        script.update_lane_sizes(force=True)
+        eq_(1, fiction.size)
+
+    def test_update_lane_sizes_in_parallel(self):
+        class MockPool(object):
+            def __init__(self):
+                self.jobs = []
+            def __enter__(self):
+                return self
+            def __exit__(self, *args):
+                pass
+            def put(self, job):
+                self.jobs.append(job)
+
+        fiction = self._lane(display_name="Fiction", fiction=True)
+        other_library = self._library()
+        other_lane = self._lane(library=other_library)
+
+        # One job is queued for each library.
+        script = RefreshMaterializedViewsScript(self._db)
+        pool = MockPool()
+        script.update_lane_sizes(force=True, pool=pool)
+        eq_(set([self._default_library.id, other_library.id]),
+            set(x.library_id for x in pool.jobs))
+        for job in pool.jobs:
+            eq_(True, job.force)
+            eq_(None, job.statistics)
+
+        # Running a job updates the sizes of that library's lanes.
+        fiction.size = 100
+        other_lane.size = 100
+        [job] = [x for x in pool.jobs
+                 if x.library_id == self._default_library.id]
+        job.do_run(self._db)
+        eq_(0, fiction.size)
+        eq_(100, other_lane.size)
+
+    def test_changes(self):
+        now = datetime.datetime.utcnow()
+        an_hour_ago = now - datetime.timedelta(hours=1)
+        recently = now - datetime.timedelta(minutes=30)
+        long_ago = now - datetime.timedelta(hours=2)
+
+        changed_work = self._work()
+        changed_work.last_update_time = recently
+        unchanged_work = self._work()
+        unchanged_work.last_update_time = long_ago
+
+        changed_list, ignore = self._customlist(num_entries=0)
+        changed_list.updated = recently
+        unchanged_list, ignore = self._customlist(num_entries=0)
+        unchanged_list.updated = long_ago
+
+        script = RefreshMaterializedViewsScript(self._db)
+        eq_(([changed_work.id], [changed_list]),
+            script.changes(an_hour_ago, now))
+
+    def test_invalidate_cached_feeds(self):
+        work = self._work(fiction=True, with_license_pool=True)
+        fiction = self._lane(display_name="Fiction", fiction=True)
+        nonfiction = self._lane(display_name="Nonfiction", fiction=False)
+        history = self._lane(display_name="History", fiction=False)
+        staff_picks = self._lane(display_name="Staff Picks")
+        customlist, ignore = self._customlist(num_entries=0)
+        staff_picks.customlists.append(customlist)
+        self.add_to_materialized_view([work])
+
+        feeds = dict()
+        for lane in (fiction, nonfiction, history, staff_picks):
+            feeds[lane], ignore = create(
+                self._db, CachedFeed, lane=lane, type=CachedFeed.PAGE_TYPE,
+                library=self._default_library, facets=u"", pagination=u""
+            )
+
+        # The work is in Fiction now. Before the materialized view
+        # was refreshed, it was in Nonfiction. The list used by Staff
+        # Picks also changed.
+        script = RefreshMaterializedViewsScript(self._db)
+        script.invalidate_cached_feeds(
+            [work.id], [customlist], lanes_before=[nonfiction]
+        )
+        for feed in feeds.values():
+            self._db.expire(feed)
+        eq_(set([fiction, nonfiction, staff_picks]),
+            set(lane for lane, feed in feeds.items() if feed.stale))
@@ -24,7 +24,9 @@ from ..util import (
     MetadataSimilarity,
     MoneyUtility,
     TitleProcessor,
+    count_estimate,
     fast_query_count,
+    planner_row_estimate,
     slugify
 )
 from ..util.median import median
@@ -495,6 +497,41 @@ class TestFastQueryCount(DatabaseTest):
         eq_(qu3.count(), fast_query_count(qu3))
 
 
+class TestCountEstimate(DatabaseTest):
+
+    def test_planner_row_estimate(self):
+        for x in range(4):
+            self._identifier()
+        qu = self._db.query(Identifier)
+
+        # We don't know exactly what the planner will say, but it
+        # will give us a number.
+        estimate = planner_row_estimate(qu)
+        assert isinstance(estimate, (int, long))
+
+        # The planner knows a query with a limit can't return more
+        # rows than the limit.
+        assert planner_row_estimate(qu.limit(2)) <= 2
+
+    def test_count_estimate(self):
+        for x in range(4):
+            self._identifier()
+        qu = self._db.query(Identifier)
+
+        # The planner's estimate for such a small table is below the
+        # threshold, so an exact count is run.
+        eq_(4, count_estimate(qu, threshold=1000000))
+
+        # With no threshold, the planner's estimate is always trusted.
+        eq_(planner_row_estimate(qu), count_estimate(qu, threshold=0))
+
+        # Distinct queries are estimated and counted properly.
+        e1 = self._edition(title="The title", authors="Author 1")
+        e2 = self._edition(title="The title", authors="Author 1")
+        qu = self._db.query(Edition).distinct(Edition.title)
+        eq_(1, count_estimate(qu, threshold=1000000))
+
+
 class TestSlugify(object):
 
     def test_slugify(self):
@@ -0,0 +1,84 @@
+from nose.tools import (
+    eq_,
+    set_trace,
+)
+
+from ..util.cache import LRUCache
+
+
+class MockClockCache(LRUCache):
+    """An LRUCache whose sense of time can be controlled."""
+    now = 1000
+
+    def _now(self):
+        return self.now
+
+
+class TestLRUCache(object):
+
+    def test_get_and_set(self):
+        cache = LRUCache()
+        eq_(None, cache.get("key"))
+        eq_("default", cache.get("key", "default"))
+        cache.set("key", "value")
+        eq_("value", cache.get("key"))
+        assert "key" in cache
+        eq_(1, len(cache))
+
+        # Hits and misses are counted.
+        eq_(1, cache.hits)
+        eq_(2, cache.misses)
+        eq_(1/3.0, cache.hit_ratio)
+
+    def test_max_entries(self):
+        cache = LRUCache(max_entries=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+
+        # Looking up 'a' makes 'b' the least recently used entry.
+        eq_(1, cache.get("a"))
+        cache.set("c", 3)
+        eq_(None, cache.get("b"))
+        eq_(1, cache.get("a"))
+        eq_(3, cache.get("c"))
+
+    def test_max_bytes(self):
+        cache = LRUCache(max_bytes=10, sizeof=len)
+        cache.set("a", "12345")
+        cache.set("b", "1234")
+        eq_(9, cache.resident_bytes)
+
+        # Adding this value pushes 'a' out of the cache.
+        cache.set("c", "12")
+        eq_(None, cache.get("a"))
+        eq_(6, cache.resident_bytes)
+
+        # A value that could never fit isn't stored at all.
+        cache.set("d", "12345678901")
+        eq_(None, cache.get("d"))
+        eq_("1234", cache.get("b"))
+
+        # Replacing a value updates the size of the cache.
+        cache.set("b", "1")
+        eq_(3, cache.resident_bytes)
+
+    def test_ttl(self):
+        cache = MockClockCache(ttl=10)
+        cache.set("key", "value")
+        cache.now += 9
+        eq_("value", cache.get("key"))
+        cache.now += 2
+        eq_(None, cache.get("key"))
+        eq_(0, len(cache))
+
+    def test_remove_and_clear(self):
+        cache = LRUCache(sizeof=len)
+        cache.set("a", "123")
+        cache.set("b", "45")
+        cache.remove("a")
+        cache.remove("no such key")
+        eq_(None, cache.get("a"))
+        eq_(2, cache.resident_bytes)
+        cache.clear()
+        eq_(0, len(cache))
+        eq_(0, cache.resident_bytes)
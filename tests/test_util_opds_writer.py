@@ -58,4 +58,33 @@ class TestAtomFeed(object):
         tag = etree.tostring(AtomFeed.author(**kwargs))
         assert tag.startswith('<author')
         assert 'xmlns:opf="http://www.idpf.org/2007/opf"' in tag
+
+    def test_stream(self):
+        feed = AtomFeed(u"Title \u2603", "http://url/")
+        entries = (AtomFeed.E.entry(AtomFeed.E.id("urn:%d" % i))
+                   for i in range(3))
+        pieces = list(feed.stream(entries))
+
+        # The feed-level tags and each entry are serialized
+        # separately.
+        assert len(pieces) > 3
+        assert pieces[0].startswith('<feed')
+        assert '<entry' not in pieces[0]
+        assert pieces[-1].strip().endswith('</feed>')
+
+        # Put together, they make a document containing everything in
+        # the feed plus the entries, with non-ASCII characters escaped
+        # just as they are by unicode().
+        document = "".join(pieces)
+        document.decode("ascii")
+        parsed = etree.fromstring(document)
+        eq_(u"Title \u2603",
+            parsed.find("{%s}title" % AtomFeed.ATOM_NS).text)
+        eq_(["urn:0", "urn:1", "urn:2"],
+            [x.text for x in parsed.findall(
+                "{%(ns)s}entry/{%(ns)s}id" % dict(ns=AtomFeed.ATOM_NS)
+            )])
+
+        # The entries were not added to the feed itself.
+        eq_([], feed.feed.findall("{%s}entry" % AtomFeed.ATOM_NS))
         assert tag.endswith('opf:role="ctb"/>')
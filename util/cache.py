@@ -0,0 +1,125 @@
+"""In-memory caches for values that are expensive to recalculate."""
+from nose.tools import set_trace
+from collections import OrderedDict
+from threading import RLock
+import sys
+import time
+
+
+class LRUCache(object):
+    """A thread-safe, in-memory cache that evicts the least recently
+    used entries once it grows too large.
+
+    The cache can be bounded by the number of entries, by the
+    (approximate) number of bytes taken up by the values, or both.
+    Entries may also expire after a certain number of seconds.
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None, ttl=None,
+                 sizeof=None):
+        """Constructor.
+
+        :param max_entries: The cache will never hold more than this
+            many entries.
+        :param max_bytes: The total size of the values in the cache
+            will not exceed this number of bytes.
+        :param ttl: An entry will be ignored once it has been in the
+            cache for this many seconds.
+        :param sizeof: A function that estimates the size of a value in
+            bytes. Defaults to sys.getsizeof.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof or sys.getsizeof
+
+        # Maps keys to (value, size, expiration time) 3-tuples, from
+        # least to most recently used.
+        self._entries = OrderedDict()
+        self._lock = RLock()
+        self.resident_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _now(self):
+        return time.time()
+
+    @property
+    def hit_ratio(self):
+        """What fraction of lookups have been satisfied by the cache?"""
+        total = self.hits + self.misses
+        if not total:
+            return 0.0
+        return self.hits / float(total)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        """Look up a value in the cache.
+
+        :return: The cached value, or `default` if the value is
+            missing or has expired.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                value, size, expires = entry
+                if expires is None or expires > self._now():
+                    # Move this entry to the most-recently-used end.
+                    self._entries[key] = entry
+                    self.hits += 1
+                    return value
+                self.resident_bytes -= size
+            self.misses += 1
+            return default
+
+    def set(self, key, value, size=None):
+        """Put a value in the cache, evicting older values if necessary.
+
+        :param size: The size of the value in bytes, if known.
+        """
+        if size is None:
+            size = self.sizeof(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            # This value would push everything else out of the cache,
+            # and it wouldn't fit anyway.
+            self.remove(key)
+            return
+        expires = None
+        if self.ttl is not None:
+            expires = self._now() + self.ttl
+        with self._lock:
+            self.remove(key)
+            self._entries[key] = (value, size, expires)
+            self.resident_bytes += size
+            self._evict()
+
+    def remove(self, key):
+        """Remove a value from the cache, if it's there."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.resident_bytes -= entry[1]
+
+    def clear(self):
+        """Remove every value from the cache."""
+        with self._lock:
+            self._entries.clear()
+            self.resident_bytes = 0
+
+    def _evict(self):
+        """Remove the least recently used entries until the cache is
+        within its bounds.
+        """
+        while self._entries and (
+            (self.max_entries is not None
+             and len(self._entries) > self.max_entries)
+            or (self.max_bytes is not None
+                and self.resident_bytes > self.max_bytes)
+        ):
+            key, (value, size, expires) = self._entries.popitem(last=False)
+            self.resident_bytes -= size
@@ -1,5 +1,6 @@
 
 import datetime
+import itertools
 import logging
 
 from lxml import builder, etree
@@ -150,6 +151,48 @@ class AtomFeed(object):
         string_tree = etree.tostring(self.feed, pretty_print=True)
         return string_tree.encode("utf8")
 
+    def stream(self, entries=()):
+        """Serialize this feed a piece at a time.
+
+        Everything already in the feed is written first, followed by
+        each of `entries` as it's produced, so the start of a large
+        feed can be sent before the rest of it exists.
+
+        :param entries: An iterable of <entry> tags to add to the end
+            of the feed. These are serialized and then discarded,
+            rather than being kept in the feed.
+
+        :yield: Pieces of the serialized feed. As with
+            etree.tostring(), non-ASCII characters are escaped.
+        """
+        if self.feed is None:
+            return
+        output = _SerializedChunks()
+        with etree.xmlfile(output, encoding="ASCII") as xf:
+            with xf.element(self.feed.tag, dict(self.feed.attrib),
+                            nsmap=self.feed.nsmap):
+                for element in itertools.chain(self.feed, entries):
+                    xf.write(element, pretty_print=True)
+                    xf.flush()
+                    yield output.take()
+        yield output.take()
+
+
+class _SerializedChunks(object):
+    """A file-like object that collects whatever is written to it
+    until it's taken away.
+    """
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    def take(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
 
 
 class OPDSFeed(AtomFeed):